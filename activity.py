@@ -0,0 +1,62 @@
+from bisect import bisect_right, insort
+from typing import Iterable
+
+from config import SENSORS
+from logger import logger, LOG_PID
+from platforms import Platform, SensorCallback
+
+LOG_PREFIX = f"{LOG_PID} {'activity.py':<20}"
+
+class ActivityProvider():
+    # Push providers feed every input event to the callback, poll providers are asked for the last input once per Watcher tick
+    def start(self, callback: SensorCallback) -> None:
+        return None
+
+    def get_last_input_ns(self) -> int | None:
+        return None
+
+class HookActivityProvider(ActivityProvider):
+    def __init__(self, platform: Platform, sensors: tuple[bool, bool, bool, bool] = SENSORS) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating HookActivityProvider')
+
+        self.platform = platform
+        self.sensors = sensors
+
+    def start(self, callback: SensorCallback) -> None:
+        # Global input hooks: sensor counters and events, at the cost of running Python code on every input of the desktop
+        self.platform.start_sensors(callback, self.sensors)
+
+class LastInputActivityProvider(ActivityProvider):
+    def __init__(self, platform: Platform) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating LastInputActivityProvider')
+
+        self.platform = platform
+
+    def get_last_input_ns(self) -> int | None:
+        # No hooks and no sensor counters: only active_time, from the time of the last input the system saw
+        return self.platform.get_last_input_ns()
+
+class FakeActivityProvider(ActivityProvider):
+    def __init__(self, platform: Platform, inputs_ns: Iterable[int] = ()) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating FakeActivityProvider')
+
+        # Scripted inputs on the platform monotonic clock: the Watcher sees those already passed, whatever the machine
+        self.platform = platform
+        self.inputs_ns = sorted(inputs_ns)
+
+    def input(self, time_ns: int | None = None) -> None:
+        insort(self.inputs_ns, self.platform.monotonic_ns() if time_ns is None else time_ns)
+
+    def get_last_input_ns(self) -> int | None:
+        index = bisect_right(self.inputs_ns, self.platform.monotonic_ns())
+
+        return self.inputs_ns[index - 1] if index else None
+
+def get_activity_provider(name: str, platform: Platform) -> ActivityProvider:
+    match name:
+        case 'hooks':
+            return HookActivityProvider(platform)
+        case 'last_input':
+            return LastInputActivityProvider(platform)
+        case _:
+            raise ValueError(f'Unknown activity provider: {name}')
@@ -0,0 +1,310 @@
+import bson
+import ctypes
+import os
+import psutil
+import socket
+import struct
+import sys
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import BUFSIZE, Client, Connection, Listener
+from pymongo.errors import ConnectionFailure
+from threading import Event, Thread
+from time import monotonic
+from typing import Any
+
+from config import AGGREGATOR_ADDRESS, AGGREGATOR_AUTHKEY, AGGREGATOR_INTERVAL, AGGREGATOR_TIMEOUT, SPOOL_BATCH_SIZE
+from database import database, get_collections
+from instance import InstanceLock
+from logger import logger, LOG_PID, LOG_PATH
+from metrics import metrics
+from schema import ensure_indexes
+from spool import Spool
+from writer import RecordWriter
+
+LOG_PREFIX = f"{LOG_PID} {'aggregator.py':<20}"
+
+AGGREGATOR_SPOOL_FILE = os.path.join(LOG_PATH, 'aggregator.db')
+AGGREGATOR_LOCK_FILE = os.path.join(LOG_PATH, 'aggregator.lock')
+
+# Protocol: an agent sends a BSON document {records: [Reporter records]}, the aggregator answers {ok: true} once they are in
+# its spool. The connection is authenticated with AGGREGATOR_AUTHKEY, and the records are attributed to the user the
+# operating system reports for the agent process, whatever user they name.
+AGGREGATOR_MESSAGE_BYTES = 16 * 1024 * 1024
+
+# Host-wide, the same for the agents of every user
+AGGREGATOR_PIPE_ADDRESS = r"\\.\pipe\watcher-aggregator"
+AGGREGATOR_SOCKET_ADDRESS = '/run/watcher/aggregator.sock'
+
+# Any local user may connect: the authkey and the peer credentials decide what is accepted. On Windows, SYSTEM, the
+# administrators and the owner get full access, the authenticated users read and write (the default DACL only lets them read)
+AGGREGATOR_SOCKET_MODE = 0o666
+AGGREGATOR_PIPE_SDDL = 'D:P(A;;GA;;;SY)(A;;GA;;;BA)(A;;GA;;;OW)(A;;GRGW;;;AU)'
+
+AGGREGATED_RECORDS = metrics.counter('aggregated_records_total', 'Records received from the agents')
+
+def get_aggregator_address() -> str:
+    if AGGREGATOR_ADDRESS:
+        return AGGREGATOR_ADDRESS
+
+    if sys.platform == "win32":
+        return AGGREGATOR_PIPE_ADDRESS
+
+    return AGGREGATOR_SOCKET_ADDRESS
+
+def get_peer_username(connection: Connection) -> str | None:
+    # None where the platform does not tell who is at the other end: the connection is refused
+    try:
+        if sys.platform == "win32":
+            from ctypes import wintypes
+
+            pid = wintypes.ULONG()
+            if not ctypes.windll.kernel32.GetNamedPipeClientProcessId(wintypes.HANDLE(connection.fileno()), ctypes.byref(pid)):
+                return None
+
+            return psutil.Process(pid.value).username()
+
+        if hasattr(socket, 'SO_PEERCRED'):
+            import pwd
+
+            with socket.socket(fileno=os.dup(connection.fileno())) as peer:
+                _, uid, _ = struct.unpack('3i', peer.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+
+            # As psutil names the user of a process
+            try:
+                return pwd.getpwuid(uid).pw_name
+            except KeyError:
+                return str(uid)
+    except (OSError, psutil.Error):
+        logger.exception(f'{LOG_PREFIX} Exception on reading the agent credentials ↴')
+
+    return None
+
+class SECURITY_ATTRIBUTES(ctypes.Structure):
+    _fields_ = [('nLength', ctypes.c_ulong), ('lpSecurityDescriptor', ctypes.c_void_p), ('bInheritHandle', ctypes.c_int)]
+
+def create_pipe_handle(address: str, first: bool) -> int:
+    # As multiprocessing creates each instance of the pipe, with AGGREGATOR_PIPE_SDDL instead of the default DACL
+    import _winapi
+
+    kernel32_dll = ctypes.windll.kernel32
+    kernel32_dll.CreateNamedPipeW.restype = ctypes.c_void_p
+
+    descriptor = ctypes.c_void_p()
+    if not ctypes.windll.advapi32.ConvertStringSecurityDescriptorToSecurityDescriptorW(AGGREGATOR_PIPE_SDDL, 1, ctypes.byref(descriptor), None):
+        raise ctypes.WinError()
+
+    try:
+        attributes = SECURITY_ATTRIBUTES(ctypes.sizeof(SECURITY_ATTRIBUTES), descriptor, 0)
+        flags = _winapi.PIPE_ACCESS_DUPLEX | _winapi.FILE_FLAG_OVERLAPPED
+
+        if first:
+            flags |= _winapi.FILE_FLAG_FIRST_PIPE_INSTANCE
+
+        handle = kernel32_dll.CreateNamedPipeW(
+            address, flags, _winapi.PIPE_TYPE_MESSAGE | _winapi.PIPE_READMODE_MESSAGE | _winapi.PIPE_WAIT,
+            _winapi.PIPE_UNLIMITED_INSTANCES, BUFSIZE, BUFSIZE, _winapi.NMPWAIT_WAIT_FOREVER, ctypes.byref(attributes)
+        )
+    finally:
+        kernel32_dll.LocalFree(descriptor)
+
+    if handle is None or handle == ctypes.c_void_p(-1).value:
+        raise ctypes.WinError()
+
+    return handle
+
+class AggregatorListener(Listener):
+    # The multiprocessing Listener, reachable by the agents of the other users of the host
+    def __init__(self, address: str, authkey: bytes) -> None:
+        super().__init__(address, authkey=authkey)
+
+        if sys.platform == "win32":
+            from multiprocessing.connection import PipeListener
+
+            class AggregatorPipeListener(PipeListener):
+                def _new_handle(self, first: bool = False) -> int:
+                    return create_pipe_handle(self._address, first)
+
+            # The first instance, created with the default DACL, is replaced before any agent is accepted
+            self._listener.close()
+            self._listener = AggregatorPipeListener(address)
+        else:
+            os.chmod(address, AGGREGATOR_SOCKET_MODE)
+
+class AggregatorClient():
+    def __init__(self, address: str | None = None) -> None:
+        self.address = address or get_aggregator_address()
+        self.connection: Connection | None = None
+        self.next_attempt = 0.0
+
+        if not AGGREGATOR_AUTHKEY:
+            logger.warning(f'{LOG_PREFIX} AGGREGATOR_AUTHKEY is not set, writing directly')
+
+    def __connect(self) -> Connection | None:
+        # Not running: the agent writes by itself and only tries again after AGGREGATOR_INTERVAL
+        if not AGGREGATOR_AUTHKEY or monotonic() < self.next_attempt:
+            return None
+
+        try:
+            self.connection = Client(self.address, authkey=AGGREGATOR_AUTHKEY.encode())
+            logger.info(f'{LOG_PREFIX} Connected to the aggregator')
+        except AuthenticationError:
+            logger.warning(f'{LOG_PREFIX} The aggregator refused the connection: wrong authkey')
+            self.next_attempt = monotonic() + AGGREGATOR_INTERVAL
+            return None
+        except (OSError, EOFError):
+            self.next_attempt = monotonic() + AGGREGATOR_INTERVAL
+            return None
+
+        return self.connection
+
+    def __disconnect(self) -> None:
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+        self.next_attempt = monotonic() + AGGREGATOR_INTERVAL
+
+    def send(self, records: list[dict[str, Any]]) -> bool:
+        connection = self.connection or self.__connect()
+
+        if not connection:
+            return False
+
+        try:
+            connection.send_bytes(bson.encode({'records': records}))
+
+            # A timed out batch may still reach the database through the aggregator: rare, and preferred to losing it
+            if not connection.poll(AGGREGATOR_TIMEOUT):
+                raise TimeoutError
+
+            if bson.decode(connection.recv_bytes(AGGREGATOR_MESSAGE_BYTES)).get('ok'):
+                return True
+        except (OSError, EOFError, TimeoutError, bson.errors.BSONError):
+            logger.warning(f'{LOG_PREFIX} Lost the aggregator, writing directly')
+
+        self.__disconnect()
+        return False
+
+class Aggregator():
+    def __init__(self, stop_event: Event, address: str | None = None) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating Aggregator')
+
+        self.stop_event = stop_event
+        self.address = address or get_aggregator_address()
+
+        # One client and one registry for the whole host: apps are registered once, whatever the number of agents
+        self.writer = RecordWriter(get_collections(database.get_database("watcher")))
+        self.spool = Spool(AGGREGATOR_SPOOL_FILE)
+        self.indexes_ensured = False
+
+        metrics.gauge('spool_pending', 'Records waiting in the spool', function=self.spool.pending)
+
+    def __serve(self, connection: Connection) -> None:
+        try:
+            username = get_peer_username(connection)
+
+            if not username:
+                logger.warning(f'{LOG_PREFIX} Connection refused: unknown agent user')
+                return None
+
+            while not self.stop_event.is_set():
+                records: list[dict[str, Any]] = bson.decode(connection.recv_bytes(AGGREGATOR_MESSAGE_BYTES))['records']
+
+                for record in records:
+                    record['user'] = username
+
+                self.spool.append(records)
+                connection.send_bytes(bson.encode({'ok': True}))
+
+                AGGREGATED_RECORDS.inc(len(records))
+        except EOFError:
+            logger.debug(f'{LOG_PREFIX} Agent disconnected')
+        except Exception:
+            logger.exception(f'{LOG_PREFIX} Exception on serving an agent ↴')
+        finally:
+            connection.close()
+
+    def __listen(self, listener: Listener) -> None:
+        while not self.stop_event.is_set():
+            try:
+                connection = listener.accept()
+            except AuthenticationError:
+                logger.warning(f'{LOG_PREFIX} Connection refused: wrong authkey')
+                continue
+            except OSError:
+                # Closed on shutdown
+                continue
+
+            Thread(target=self.__serve, args=(connection,), daemon=True).start()
+
+    def __drain(self) -> None:
+        # The records of every agent are merged per batch by the writer: one report upsert per user and day, one bulk write per collection
+        while not self.stop_event.is_set():
+            try:
+                # On startup, retried with the reconnection delay until the database is reachable
+                if not self.indexes_ensured:
+                    ensure_indexes(self.writer.db)
+                    self.indexes_ensured = True
+
+                offset, records = self.spool.read(SPOOL_BATCH_SIZE)
+
+                if not records:
+                    self.stop_event.wait(AGGREGATOR_INTERVAL)
+                    continue
+
+                self.writer.write(records, self.spool.get_batch_id(offset))
+                self.spool.commit(offset)
+
+                database.set_healthy(True)
+                logger.debug(f'{LOG_PREFIX} {len(records)} records written')
+            except ConnectionFailure:
+                database.set_healthy(False)
+                reconnect_delay = database.get_reconnect_delay()
+
+                logger.warning(f'{LOG_PREFIX} The aggregated data were not saved in the database: database unreachable, retrying in {reconnect_delay:.1f}s')
+                self.stop_event.wait(reconnect_delay)
+            except Exception:
+                # The batch stays in the spool and is retried as is
+                logger.exception(f'{LOG_PREFIX} Exception on draining the aggregated data ↴')
+                self.stop_event.wait(AGGREGATOR_INTERVAL)
+
+    def run(self) -> None:
+        if not AGGREGATOR_AUTHKEY:
+            logger.error(f'{LOG_PREFIX} AGGREGATOR_AUTHKEY is not set: the aggregator does not start')
+            return None
+
+        logger.info(f'{LOG_PREFIX} Listening on {self.address}')
+
+        if not self.address.startswith('\\\\'):
+            os.makedirs(os.path.dirname(self.address), mode=0o755, exist_ok=True)
+
+            # A socket file left by a crashed aggregator; the instance lock guarantees no other one is using it
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+
+        listener = AggregatorListener(self.address, AGGREGATOR_AUTHKEY.encode())
+        listener_thread = Thread(target=self.__listen, args=(listener,), daemon=True)
+        listener_thread.start()
+
+        try:
+            self.__drain()
+        finally:
+            self.stop_event.set()
+            listener.close()
+            self.spool.close()
+            database.close()
+
+if __name__ == "__main__":
+    instance_lock = InstanceLock(AGGREGATOR_LOCK_FILE)
+
+    if not instance_lock.acquire():
+        logger.info(f'{LOG_PREFIX} Aggregator already running')
+    else:
+        stop_event = Event()
+
+        try:
+            Aggregator(stop_event).run()
+        except KeyboardInterrupt:
+            stop_event.set()
+
+        logger.info(f'{LOG_PREFIX} Aggregator stopped')
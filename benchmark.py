@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+from pymongo import MongoClient
+from pymongo.database import Database
+from statistics import mean, median, quantiles
+from tempfile import TemporaryDirectory
+from threading import Event
+from time import perf_counter, perf_counter_ns, process_time
+from typing import Any, Dict
+
+from activity import get_activity_provider
+from config import MONGODB_URL
+from logger import logger
+from objects import SensorEvent, SensorThrottle
+from replay import TracePlatform, load_trace
+from reporter import Reporter
+from watcher import Watcher
+
+try:
+    import mongomock # type: ignore
+except ImportError:
+    mongomock = None
+
+# Metrics where a higher value is a regression
+LOWER_IS_BETTER = ('cpu_per_tick_us', 'flush_mean_ms', 'flush_p95_ms', 'peak_rss_kb', 'sensor_accepted_ns', 'sensor_rejected_ns', 'sensor_repeated_ns')
+HIGHER_IS_BETTER = ('events_per_second',)
+
+def get_peak_rss_kb() -> int:
+    try:
+        import resource
+
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss // 1024 if sys.platform == 'darwin' else peak_rss
+    except ImportError:
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset // 1024 # type: ignore
+
+def get_database(mongodb_url: str, in_memory: bool) -> Database[Dict[str, Any]]:
+    if not in_memory:
+        return MongoClient(mongodb_url).get_database("watcher_benchmark")
+
+    if not mongomock:
+        raise SystemExit('--in-memory requires the mongomock package')
+
+    return mongomock.MongoClient().get_database("watcher_benchmark")
+
+def get_throttle_ns(throttle: SensorThrottle, keys: tuple[int, int], iterations: int) -> float:
+    allow = throttle.allow
+    first, second = keys
+    value = SensorEvent.MOUSE_MOVE.value
+
+    # Two calls per iteration, the loop overhead is measured apart and subtracted
+    start = perf_counter_ns()
+    for _ in range(iterations):
+        allow(value, first)
+        allow(value, second)
+    elapsed = perf_counter_ns() - start
+
+    start = perf_counter_ns()
+    for _ in range(iterations):
+        pass
+    overhead = perf_counter_ns() - start
+
+    return max(elapsed - overhead, 0) / (iterations * 2)
+
+def run_sensor_benchmark(iterations: int) -> dict[str, Any]:
+    # The listener callbacks need a desktop, the throttle in front of them does not
+    return {
+        'sensor_iterations': iterations * 2,
+        # No interval, alternating events: every call passes
+        'sensor_accepted_ns': get_throttle_ns(SensorThrottle({}), (0, 1), iterations),
+        # Alternating events within the interval: rejected on the deadline
+        'sensor_rejected_ns': get_throttle_ns(SensorThrottle({SensorEvent.MOUSE_MOVE: 3600}), (0, 1), iterations),
+        # The same event again: rejected before the clock is read
+        'sensor_repeated_ns': get_throttle_ns(SensorThrottle({}), (0, 0), iterations),
+    }
+
+def run_benchmark(trace_path: str, mongodb: Database[Dict[str, Any]], speed: float, flush_interval: float, activity: str = 'hooks', window_events: bool = False) -> dict[str, Any]:
+    trace = load_trace(trace_path)
+
+    stop_event = Event()
+    trace_platform = TracePlatform(trace, stop_event, speed, window_events)
+
+    watcher = Watcher(stop_event, trace_platform, get_activity_provider(activity, trace_platform))
+
+    # Its own app registry file: the ids of the benchmark database must not replace those of the real one
+    registry_directory = TemporaryDirectory()
+    reporter = Reporter(watcher, stop_event, mongodb, spool_enabled=False, registry_path=os.path.join(registry_directory.name, 'apps.json'))
+
+    flush_times: list[float] = []
+    flush_cpu = 0.0
+
+    def __flush() -> None:
+        nonlocal flush_cpu
+
+        cpu_start = process_time()
+        start = perf_counter()
+
+        reporter.flush()
+
+        flush_times.append(perf_counter() - start)
+        flush_cpu += process_time() - cpu_start
+
+    trace_platform.add_timer(flush_interval, __flush)
+
+    cpu_start = process_time()
+    start = perf_counter()
+
+    watcher.run()
+    __flush()
+
+    elapsed = perf_counter() - start
+    cpu = process_time() - cpu_start - flush_cpu
+
+    ticks = max(trace_platform.waits, 1)
+    flush_ms = [flush_time * 1000 for flush_time in flush_times]
+
+    return {
+        'trace': trace_path,
+        'activity': activity,
+        'window_events': window_events,
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'events': trace_platform.replayed,
+        'virtual_seconds': trace_platform.time_ns / 1_000_000_000,
+        'elapsed_seconds': elapsed,
+        'events_per_second': trace_platform.replayed / elapsed if elapsed else 0,
+        'ticks': ticks,
+        'cpu_per_tick_us': cpu / ticks * 1_000_000,
+        'flushes': len(flush_ms),
+        'flush_mean_ms': mean(flush_ms),
+        'flush_p50_ms': median(flush_ms),
+        'flush_p95_ms': quantiles(flush_ms, n=20)[-1] if len(flush_ms) > 1 else flush_ms[0],
+        'flush_max_ms': max(flush_ms),
+        'peak_rss_kb': get_peak_rss_kb(),
+        'active_time': watcher.data.active_time.total_seconds(),
+        'screen_time': watcher.data.screen_time.total_seconds(),
+    }
+
+def compare(results: dict[str, Any], baseline: dict[str, Any], tolerance: float) -> list[str]:
+    regressions: list[str] = []
+
+    for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+        if not baseline.get(key):
+            continue
+
+        ratio = results[key] / baseline[key]
+        print(f'{key:<20} {baseline[key]:>14.3f} -> {results[key]:>14.3f} ({ratio:.2f}x)')
+
+        if (key in LOWER_IS_BETTER and ratio > 1 + tolerance) or (key in HIGHER_IS_BETTER and ratio < 1 - tolerance):
+            regressions.append(key)
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a Watcher trace and measure ingest throughput, tick CPU, flush latency and peak RSS')
+    parser.add_argument('trace', help='trace file, see replay.py')
+    parser.add_argument('--mongodb-url', default=MONGODB_URL)
+    parser.add_argument('--in-memory', action='store_true', help='use mongomock instead of a mongod')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed as a multiple of real time, 0 for maximum speed')
+    parser.add_argument('--flush-interval', type=float, default=15, help='trace seconds between Reporter flushes')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='baseline results file, exits with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--activity', choices=('hooks', 'last_input'), default='hooks', help='activity provider replayed by the Watcher')
+    parser.add_argument('--window-events', action='store_true', help='push the app changes to the Watcher instead of polling them')
+    parser.add_argument('--log', action='store_true', help='keep the Watcher logs')
+    parser.add_argument('--sensor-iterations', type=int, default=1_000_000, help='throttle calls per Sensor micro-benchmark, 0 to skip it')
+
+    args = parser.parse_args()
+
+    if not args.log:
+        logger.remove()
+
+    results = run_benchmark(args.trace, get_database(args.mongodb_url, args.in_memory), args.speed, args.flush_interval, args.activity, args.window_events)
+
+    if args.sensor_iterations:
+        results.update(run_sensor_benchmark(args.sensor_iterations))
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=4)
+
+    print(json.dumps(results, indent=4))
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+
+        if regressions:
+            print(f'Regressions: {", ".join(regressions)}')
+            sys.exit(1)
@@ -0,0 +1,71 @@
+import os
+import psutil
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from logger import logger, LOG_PID
+
+LOG_PREFIX = f"{LOG_PID} {'cache.py':<20}"
+
+class ProcessDescriptionCache():
+    def __init__(self, max_size: int) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating ProcessDescriptionCache')
+
+        self.max_size = max_size
+        self.entries: OrderedDict[Hashable, str] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __get(self, key: Hashable) -> str | None:
+        description = self.entries.get(key)
+
+        if description is None:
+            return None
+
+        self.entries.move_to_end(key)
+        return description
+
+    def __put(self, key: Hashable, description: str) -> None:
+        self.entries[key] = description
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, process: psutil.Process, resolver: Callable[[psutil.Process], str]) -> str:
+        # Process identity: the pid alone is reused by the OS, the create time is not
+        try:
+            process_key = ('process', process.pid, process.create_time())
+        except psutil.Error:
+            self.misses += 1
+            return resolver(process)
+
+        description = self.__get(process_key)
+
+        if description is not None:
+            self.hits += 1
+            return description
+
+        # Executable identity: a new process of an already known executable skips the version info read
+        try:
+            file_path = process.exe()
+            file_key = ('file', file_path, os.stat(file_path).st_mtime_ns)
+            description = self.__get(file_key)
+        except (psutil.Error, OSError):
+            file_key = None
+
+        if description is None:
+            self.misses += 1
+            description = resolver(process)
+
+            logger.debug(f'{LOG_PREFIX} miss: {description} (hits: {self.hits}, misses: {self.misses}, size: {len(self.entries)})')
+
+            if file_key:
+                self.__put(file_key, description)
+        else:
+            self.hits += 1
+
+        self.__put(process_key, description)
+
+        return description
@@ -9,4 +9,96 @@ WATCHER_SECONDS = 0.2
 # SENSORS[1] Mouse Click
 # SENSORS[2] Mouse Scroll
 # SENSORS[3] Keyboard Press
-SENSORS = (True, True, True, True)
\ No newline at end of file
+SENSORS = (True, True, True, True)
+
+# Maximum number of process descriptions kept in the Watcher cache
+PROCESS_CACHE_SIZE = 256
+
+# Write the report as one $inc/$max upsert of the deltas instead of reading and rewriting the whole document
+REPORTER_DELTA_WRITES = True
+
+# Buffer the Reporter records in an on-disk spool (LOG_PATH/spool.db) replayed to MongoDB by a background drainer
+SPOOL_ENABLED = True
+SPOOL_BATCH_SIZE = 5000
+
+# Capacity of each Watcher events ring buffer (activity, app and sensor), events beyond it are dropped and counted
+EVENTS_QUEUE_CAPACITY = 65536
+
+# Fold sensor events into per-user, per-session count buckets of this many seconds (sensor_buckets collection), 0 writes one events document per sensor event
+SENSOR_BUCKET_SECONDS = 60
+
+# Expire raw events documents after this many days (TTL index on events.timestamp), 0 keeps them forever
+EVENTS_TTL_DAYS = 0
+
+# The Watcher backs off from WATCHER_INTERVAL once the user is inactive and no app changed for WATCHER_IDLE_AFTER seconds,
+# doubling its period up to WATCHER_ACCURACY_BUDGET seconds (the most screen_time a focus change can be misattributed while idle)
+WATCHER_IDLE_AFTER = 60
+WATCHER_ACCURACY_BUDGET = 5
+
+# Per-event log call sites (sensor events, app switches) log at most once per this many seconds
+LOG_SAMPLE_INTERVAL = 1.0
+# Log messages waiting for the sink thread; beyond it they are dropped (and counted) rather than blocking the caller
+LOG_QUEUE_CAPACITY = 10000
+
+# Serve the Prometheus metrics on http://127.0.0.1:METRICS_PORT/metrics, 0 disables the endpoint
+METRICS_PORT = 0
+# Write a summary of the metrics to the metrics collection every this many seconds, 0 disables it
+METRICS_INTERVAL = 300
+
+# The Watcher publishes a consistent copy of its totals for the Reporter and the tray every this many seconds
+WATCHER_SNAPSHOT_INTERVAL = 1.0
+
+# A stopped thread is restarted after SUPERVISOR_BACKOFF_MIN seconds, doubling on each failure up to SUPERVISOR_BACKOFF_MAX seconds
+SUPERVISOR_BACKOFF_MIN = 2
+SUPERVISOR_BACKOFF_MAX = 300
+
+# The Reporter flushes every REPORT_SECONDS, or earlier once REPORTER_FLUSH_EVENTS events or REPORTER_FLUSH_BYTES bytes are queued
+REPORTER_FLUSH_EVENTS = 5000
+REPORTER_FLUSH_BYTES = 65536
+# Raw sensor events are coalesced into minute buckets while more than REPORTER_BACKPRESSURE_RECORDS records are spooled,
+# or without the spool while the last write took more than REPORTER_BACKPRESSURE_SECONDS seconds
+REPORTER_BACKPRESSURE_RECORDS = 50000
+REPORTER_BACKPRESSURE_SECONDS = 5
+
+# One MongoClient per process: pool size, heartbeat period, connect/server selection timeout (socket timeout is 3 times it) and wire compression
+MONGODB_MAX_POOL_SIZE = 4
+MONGODB_HEARTBEAT_SECONDS = 30
+MONGODB_TIMEOUT_SECONDS = 10
+MONGODB_COMPRESSORS = "zlib"
+# After a connection failure the spool drainer retries after a random delay, doubling from MONGODB_RECONNECT_MIN up to MONGODB_RECONNECT_MAX seconds
+MONGODB_RECONNECT_MIN = 1
+MONGODB_RECONNECT_MAX = 60
+
+# Write the activity, app and sensor events to the events_timeseries time series collection (MongoDB 5.0+), meta {user, session, type},
+# created on demand with this granularity and EVENTS_TTL_DAYS as expiry; the exception events stay in events
+EVENTS_TIMESERIES = False
+EVENTS_TIMESERIES_GRANULARITY = "seconds"
+
+# rollup.py: hours are rolled up ROLLUP_DELAY_MINUTES after they end; each run also recomputes the hours of the events,
+# sensor buckets and sessions written since the previous run (late spooled records), allowing the agents' clocks
+# ROLLUP_DELAY_MINUTES of skew
+ROLLUP_DELAY_MINUTES = 15
+
+# Host-local aggregator (python aggregator.py) for multi-session hosts: the agents send their records to it, it writes them to MongoDB
+# in one batched stream every AGGREGATOR_INTERVAL seconds; an agent writes by itself while the aggregator does not answer
+AGGREGATOR_ENABLED = False
+# Empty: the host-wide \\.\pipe\watcher-aggregator named pipe on Windows, /run/watcher/aggregator.sock elsewhere (created by the
+# aggregator, which must be allowed to write to /run/watcher); every user of the host may connect to it, the authkey decides
+AGGREGATOR_ADDRESS = ""
+# Secret shared by the agents and the aggregator of a host, e.g. python -c "import secrets; print(secrets.token_hex(32))":
+# while it is empty the aggregator does not start and the agents write by themselves
+AGGREGATOR_AUTHKEY = ""
+AGGREGATOR_INTERVAL = 5
+AGGREGATOR_TIMEOUT = 10
+
+# How the Watcher detects activity: "hooks" runs the global mouse and keyboard listeners (sensor counters and events, SENSORS),
+# "last_input" only asks the system for the time of the last input once per tick (active_time only, no per-input CPU work)
+ACTIVITY_PROVIDER = "hooks"
+
+# Let the platform push the foreground window changes (X11 _NET_ACTIVE_WINDOW events) instead of polling it every WATCHER_INTERVAL:
+# the Watcher then only ticks on a focus change, and on WATCHER_SNAPSHOT_INTERVAL and the end of the active period while active; idle, it
+# backs off as when polling, up to WATCHER_ACCURACY_BUDGET seconds. Windows is always polled
+WATCHER_WINDOW_EVENTS = True
+
+# Run without the system tray icon (also with main.py --headless): pystray and PIL are never imported
+HEADLESS = False
\ No newline at end of file
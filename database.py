@@ -0,0 +1,110 @@
+import random
+from pymongo import MongoClient
+from pymongo.database import Database
+from pymongo.monitoring import ServerHeartbeatFailedEvent, ServerHeartbeatListener, ServerHeartbeatStartedEvent, ServerHeartbeatSucceededEvent
+from threading import Lock
+from typing import Any, Dict
+
+from config import (MONGODB_COMPRESSORS, MONGODB_HEARTBEAT_SECONDS, MONGODB_MAX_POOL_SIZE, MONGODB_RECONNECT_MAX, MONGODB_RECONNECT_MIN,
+                    MONGODB_TIMEOUT_SECONDS, MONGODB_URL)
+from logger import logger, LOG_PID
+from metrics import metrics
+from objects import DatabaseCollections
+
+LOG_PREFIX = f"{LOG_PID} {'database.py':<20}"
+
+class HealthListener(ServerHeartbeatListener):
+    def __init__(self, manager: 'DatabaseManager') -> None:
+        self.manager = manager
+
+    def started(self, event: ServerHeartbeatStartedEvent) -> None:
+        return None
+
+    def succeeded(self, event: ServerHeartbeatSucceededEvent) -> None:
+        self.manager.set_healthy(True)
+
+    def failed(self, event: ServerHeartbeatFailedEvent) -> None:
+        self.manager.set_healthy(False)
+        logger.debug(f'{LOG_PREFIX} Heartbeat failed on {event.connection_id}: {event.reply}')
+
+class DatabaseManager():
+    def __init__(self, url: str = MONGODB_URL) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating DatabaseManager')
+
+        self.url = url
+        self.lock = Lock()
+        self.client: MongoClient[Dict[str, Any]] | None = None
+
+        self.healthy = False
+        self.failures = 0
+
+    def get_client(self) -> MongoClient[Dict[str, Any]]:
+        # One client, and so one pool and one set of monitor threads, for the whole process
+        with self.lock:
+            if not self.client:
+                timeout_ms = MONGODB_TIMEOUT_SECONDS * 1000
+
+                self.client = MongoClient(
+                    self.url,
+                    maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                    minPoolSize=0,
+                    heartbeatFrequencyMS=MONGODB_HEARTBEAT_SECONDS * 1000,
+                    serverSelectionTimeoutMS=timeout_ms,
+                    connectTimeoutMS=timeout_ms,
+                    socketTimeoutMS=timeout_ms * 3,
+                    compressors=MONGODB_COMPRESSORS,
+                    retryWrites=True,
+                    # No monitor threads or connections until the first operation: an agent writing through the aggregator never opens any
+                    connect=False,
+                    event_listeners=[HealthListener(self)],
+                )
+
+                logger.info(f'{LOG_PREFIX} MongoClient created')
+
+            return self.client
+
+    def get_database(self, name: str = 'watcher') -> Database[Dict[str, Any]]:
+        return self.get_client().get_database(name)
+
+    def set_healthy(self, healthy: bool) -> None:
+        if healthy == self.healthy:
+            return None
+
+        self.healthy = healthy
+
+        if healthy:
+            self.failures = 0
+            logger.info(f'{LOG_PREFIX} Database reachable')
+        else:
+            logger.warning(f'{LOG_PREFIX} Database unreachable')
+
+    def get_reconnect_delay(self) -> float:
+        # Full jitter: agents that lost the server together do not all come back at the same instant
+        delay = min(MONGODB_RECONNECT_MIN * 2 ** self.failures, MONGODB_RECONNECT_MAX)
+        self.failures += 1
+
+        return random.uniform(MONGODB_RECONNECT_MIN, delay)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.client:
+                self.client.close()
+                self.client = None
+
+                logger.info(f'{LOG_PREFIX} MongoClient closed')
+
+def get_collections(mongodb: Database[Dict[str, Any]]) -> DatabaseCollections:
+    return DatabaseCollections(
+        mongodb.apps,
+        mongodb.events,
+        mongodb.reports,
+        mongodb.users,
+        mongodb.sensor_buckets,
+        mongodb.metrics,
+        mongodb.events_timeseries,
+        mongodb.sessions
+    )
+
+database = DatabaseManager()
+
+metrics.gauge('database_healthy', 'Whether the last heartbeat to the database succeeded', function=lambda: int(database.healthy))
@@ -0,0 +1,393 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+from bson.objectid import ObjectId
+from datetime import date, datetime, time, timedelta, timezone
+from pymongo import ASCENDING, ReadPreference
+from pymongo.collection import Collection
+from pymongo.database import Database
+from typing import Any, Dict, Iterator
+
+from config import EVENTS_TIMESERIES, MONGODB_URL
+from database import DatabaseManager
+from logger import logger, LOG_PID
+from objects import SensorEvent
+
+try:
+    import pyarrow # type: ignore
+    import pyarrow.parquet # type: ignore
+except ImportError:
+    pyarrow = None
+
+LOG_PREFIX = f"{LOG_PID} {'export.py':<20}"
+
+# Output layout: <output>/<export>/day=YYYY-MM-DD/user=<username>/part-<first _id or day>.parquet (or .csv.gz)
+# Events are exported in insertion (_id) order, so the events of a drained spool are exported whatever their timestamp;
+# reports and sensor buckets, incremented in place, once their day is closed.
+# Parquet: timestamps are DELTA_BINARY_PACKED, app and session names dictionary encoded.
+# CSV fallback: timestamp_delta_ms is the epoch milliseconds on the first row of a file and the difference to the previous
+# row after it; app_code refers to <output>/<export>/apps.csv, which only grows across incremental exports.
+CHECKPOINT_FILE = 'checkpoint.json'
+EPOCH = datetime(1970, 1, 1)
+
+EVENT_COLUMNS = ('timestamp', 'type', 'session', 'active', 'app', 'sensor', 'restarts')
+REPORT_COLUMNS = ('timestamp', 'app', 'active_time', 'screen_time', 'sensor_counter')
+SENSOR_BUCKET_COLUMNS = ('timestamp', 'session', *(sensor_event.name.lower() for sensor_event in SensorEvent), 'total')
+
+def get_epoch_ms(value: datetime) -> int:
+    return (value - EPOCH) // timedelta(milliseconds=1)
+
+def get_safe_name(name: str) -> str:
+    return ''.join(character if character.isalnum() or character in '-_.' else '_' for character in name)
+
+class PartitionWriter():
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def write(self, partition: str, columns: tuple[str, ...], rows: list[dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+    def save(self) -> None:
+        # Persists what the written files refer to, before the checkpoint that covers them
+        return None
+
+    def close(self) -> None:
+        self.save()
+
+class ParquetPartitionWriter(PartitionWriter):
+    def __get_type(self, column: str) -> Any:
+        match column:
+            case 'timestamp':
+                return pyarrow.timestamp('ms')
+            case 'app' | 'session':
+                return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+            case 'active':
+                return pyarrow.bool_()
+            case 'type' | 'sensor':
+                return pyarrow.int8()
+            case _:
+                return pyarrow.int64()
+
+    def write(self, partition: str, columns: tuple[str, ...], rows: list[dict[str, Any]]) -> None:
+        schema = pyarrow.schema([(column, self.__get_type(column)) for column in columns])
+        table = pyarrow.Table.from_pylist(rows, schema=schema)
+
+        pyarrow.parquet.write_table(
+            table,
+            f'{partition}.parquet',
+            compression='zstd',
+            use_dictionary=[column for column in columns if column in ('app', 'session')],
+            column_encoding={'timestamp': 'DELTA_BINARY_PACKED'},
+        )
+
+class CsvPartitionWriter(PartitionWriter):
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+
+        self.apps_path = os.path.join(path, 'apps.csv')
+        self.app_codes: dict[str, int] = dict()
+
+        if os.path.exists(self.apps_path):
+            with open(self.apps_path, 'r', encoding='utf-8', newline='') as file:
+                for row in csv.DictReader(file):
+                    self.app_codes[row['app']] = int(row['app_code'])
+
+    def __get_app_code(self, app_name: str | None) -> int | str:
+        if app_name is None:
+            return ''
+
+        if app_name not in self.app_codes:
+            self.app_codes[app_name] = len(self.app_codes)
+
+        return self.app_codes[app_name]
+
+    def write(self, partition: str, columns: tuple[str, ...], rows: list[dict[str, Any]]) -> None:
+        header = ['timestamp_delta_ms' if column == 'timestamp' else 'app_code' if column == 'app' else column for column in columns]
+        last_ms = 0
+
+        with gzip.open(f'{partition}.csv.gz', 'wt', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+
+            for row in rows:
+                timestamp_ms = get_epoch_ms(row['timestamp'])
+                values: list[Any] = []
+
+                for column in columns:
+                    if column == 'timestamp':
+                        values.append(timestamp_ms - last_ms)
+                    elif column == 'app':
+                        values.append(self.__get_app_code(row['app']))
+                    else:
+                        values.append('' if row[column] is None else row[column])
+
+                writer.writerow(values)
+                last_ms = timestamp_ms
+
+    def save(self) -> None:
+        temporary_path = f'{self.apps_path}.tmp'
+
+        with open(temporary_path, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['app_code', 'app'])
+
+            for app_name, app_code in self.app_codes.items():
+                writer.writerow([app_code, app_name])
+
+        os.replace(temporary_path, self.apps_path)
+
+class Exporter():
+    def __init__(self, mongodb: Database[Dict[str, Any]], output: str, file_format: str, batch_size: int) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating Exporter')
+
+        self.mongodb = mongodb
+        self.output = output
+        self.file_format = file_format
+        self.batch_size = batch_size
+
+        self.checkpoint_path = os.path.join(output, CHECKPOINT_FILE)
+        self.checkpoint: dict[str, Any] = self.__load_checkpoint()
+
+        # Small lookup collections, loaded once instead of one query per row
+        self.usernames: dict[ObjectId, str] = {user['_id']: user['username'] for user in mongodb.users.find({}, {'username': 1})}
+        self.app_names: dict[ObjectId, str] = {app['_id']: app['app'] for app in mongodb.apps.find({}, {'app': 1})}
+
+    def __load_checkpoint(self) -> dict[str, Any]:
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return dict()
+
+    def __save_checkpoint(self, writer: PartitionWriter, name: str, value: dict[str, str]) -> None:
+        # The app codes of the CSV files written so far are saved first: a crash never leaves a file with unknown codes
+        writer.save()
+
+        self.checkpoint[name] = value
+        temporary_path = f'{self.checkpoint_path}.tmp'
+
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(self.checkpoint, file, indent=4)
+
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def __get_collection(self, name: str) -> Collection[Dict[str, Any]]:
+        # Exports read from a secondary when the deployment has one, away from the agents writes
+        return self.mongodb.get_collection(name, read_preference=ReadPreference.SECONDARY_PREFERRED)
+
+    def __get_writer(self, name: str) -> PartitionWriter:
+        path = os.path.join(self.output, name)
+        os.makedirs(path, exist_ok=True)
+
+        return ParquetPartitionWriter(path) if self.file_format == 'parquet' else CsvPartitionWriter(path)
+
+    def __get_partition(self, writer: PartitionWriter, day: date, user_id: ObjectId, part: str) -> str:
+        username = get_safe_name(self.usernames.get(user_id, str(user_id)))
+        path = os.path.join(writer.path, f'day={day.isoformat()}', f'user={username}')
+        os.makedirs(path, exist_ok=True)
+
+        return os.path.join(path, f'part-{part}')
+
+    def __get_event_row(self, document: dict[str, Any]) -> dict[str, Any]:
+        meta = document.get('meta', document)
+
+        return {
+            'timestamp': document['timestamp'],
+            'type': meta['type'],
+            'session': meta.get('session'),
+            'active': document.get('active'),
+            'app': self.app_names.get(document['app']) if document.get('app') else None,
+            'sensor': document.get('sensor'),
+            'restarts': document.get('restarts'),
+        }
+
+    def __iter_events(self, collection: Collection[Dict[str, Any]], since: dict[str, str] | None, until: datetime | None, lag: timedelta) -> Iterator[dict[str, Any]]:
+        # The _id is taken by the writer just before the insert: the events of the last lag may still be in flight, with
+        # a lower _id than those already inserted
+        inserted_until = datetime.now(timezone.utc) - lag
+
+        if until:
+            inserted_until = min(inserted_until, until.astimezone(timezone.utc))
+
+        query: dict[str, Any] = {'_id': {'$lt': ObjectId.from_datetime(inserted_until)}}
+
+        if since and 'timestamp' in since:
+            # A checkpoint of the (timestamp, _id) order of the previous versions, converted by the next save
+            since_timestamp = datetime.fromisoformat(since['timestamp'])
+            query['$or'] = [{'timestamp': {'$gt': since_timestamp}}, {'timestamp': since_timestamp, '_id': {'$gt': ObjectId(since['_id'])}}]
+        elif since:
+            query['_id']['$gt'] = ObjectId(since['_id'])
+
+        yield from collection.find(query).sort([('_id', ASCENDING)]).batch_size(self.batch_size)
+
+    def export_events(self, until: datetime | None = None, lag: timedelta = timedelta(minutes=5)) -> int:
+        name = 'events_timeseries' if EVENTS_TIMESERIES else 'events'
+        writer = self.__get_writer('events')
+        collection = self.__get_collection(name)
+
+        partitions: dict[tuple[date, ObjectId], list[dict[str, Any]]] = dict()
+        first_ids: dict[tuple[date, ObjectId], ObjectId] = dict()
+        buffered = 0
+        exported = 0
+        last: dict[str, Any] | None = None
+
+        def __flush() -> None:
+            for (day, user_id), rows in partitions.items():
+                rows.sort(key=lambda row: row['timestamp'])
+                writer.write(self.__get_partition(writer, day, user_id, str(first_ids[(day, user_id)])), EVENT_COLUMNS, rows)
+
+            partitions.clear()
+            first_ids.clear()
+
+            if last:
+                self.__save_checkpoint(writer, name, {'_id': str(last['_id'])})
+
+        # At most batch_size rows are held in memory, whatever the range
+        for document in self.__iter_events(collection, self.checkpoint.get(name), until, lag):
+            user_id = document.get('meta', document)['user']
+            key = (document['timestamp'].date(), user_id)
+
+            if key not in partitions:
+                partitions[key] = []
+                first_ids[key] = document['_id']
+
+            partitions[key].append(self.__get_event_row(document))
+            buffered += 1
+            exported += 1
+            last = document
+
+            if buffered >= self.batch_size:
+                __flush()
+                buffered = 0
+
+        __flush()
+        writer.close()
+
+        logger.info(f'{LOG_PREFIX} {exported} events exported')
+        return exported
+
+    def export_reports(self) -> int:
+        writer = self.__get_writer('reports')
+        collection = self.__get_collection('reports')
+
+        # Only closed days: the report of today is still being incremented
+        query: dict[str, Any] = {'date': {'$lt': datetime.combine(date.today(), time.min)}}
+        since = self.checkpoint.get('reports')
+
+        if since:
+            query['date']['$gt'] = datetime.fromisoformat(since['date'])
+
+        exported = 0
+        last_date: datetime | None = None
+
+        for report in collection.find(query).sort([('date', ASCENDING), ('_id', ASCENDING)]).batch_size(self.batch_size):
+            rows: list[dict[str, Any]] = [{'timestamp': report['date'], 'app': None, 'active_time': report['active_time'], 'screen_time': report['screen_time'], 'sensor_counter': report['sensor_counter']}]
+
+            # Keyed by app id, with the name in the entry; reports not migrated yet are keyed by the name
+            for app_key, app in report.get('apps', {}).items():
+                rows.append({'timestamp': report['date'], 'app': app.get('app', app_key), 'active_time': app['active_time'], 'screen_time': app['screen_time'], 'sensor_counter': None})
+
+            writer.write(self.__get_partition(writer, report['date'].date(), report['user'], report['date'].date().isoformat()), REPORT_COLUMNS, rows)
+            exported += 1
+
+            # A day is checkpointed once all of its reports are written
+            if last_date and report['date'] != last_date:
+                self.__save_checkpoint(writer, 'reports', {'date': last_date.isoformat()})
+
+            last_date = report['date']
+
+        if last_date:
+            self.__save_checkpoint(writer, 'reports', {'date': last_date.isoformat()})
+
+        writer.close()
+
+        logger.info(f'{LOG_PREFIX} {exported} reports exported')
+        return exported
+
+    def export_sensor_buckets(self) -> int:
+        writer = self.__get_writer('sensor_buckets')
+        collection = self.__get_collection('sensor_buckets')
+
+        # Only closed days, like the reports: a bucket is incremented again by the records spooled late
+        query: dict[str, Any] = {'timestamp': {'$lt': datetime.combine(date.today(), time.min)}}
+        since = self.checkpoint.get('sensor_buckets')
+
+        if since and 'date' in since:
+            # A checkpoint of whole days, converted by the next save
+            query['timestamp']['$gte'] = datetime.fromisoformat(since['date']) + timedelta(days=1)
+        elif since:
+            since_timestamp = datetime.fromisoformat(since['timestamp'])
+            query['$or'] = [{'timestamp': {'$gt': since_timestamp}}, {'timestamp': since_timestamp, '_id': {'$gt': ObjectId(since['_id'])}}]
+
+        partitions: dict[tuple[date, ObjectId], list[dict[str, Any]]] = dict()
+        first_ids: dict[tuple[date, ObjectId], ObjectId] = dict()
+        buffered = 0
+        exported = 0
+        last: dict[str, Any] | None = None
+
+        def __flush() -> None:
+            for (day, user_id), rows in partitions.items():
+                writer.write(self.__get_partition(writer, day, user_id, str(first_ids[(day, user_id)])), SENSOR_BUCKET_COLUMNS, rows)
+
+            partitions.clear()
+            first_ids.clear()
+
+            if last:
+                self.__save_checkpoint(writer, 'sensor_buckets', {'timestamp': last['timestamp'].isoformat(), '_id': str(last['_id'])})
+
+        # At most batch_size rows are held in memory, whatever the number of users
+        for bucket in collection.find(query).sort([('timestamp', ASCENDING), ('_id', ASCENDING)]).batch_size(self.batch_size):
+            key = (bucket['timestamp'].date(), bucket['user'])
+
+            if key not in partitions:
+                partitions[key] = []
+                first_ids[key] = bucket['_id']
+
+            row: dict[str, Any] = {'timestamp': bucket['timestamp'], 'session': bucket['session'], 'total': bucket.get('total', 0)}
+            row.update({column: bucket['counts'].get(column, 0) for column in SENSOR_BUCKET_COLUMNS[2:-1]})
+
+            partitions[key].append(row)
+            buffered += 1
+            exported += 1
+            last = bucket
+
+            if buffered >= self.batch_size:
+                __flush()
+                buffered = 0
+
+        __flush()
+        writer.close()
+
+        logger.info(f'{LOG_PREFIX} {exported} sensor buckets exported')
+        return exported
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stream the events, the daily reports and the sensor buckets to Parquet (or gzip CSV) files partitioned by day and user')
+    parser.add_argument('output', help='output directory, also holds the checkpoint of the incremental exports')
+    parser.add_argument('--mongodb-url', default=MONGODB_URL)
+    parser.add_argument('--only', choices=('events', 'reports', 'sensor_buckets'), help='export only this data')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='export the events inserted before this time, ISO format')
+    parser.add_argument('--lag-minutes', type=float, default=5, help='leave out the events inserted in the last minutes, possibly still in flight')
+    parser.add_argument('--format', choices=('parquet', 'csv'), default='parquet' if pyarrow else 'csv', help='parquet requires the pyarrow package')
+    parser.add_argument('--batch-size', type=int, default=50000, help='rows held in memory and fetched per cursor batch')
+
+    args = parser.parse_args()
+
+    if args.format == 'parquet' and not pyarrow:
+        raise SystemExit('--format parquet requires the pyarrow package')
+
+    database = DatabaseManager(args.mongodb_url)
+
+    try:
+        exporter = Exporter(database.get_database('watcher'), args.output, args.format, args.batch_size)
+
+        if args.only in (None, 'events'):
+            exporter.export_events(args.until, timedelta(minutes=args.lag_minutes))
+        if args.only in (None, 'reports'):
+            exporter.export_reports()
+        if args.only in (None, 'sensor_buckets'):
+            exporter.export_sensor_buckets()
+    finally:
+        database.close()
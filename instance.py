@@ -0,0 +1,95 @@
+import errno
+import os
+import psutil
+import sys
+
+from logger import logger, LOG_PID, LOG_PATH
+
+LOG_PREFIX = f"{LOG_PID} {'instance.py':<20}"
+
+LOCK_FILE = os.path.join(LOG_PATH, 'watcher.lock')
+
+# Windows locks are mandatory: the lock covers a byte far past the owner record so other instances can still read it
+LOCK_OFFSET = 1 << 30
+
+class InstanceLock():
+    def __init__(self, path: str = LOCK_FILE) -> None:
+        self.path = path
+        self.fd: int | None = None
+
+    def __lock(self, fd: int) -> bool:
+        if sys.platform == "win32":
+            import msvcrt
+
+            os.lseek(fd, LOCK_OFFSET, os.SEEK_SET)
+            try:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            except OSError as error:
+                if error.errno in (errno.EACCES, errno.EDEADLOCK):
+                    return False
+                raise
+        else:
+            import fcntl
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+
+        return True
+
+    def __read_owner(self, fd: int) -> tuple[int, float] | None:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+        try:
+            pid, create_time = os.read(fd, 64).decode().split()
+            return int(pid), float(create_time)
+        except ValueError:
+            return None
+
+    def __is_owner_alive(self, owner: tuple[int, float]) -> bool:
+        pid, create_time = owner
+
+        try:
+            return abs(psutil.Process(pid).create_time() - create_time) < 1
+        except psutil.Error:
+            return False
+
+    def acquire(self) -> bool:
+        # Raises OSError when the lock file cannot be used at all (read-only or network directory)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+
+        if not self.__lock(fd):
+            owner = self.__read_owner(fd)
+            os.close(fd)
+
+            if owner and self.__is_owner_alive(owner):
+                logger.debug(f'{LOG_PREFIX} Lock held by PID {owner[0]}')
+            else:
+                logger.warning(f'{LOG_PREFIX} Lock held by an unknown process')
+                logger.debug(f'{LOG_PREFIX} owner: {owner}')
+
+            return False
+
+        # The OS drops the lock with its process: a record left behind is from an instance that is gone
+        owner = self.__read_owner(fd)
+        if owner:
+            logger.debug(f'{LOG_PREFIX} Stale lock of PID {owner[0]} taken over')
+
+        process = psutil.Process(os.getpid())
+
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, f'{process.pid} {process.create_time()}'.encode())
+
+        self.fd = fd
+        logger.debug(f'{LOG_PREFIX} Lock acquired: {self.path}')
+
+        return True
+
+    def release(self) -> None:
+        if self.fd is None:
+            return None
+
+        os.close(self.fd)
+        self.fd = None
@@ -1,16 +1,95 @@
+import atexit
 import os
 import sys
-from config import LOG_LEVEL
+from config import LOG_LEVEL, LOG_QUEUE_CAPACITY, LOG_SAMPLE_INTERVAL
 from loguru import logger
+from queue import Full, Queue
+from threading import Thread
+from time import monotonic
+from typing import Any
 
 LOG_FORMAT = "{time:DD/MM/YYYY HH:mm:ss.SSS} │ <level>{level: <8}</> │ <level>{message}</>"
 LOG_PREFIX = "logger.py"
 LOG_PID = f"PID {os.getpid():<10} ├→"
 
+class LogSampler():
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.last: dict[str, float] = dict()
+        self.dropped = 0
+        
+    def allow(self, key: str) -> bool:
+        now = monotonic()
+        
+        if now - self.last.get(key, -self.interval) < self.interval:
+            self.dropped += 1
+            return False
+        
+        self.last[key] = now
+        return True
+    
+    def pop_dropped(self) -> int:
+        dropped = self.dropped
+        self.dropped -= dropped
+        return dropped
+
+class LogQueue():
+    def __init__(self, capacity: int) -> None:
+        self.queue: Queue[dict[str, Any] | None] = Queue(capacity)
+        self.dropped = 0
+        
+        self.thread = Thread(target=self.__run, name='LogQueue', daemon=True)
+        self.thread.start()
+        
+    def put(self, message: Any) -> None:
+        # The sink of the calling thread: only the '{message}' format is applied there, never blocks on a full queue
+        try:
+            self.queue.put_nowait(message.record)
+        except Full:
+            self.dropped += 1
+            
+    def __run(self) -> None:
+        # The records are logged again from this thread, unchanged, to the sinks that accept the queued ones: those
+        # format them and do the I/O here
+        while True:
+            record = self.queue.get()
+            
+            if record is None:
+                return None
+            
+            queued = {**record, 'extra': {**record['extra'], 'queued': True}}
+            logger.patch(lambda patched, queued=queued: patched.update(queued)).log(record['level'].name, record['message'])
+            
+    def pop_dropped(self) -> int:
+        dropped = self.dropped
+        self.dropped -= dropped
+        return dropped
+    
+    def close(self, timeout: float = 1.0) -> None:
+        # On exit: what is already queued is written, within the timeout
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Full:
+            return None
+        
+        self.thread.join(timeout)
+
+def is_queued(record: dict[str, Any]) -> bool:
+    return 'queued' in record['extra']
+
+# Per-event call sites log at most once per LOG_SAMPLE_INTERVAL for each key
+log_sampler = LogSampler(LOG_SAMPLE_INTERVAL)
+
 logger.remove()
 
+# The callers (input hooks, Watcher, Reporter) only enqueue their records; the formatting and the I/O of the real sinks
+# happen on the LogQueue thread, so a stalled disk or console drops messages instead of blocking them
+log_queue = LogQueue(LOG_QUEUE_CAPACITY)
+logger.add(log_queue.put, level=LOG_LEVEL, format="{message}", filter=lambda record: not is_queued(record), catch=False)
+atexit.register(log_queue.close)
+
 if sys.stdout:
-    logger.add(sys.stdout, level=LOG_LEVEL, format=LOG_FORMAT, colorize=True)
+    logger.add(sys.stdout, level=LOG_LEVEL, format=LOG_FORMAT, colorize=True, filter=is_queued)
 
 if sys.platform == "win32":
     appdata_directory = os.getenv('APPDATA')
@@ -28,5 +107,5 @@ os.makedirs(LOG_PATH, exist_ok=True)
 
 LOG_FILE = f'{LOG_PATH}/watcher.log'
 
-logger.add(LOG_FILE, level=LOG_LEVEL, format=LOG_FORMAT, rotation="10 MB", retention="7 days")
+logger.add(LOG_FILE, level=LOG_LEVEL, format=LOG_FORMAT, rotation="10 MB", retention="7 days", filter=is_queued)
 logger.debug(f'{LOG_PREFIX} log_file: {LOG_FILE}')
\ No newline at end of file
@@ -1,18 +1,30 @@
+from startup import startup
+
+import argparse
 import os
-import psutil
-from threading import Thread, Event
-from time import sleep
+from threading import Event
+from typing import TYPE_CHECKING
+from config import HEADLESS, METRICS_PORT, SPOOL_ENABLED
+from instance import InstanceLock
 from logger import logger, LOG_PID
-from reporter import Reporter
-from stray import SystemTray
+from metrics import start_metrics_server
+from platforms import get_platform
+from supervisor import Supervisor
 from watcher import Watcher
 
+if TYPE_CHECKING:
+    from reporter import Reporter
+    from stray import SystemTray
+
 LOG_PREFIX = f"{LOG_PID} {'watcher.py':<20}"
 
-def is_watcher_already_running():
+def is_watcher_already_running_scan():
+    import psutil
+    
     current_process_id = os.getpid()    
     current_process = psutil.Process(current_process_id)
-    current_process_description = Watcher.get_process_description(current_process)
+    platform = get_platform()
+    current_process_description = platform.get_process_description(current_process)
     
     logger.debug(f'{LOG_PREFIX} current_process_id: {current_process_id}')
     logger.debug(f'{LOG_PREFIX} current_process: {current_process}')
@@ -25,7 +37,7 @@ def is_watcher_already_running():
             if process.pid == current_process_id:
                 continue
             
-            process_description = Watcher.get_process_description(process)
+            process_description = platform.get_process_description(process)
             
             if current_process_description == process_description and current_process.username() == process.username():
                 already_running_counter += 1
@@ -34,67 +46,90 @@ def is_watcher_already_running():
                 logger.debug(f'{LOG_PREFIX} process: {process}')
                 logger.debug(f'{LOG_PREFIX} process_description: {process_description}')
                 if already_running_counter > 1:
-                    logger.debug(f'{LOG_PREFIX} is_watcher_already_running(): True')
+                    logger.debug(f'{LOG_PREFIX} is_watcher_already_running_scan(): True')
                     return True
                 
         except: 
             continue
 
-    logger.debug(f'{LOG_PREFIX} is_watcher_already_running(): False')
+    logger.debug(f'{LOG_PREFIX} is_watcher_already_running_scan(): False')
     return False
 
-def run():
+def is_watcher_already_running(instance_lock: InstanceLock):
+    try:
+        already_running = not instance_lock.acquire()
+    except OSError:
+        logger.warning(f'{LOG_PREFIX} Cannot use the lock file, scanning the running processes')
+        return is_watcher_already_running_scan()
+    
+    logger.debug(f'{LOG_PREFIX} is_watcher_already_running(): {already_running}')
+    return already_running
+
+def supervise(headless: bool = HEADLESS):
     stop_event  = Event()
 
+    # Built once: a restarted Watcher or Reporter keeps its data, queues, spool and database client
     watcher     = Watcher(stop_event)
-    reporter    = Reporter(watcher, stop_event)
-    stray       = SystemTray(watcher, reporter, stop_event)
-
-    watcher_thread  = Thread(target=watcher.run)
-    reporter_thread = Thread(target=reporter.run)
-    stray_thread    = Thread(target=stray.run)
-
-    watcher_thread.start()
-    reporter_thread.start()
-    stray_thread.start()
-
-    return stop_event, (watcher, watcher_thread), (reporter, reporter_thread), (stray, stray_thread)
-
-def infinity_run():
-    restart_counter = 0
-    while True:
-        logger.info(f'{LOG_PREFIX} Starting Threads')
+    reporter: 'Reporter | None' = None
+    
+    startup.mark('watcher')
+    
+    def get_reporter() -> 'Reporter':
+        nonlocal reporter
         
-        if restart_counter != 0:
-            logger.warning(f'{LOG_PREFIX} restart_counter: {restart_counter}')
+        # Built on the first start, after the Watcher thread: pymongo is imported while the first sample is taken
+        if not reporter:
+            from reporter import Reporter
             
-        stop_event, watcher, reporter, stray = run()
-        
-        logger.info(f'{LOG_PREFIX} Threads started')
-
-        while watcher[1].is_alive() and reporter[1].is_alive() and stray[1].is_alive():
-            sleep(1)
-
-        logger.warning(f'{LOG_PREFIX} A thread stopped, restarting all threads')
-
-        stop_event.set()
-
-        watcher[1].join()
-        logger.info(f'{LOG_PREFIX} Watcher thread stopped')
-        
-        reporter[1].join()
-        logger.info(f'{LOG_PREFIX} Reporter thread stopped')
+            reporter = Reporter(watcher, stop_event)
+            
+        return reporter
+    
+    supervisor  = Supervisor(stop_event, lambda restarts: get_reporter().write_exception_event(restarts))
+    
+    supervisor.add('Watcher', lambda: watcher)
+    supervisor.add('Reporter', get_reporter, lambda reporter: reporter.wake())
+    
+    if SPOOL_ENABLED:
+        supervisor.add('Spool drainer', get_reporter, target='drain')
+    
+    # Headless: the tray stack (pystray, PIL) is never imported
+    if not headless:
+        def get_system_tray() -> 'SystemTray':
+            from stray import SystemTray
+            
+            return SystemTray(watcher, get_reporter(), stop_event)
         
-        stray[0].icon.stop()
-        stray[1].join()
-        logger.info(f'{LOG_PREFIX} System Tray thread stopped')
-
-        sleep(2)
-        restart_counter += 1
+        supervisor.add('System Tray', get_system_tray, lambda stray: stray.stop())
+    
+    supervisor.run()
+    
+    from database import database
+    
+    database.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Track the active and screen time of the foreground apps')
+    parser.add_argument('--headless', action='store_true', default=HEADLESS, help='run without the system tray icon')
+    parser.add_argument('--startup-report', help='write the startup phase timings, up to the first sample, to this JSON file')
+    
+    args = parser.parse_args()
+    
+    startup.output = args.startup_report
+    startup.mark('imports')
+    
     logger.info(f'{LOG_PREFIX} Starting program with PID {os.getpid()}')
-    if is_watcher_already_running():
+    # Kept referenced for the whole run: the lock is held as long as its file stays open
+    instance_lock = InstanceLock()
+    
+    if is_watcher_already_running(instance_lock):
+        import psutil
+        
         logger.info(f"{LOG_PREFIX} Watcher already running on user '{psutil.Process(os.getpid()).username()}'")
     else:
-        infinity_run()
\ No newline at end of file
+        startup.mark('instance_lock')
+        
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+            
+        supervise(args.headless)
\ No newline at end of file
@@ -0,0 +1,189 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Iterator
+
+from logger import logger, LOG_PID
+
+LOG_PREFIX = f"{LOG_PID} {'metrics.py':<20}"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = tuple[tuple[str, str], ...]
+
+def format_labels(labels: Labels, extra: str = '') -> str:
+    pairs = [f'{key}="{value}"' for key, value in labels]
+
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter():
+    def __init__(self, function: Callable[[], float] | None = None) -> None:
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def get(self) -> float:
+        # A function counter reads counts kept elsewhere (per thread, without locking) and merges them on scrape
+        return self.function() if self.function else self.value
+
+class Gauge():
+    def __init__(self, function: Callable[[], float] | None = None) -> None:
+        self.value: float = 0
+        self.function = function
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def get(self) -> float:
+        return self.function() if self.function else self.value
+
+class Histogram():
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        # Bucket i counts values <= buckets[i], the last one everything above
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def get_cumulative(self) -> list[tuple[str, int]]:
+        cumulative: list[tuple[str, int]] = []
+        total = 0
+
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((f'{bucket:g}', total))
+
+        cumulative.append(('+Inf', total + self.counts[-1]))
+
+        return cumulative
+
+Metric = Counter | Gauge | Histogram
+
+class MetricsRegistry():
+    def __init__(self, prefix: str = 'watcher') -> None:
+        self.prefix = prefix
+        self.lock = Lock()
+        self.families: dict[str, tuple[str, str, dict[Labels, Metric]]] = dict()
+
+    def __get(self, kind: str, name: str, help: str, labels: dict[str, str] | None, factory: Callable[[], Metric]) -> Any:
+        name = f'{self.prefix}_{name}'
+        key: Labels = tuple(sorted(labels.items())) if labels else ()
+
+        with self.lock:
+            if name not in self.families:
+                self.families[name] = (kind, help, dict())
+
+            family_kind, _, metrics = self.families[name]
+
+            if family_kind != kind:
+                raise ValueError(f'Metric {name} is a {family_kind}, not a {kind}')
+
+            if key not in metrics:
+                metrics[key] = factory()
+
+            return metrics[key]
+
+    def counter(self, name: str, help: str, labels: dict[str, str] | None = None, function: Callable[[], float] | None = None) -> Counter:
+        return self.__get('counter', name, help, labels, lambda: Counter(function))
+
+    def gauge(self, name: str, help: str, labels: dict[str, str] | None = None, function: Callable[[], float] | None = None) -> Gauge:
+        gauge: Gauge = self.__get('gauge', name, help, labels, lambda: Gauge(function))
+
+        # Re-registering a gauge function (new Watcher after a restart) points it at the new instance
+        if function:
+            gauge.function = function
+
+        return gauge
+
+    def histogram(self, name: str, help: str, labels: dict[str, str] | None = None, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.__get('histogram', name, help, labels, lambda: Histogram(buckets))
+
+    def __items(self) -> list[tuple[str, str, str, list[tuple[Labels, Metric]]]]:
+        with self.lock:
+            return [(name, kind, help, list(metrics.items())) for name, (kind, help, metrics) in self.families.items()]
+
+    def render(self) -> str:
+        lines: list[str] = []
+
+        for name, kind, help, metrics in self.__items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+            for labels, metric in metrics:
+                if isinstance(metric, Histogram):
+                    for bucket, count in metric.get_cumulative():
+                        bucket_labels = format_labels(labels, 'le="' + bucket + '"')
+                        lines.append(f'{name}_bucket{bucket_labels} {count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {metric.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {metric.count}')
+                else:
+                    lines.append(f'{name}{format_labels(labels)} {metric.get()}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> list[dict[str, Any]]:
+        summary: list[dict[str, Any]] = []
+
+        for name, kind, _, metrics in self.__items():
+            for labels, metric in metrics:
+                item: dict[str, Any] = {'name': name, 'type': kind, 'labels': dict(labels)}
+
+                if isinstance(metric, Histogram):
+                    item['count'] = metric.count
+                    item['sum'] = metric.sum
+                    item['buckets'] = [[bucket, count] for bucket, count in metric.get_cumulative()]
+                else:
+                    item['value'] = metric.get()
+
+                summary.append(item)
+
+        return summary
+
+metrics = MetricsRegistry()
+
+def start_metrics_server(port: int) -> Any:
+    # Imported here: http.server and its dependencies only load in the processes serving the metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != '/metrics':
+                self.send_error(404)
+                return None
+
+            body = metrics.render().encode()
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            return None
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsRequestHandler)
+
+    Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'{LOG_PREFIX} Serving metrics on http://127.0.0.1:{port}/metrics')
+
+    return server
@@ -0,0 +1,95 @@
+import argparse
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.database import Database
+from typing import Any, Dict
+
+from config import MONGODB_URL
+from database import DatabaseManager
+from logger import logger, LOG_PID
+from writer import get_report_app_key
+
+LOG_PREFIX = f"{LOG_PID} {'migrate.py':<20}"
+
+# Report apps used to be keyed by the app name: {apps: {<name>: {active_time, screen_time}}}, the delta writes escaping
+# '.' and a leading '$' with their fullwidth look-alikes. They are now keyed by the apps _id, with the name in the entry:
+#   {apps: {<apps _id>: {app, active_time, screen_time}}}
+# The migration rewrites the legacy entries, merging the ones of the same app. It is idempotent: run it again once every
+# agent is upgraded, for the reports the old agents kept writing meanwhile.
+def unescape_field_name(name: str) -> str:
+    name = name.replace('\uff0e', '.')
+
+    if name.startswith('\uff04'):
+        name = '$' + name[1:]
+
+    return name
+
+def is_migrated(app_key: str, app: Any) -> bool:
+    return ObjectId.is_valid(app_key) and isinstance(app, dict) and 'app' in app
+
+class ReportAppsMigration():
+    def __init__(self, mongodb: Database[Dict[str, Any]]) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating ReportAppsMigration')
+
+        self.mongodb = mongodb
+        self.app_ids: dict[str, ObjectId] = {app['app']: app['_id'] for app in mongodb.apps.find({}, {'app': 1})}
+
+    def __get_app_id(self, app_name: str) -> ObjectId:
+        app_id = self.app_ids.get(app_name)
+
+        if not app_id:
+            app = self.mongodb.apps.find_one_and_update({'app': app_name}, {'$setOnInsert': {'app': app_name}}, upsert=True, return_document=ReturnDocument.AFTER)
+            app_id = self.app_ids[app_name] = app['_id']
+
+        return app_id
+
+    def get_apps(self, apps: dict[str, Any]) -> dict[str, Any]:
+        migrated: dict[str, dict[str, Any]] = dict()
+
+        for app_key, app in apps.items():
+            if is_migrated(app_key, app):
+                app_name = app['app']
+                key = app_key
+            else:
+                app_name = unescape_field_name(app_key)
+                key = get_report_app_key(self.__get_app_id(app_name))
+
+            entry = migrated.setdefault(key, {'app': app_name, 'active_time': 0, 'screen_time': 0})
+            entry['active_time'] += app.get('active_time', 0)
+            entry['screen_time'] += app.get('screen_time', 0)
+
+        return migrated
+
+    def run(self) -> int:
+        migrated = 0
+        changed = 0
+
+        for report in self.mongodb.reports.find({}, {'apps': 1}):
+            apps: dict[str, Any] = report.get('apps') or {}
+
+            if all(is_migrated(app_key, app) for app_key, app in apps.items()):
+                continue
+
+            # Only if no agent changed the apps since they were read; a report skipped here is migrated by the next run
+            result = self.mongodb.reports.update_one({'_id': report['_id'], 'apps': apps}, {'$set': {'apps': self.get_apps(apps)}})
+
+            if result.modified_count:
+                migrated += 1
+            else:
+                changed += 1
+
+        logger.info(f'{LOG_PREFIX} {migrated} reports migrated, {changed} changed meanwhile (run again)')
+        return changed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Key the apps of the reports by the apps _id instead of the app name')
+    parser.add_argument('--mongodb-url', default=MONGODB_URL)
+
+    args = parser.parse_args()
+
+    database = DatabaseManager(args.mongodb_url)
+
+    try:
+        ReportAppsMigration(database.get_database('watcher')).run()
+    finally:
+        database.close()
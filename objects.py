@@ -1,18 +1,24 @@
-from bson.objectid import ObjectId
-from collections import deque
+from array import array
 from dataclasses import dataclass, field
 from datetime import date, datetime, timedelta
 from enum import Enum
-from pymongo.collection import Collection
-from pynput import keyboard
-from typing import Any, Dict
-    
+from threading import Event, Lock
+from time import monotonic_ns
+from typing import Any, Dict, Hashable, Iterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pymongo.collection import Collection
+
 @dataclass
 class DatabaseCollections():
-    apps            : Collection[Dict[str, Any]]
-    events          : Collection[Dict[str, Any]]
-    reports         : Collection[Dict[str, Any]]
-    users           : Collection[Dict[str, Any]]
+    apps            : 'Collection[Dict[str, Any]]'
+    events          : 'Collection[Dict[str, Any]]'
+    reports         : 'Collection[Dict[str, Any]]'
+    users           : 'Collection[Dict[str, Any]]'
+    sensor_buckets  : 'Collection[Dict[str, Any]]'
+    metrics         : 'Collection[Dict[str, Any]]'
+    events_timeseries: 'Collection[Dict[str, Any]]'
+    sessions        : 'Collection[Dict[str, Any]]'
 
 class SensorEvent(Enum):
     MOUSE_MOVE      = 0
@@ -26,11 +32,121 @@ class SensorCounters():
     mouse   : int = 0
     keyboard: int = 0
 
-@dataclass
-class EventsQueue:
-    activity    : deque[tuple[bool, datetime]]          = field(default_factory=deque)
-    app         : deque[tuple[str, datetime]]           = field(default_factory=deque)
-    sensor      : deque[tuple[SensorEvent, datetime]]   = field(default_factory=deque)
+class EventRingView():
+    def __init__(self, segments: list[tuple[memoryview, memoryview]]) -> None:
+        self.segments = segments
+        self.count = sum(len(times) for times, _ in segments)
+        
+    def __len__(self) -> int:
+        return self.count
+        
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        for times, codes in self.segments:
+            yield from zip(times, codes)
+            
+    def release(self) -> None:
+        for times, codes in self.segments:
+            times.release()
+            codes.release()
+    
+class EventRing():
+    def __init__(self, capacity: int, typecode: str = 'B') -> None:
+        self.capacity   = capacity
+        self.times      = array('q', [0]) * capacity
+        self.codes      = array(typecode, [0]) * capacity
+        self.head       = 0
+        self.tail       = 0
+        self.overflows  = 0
+        self.lock       = Lock()
+        
+    def __len__(self) -> int:
+        return self.head - self.tail
+    
+    @property
+    def itemsize(self) -> int:
+        return self.times.itemsize + self.codes.itemsize
+        
+    def append(self, code: int, time_ns: int) -> bool:
+        with self.lock:
+            if self.head - self.tail >= self.capacity:
+                self.overflows += 1
+                return False
+            
+            index = self.head % self.capacity
+            self.times[index] = time_ns
+            self.codes[index] = code
+            self.head += 1
+            
+        return True
+    
+    def drain(self) -> EventRingView:
+        # The pending region is never written until commit() moves the tail past it, so it is handed out without a copy
+        with self.lock:
+            head, tail = self.head, self.tail
+            
+        start = tail % self.capacity
+        end = start + (head - tail)
+        
+        times = memoryview(self.times)
+        codes = memoryview(self.codes)
+        
+        if end <= self.capacity:
+            segments = [(times[start:end], codes[start:end])]
+        else:
+            end -= self.capacity
+            segments = [(times[start:], codes[start:]), (times[:end], codes[:end])]
+            
+        return EventRingView(segments)
+    
+    def commit(self, view: EventRingView) -> None:
+        view.release()
+        
+        with self.lock:
+            self.tail += view.count
+    
+class EventsQueue():
+    def __init__(self, capacity: int, origin_ns: int | None = None, origin_datetime: datetime | None = None) -> None:
+        self.activity   = EventRing(capacity)
+        self.app        = EventRing(capacity, 'I')
+        self.sensor     = EventRing(capacity)
+        
+        # Set by the Watcher once enough events are pending to flush before the Reporter deadline
+        self.ready      = Event()
+        
+        self.app_names  : list[str]         = []
+        self.app_codes  : dict[str, int]    = dict()
+        
+        # Events are stamped with monotonic_ns(); wall clock time is derived from this origin, anchored again on every drain
+        self.origin_ns          = origin_ns if origin_ns is not None else monotonic_ns()
+        self.origin_datetime    = origin_datetime if origin_datetime else datetime.now()
+        
+    def get_app_code(self, app_name: str) -> int:
+        app_code = self.app_codes.get(app_name)
+        
+        if app_code is None:
+            app_code = len(self.app_names)
+            self.app_names.append(app_name)
+            self.app_codes[app_name] = app_code
+            
+        return app_code
+    
+    def anchor(self, origin_ns: int, origin_datetime: datetime) -> None:
+        # The wall clock moves away from the monotonic one (DST, NTP steps, suspend): only the events of one drain are
+        # derived from the same pair of readings
+        self.origin_ns          = origin_ns
+        self.origin_datetime    = origin_datetime
+    
+    def get_datetime(self, time_ns: int) -> datetime:
+        return self.origin_datetime + timedelta(microseconds=(time_ns - self.origin_ns) // 1000)
+    
+    def overflows(self) -> int:
+        return self.activity.overflows + self.app.overflows + self.sensor.overflows
+    
+    def __len__(self) -> int:
+        return len(self.activity) + len(self.app) + len(self.sensor)
+    
+    def nbytes(self) -> int:
+        return sum(len(ring) * ring.itemsize for ring in (self.activity, self.app, self.sensor))
     
 class EventType(Enum):
     ACTIVITY    = 0
@@ -38,31 +154,54 @@ class EventType(Enum):
     SENSOR      = 2
     EXCEPTION   = 3
     
-@dataclass
-class SensorLast():
-    event       : SensorEvent | None                        = None
-    move_time   : datetime                                  = field(default_factory=datetime.now)
-    click_time  : datetime                                  = field(default_factory=datetime.now)
-    scroll_time : datetime                                  = field(default_factory=datetime.now)
-    pressed_key : keyboard.Key | keyboard.KeyCode | None    = None
-    pressed_time: datetime                                  = field(default_factory=datetime.now)
+class SensorThrottle():
+    # Owned by one listener thread: its deadlines and counters are never written by another thread
+    def __init__(self, intervals: dict[SensorEvent, float]) -> None:
+        self.intervals_ns   = [int(intervals.get(sensor_event, 0) * 1_000_000_000) for sensor_event in SensorEvent]
+        self.deadlines_ns   = [0] * len(SensorEvent)
+        self.last           : Hashable  = None
+        self.accepted       = [0] * len(SensorEvent)
+        self.rejected       = 0
+        self.count          = 0
+        
+    def allow(self, sensor_value: int, key: Hashable) -> bool:
+        # The same event (mouse) or key (keyboard) as the last accepted one is rejected without reading the clock
+        if key == self.last:
+            self.rejected += 1
+            return False
+        
+        now_ns = monotonic_ns()
+        
+        if now_ns < self.deadlines_ns[sensor_value]:
+            self.rejected += 1
+            return False
+        
+        self.deadlines_ns[sensor_value] = now_ns + self.intervals_ns[sensor_value]
+        self.last = key
+        self.accepted[sensor_value] += 1
+        self.count += 1
+        
+        return True
+        
+class RecordKind(Enum):
+    REPORT      = 0
+    ACTIVITY    = 1
+    APP         = 2
+    SENSOR      = 3
+    EXCEPTION   = 4
+    SENSOR_BUCKET = 5
+    METRICS     = 6
         
 @dataclass
 class ReporterApp():
-    id  : ObjectId
     name: str
     active_time: int = 0
     screen_time: int = 0
-
-@dataclass    
-class ReporterUserData():
-    id  : ObjectId
-    name: str
     
 @dataclass    
 class ReporterData():
-    user            : ReporterUserData
-    apps            : dict[str, ReporterApp]
+    username        : str
+    apps            : dict[str, ReporterApp]    = field(default_factory=dict)
     active_time     : int                       = 0
     screen_time     : int                       = 0
     sensor_counters : SensorCounters            = field(default_factory=SensorCounters)
@@ -90,4 +229,36 @@ class WatcherData():
     screen_time         : timedelta               = field(default_factory=timedelta)
     sensor_counters     : SensorCounters          = field(default_factory=SensorCounters)
     last_app            : str                     = ''
-    apps                : dict[str, WatcherApp]   = field(default_factory=dict)
\ No newline at end of file
+    apps                : dict[str, WatcherApp]   = field(default_factory=dict)
+    
+@dataclass(frozen=True)
+class WatcherAppSnapshot():
+    name        : str
+    active_time : timedelta
+    screen_time : timedelta
+    
+@dataclass(frozen=True)
+class WatcherSnapshot():
+    USERNAME        : str
+    INIT_TIME       : datetime
+    last_time       : datetime
+    is_active       : bool
+    active_time     : timedelta
+    screen_time     : timedelta
+    sensor_counter  : int
+    last_app        : str
+    apps            : tuple[WatcherAppSnapshot, ...]
+    
+    @classmethod
+    def from_data(cls, data: WatcherData) -> 'WatcherSnapshot':
+        return cls(
+            data.USERNAME,
+            data.INIT_TIME,
+            data.last_time,
+            data.is_active,
+            data.active_time,
+            data.screen_time,
+            data.sensor_counters.all,
+            data.last_app,
+            tuple(WatcherAppSnapshot(app.name, app.active_time, app.screen_time) for app in data.apps.values()),
+        )
\ No newline at end of file
@@ -0,0 +1,250 @@
+import ctypes
+import os
+import psutil
+import sys
+from datetime import datetime
+from threading import Event, Thread
+from time import monotonic_ns
+from typing import Any, Callable, Hashable
+
+from cache import ProcessDescriptionCache
+from config import PROCESS_CACHE_SIZE
+from logger import logger, LOG_PID
+from objects import SensorCounters, SensorEvent
+
+LOG_PREFIX = f"{LOG_PID} {'platforms.py':<20}"
+
+SensorCallback = Callable[[SensorCounters, SensorEvent], None]
+
+# X11 reports the idle time in milliseconds, read against another clock: a difference this small is not a new input
+X11_INPUT_JITTER_NS = 5_000_000
+
+class Platform():
+    def monotonic_ns(self) -> int:
+        return monotonic_ns()
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def wait(self, event: Event, timeout: float) -> bool:
+        return event.wait(timeout)
+
+    def get_username(self) -> str:
+        raise NotImplementedError
+
+    @classmethod
+    def get_process_description(cls, process: psutil.Process) -> str:
+        return process.name()
+
+    def get_active_window(self) -> Hashable:
+        raise NotImplementedError
+
+    def get_window_description(self, window: Hashable) -> str:
+        raise NotImplementedError
+
+    def watch_active_window(self, callback: Callable[[], None]) -> bool:
+        # Push sources call back on every focus change and return True, polled ones return False
+        return False
+
+    def start_sensors(self, callback: SensorCallback, sensors: tuple[bool, bool, bool, bool]) -> None:
+        raise NotImplementedError
+
+    def get_last_input_ns(self) -> int:
+        raise NotImplementedError
+
+class LASTINPUTINFO(ctypes.Structure):
+    _fields_ = [('cbSize', ctypes.c_uint), ('dwTime', ctypes.c_ulong)]
+
+class WindowsPlatform(Platform):
+    def __init__(self) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating WindowsPlatform')
+
+        self.user32_dll = ctypes.windll.user32 # type: ignore
+        self.kernel32_dll = ctypes.windll.kernel32 # type: ignore
+        self.process_cache = ProcessDescriptionCache(PROCESS_CACHE_SIZE)
+
+        self.last_input_info = LASTINPUTINFO(ctypes.sizeof(LASTINPUTINFO), 0)
+        self.last_input_tick: int | None = None
+        self.last_input_ns = 0
+
+    @classmethod
+    def get_process_description(cls, process: psutil.Process) -> str:
+        if process.pid == 0:
+            return ""
+
+        try:
+            import win32api
+
+            file_path = process.exe()
+            lang, codepage = win32api.GetFileVersionInfo(file_path, '\\VarFileInfo\\Translation')[0] # type: ignore
+            description_key = f'\\StringFileInfo\\{lang:04x}{codepage:04x}\\FileDescription'
+
+            description = win32api.GetFileVersionInfo(file_path, description_key)
+            return str(description) if description else process.name()
+
+        except:
+            return process.name()
+
+    def get_active_window(self) -> tuple[int, int]:
+        hwnd = self.user32_dll.GetForegroundWindow()
+        pid = ctypes.c_ulong()
+
+        self.user32_dll.GetWindowThreadProcessId(hwnd, ctypes.byref(pid))
+
+        return hwnd, pid.value
+
+    def get_username(self) -> str:
+        _, pid = self.get_active_window()
+
+        return psutil.Process(pid).username()
+
+    def get_window_description(self, window: tuple[int, int]) -> str:
+        process = psutil.Process(window[1])
+
+        if process.pid == 0:
+            return self.get_process_description(process)
+
+        return self.process_cache.get(process, self.get_process_description)
+
+    def start_sensors(self, callback: SensorCallback, sensors: tuple[bool, bool, bool, bool]) -> None:
+        from sensor import Sensor
+
+        Sensor.run(callback, sensors[0], sensors[1], sensors[2], sensors[3])
+
+    def get_last_input_ns(self) -> int:
+        if not self.user32_dll.GetLastInputInfo(ctypes.byref(self.last_input_info)):
+            raise ctypes.WinError() # type: ignore
+
+        # Converted only when the tick count of the last input changes: the same input always maps to the same time
+        if self.last_input_info.dwTime != self.last_input_tick:
+            # Both are 32-bit millisecond tick counts, wrapping every 49.7 days
+            idle_ms = (self.kernel32_dll.GetTickCount() - self.last_input_info.dwTime) & 0xFFFFFFFF
+
+            self.last_input_tick = self.last_input_info.dwTime
+            self.last_input_ns = self.monotonic_ns() - idle_ms * 1_000_000
+
+        return self.last_input_ns
+
+class X11Platform(Platform):
+    def __init__(self) -> None:
+        from Xlib import display
+
+        logger.debug(f'{LOG_PREFIX} Instantiating X11Platform')
+
+        # Only used by the Watcher thread: an Xlib connection is not thread-safe, the window events thread opens its own
+        self.display = display.Display()
+        self.root = self.display.screen().root
+
+        self.NET_ACTIVE_WINDOW = self.display.intern_atom('_NET_ACTIVE_WINDOW')
+        self.NET_WM_PID = self.display.intern_atom('_NET_WM_PID')
+
+        self.process_cache = ProcessDescriptionCache(PROCESS_CACHE_SIZE)
+
+        # Published by the window events thread once it watches, replaced as a whole
+        self.active_window: tuple[int, int] | None = None
+        self.last_input_ns = 0
+
+    def __get_active_window(self, x_display: Any) -> tuple[int, int]:
+        from Xlib import X
+        from Xlib.error import XError
+
+        active_window = x_display.screen().root.get_full_property(self.NET_ACTIVE_WINDOW, X.AnyPropertyType)
+        window_id = int(active_window.value[0]) if active_window and len(active_window.value) else 0
+
+        if not window_id:
+            return 0, 0
+
+        # The window may be gone already, or belong to a client that does not set its pid
+        try:
+            pid = x_display.create_resource_object('window', window_id).get_full_property(self.NET_WM_PID, X.AnyPropertyType)
+        except XError:
+            return window_id, 0
+
+        return window_id, int(pid.value[0]) if pid and len(pid.value) else 0
+
+    def get_active_window(self) -> tuple[int, int]:
+        active_window = self.active_window
+
+        return active_window if active_window is not None else self.__get_active_window(self.display)
+
+    def get_username(self) -> str:
+        return psutil.Process().username()
+
+    def get_window_description(self, window: tuple[int, int]) -> str:
+        if not window[1]:
+            return ''
+
+        return self.process_cache.get(psutil.Process(window[1]), self.get_process_description)
+
+    def __watch(self, callback: Callable[[], None]) -> None:
+        from Xlib import X, display
+
+        try:
+            x_display = display.Display()
+            x_display.screen().root.change_attributes(event_mask=X.PropertyChangeMask)
+
+            self.active_window = self.__get_active_window(x_display)
+
+            while True:
+                # Blocks on the X connection: no CPU at all while the focus does not change
+                event = x_display.next_event()
+
+                if event.type == X.PropertyNotify and event.atom == self.NET_ACTIVE_WINDOW:
+                    self.active_window = self.__get_active_window(x_display)
+                    callback()
+        except Exception:
+            # The Watcher queries the window itself again, on its time-accounting deadlines
+            self.active_window = None
+            logger.exception(f'{LOG_PREFIX} Exception on watching _NET_ACTIVE_WINDOW ↴')
+
+    def watch_active_window(self, callback: Callable[[], None]) -> bool:
+        Thread(target=self.__watch, args=(callback,), name='X11 Window Events', daemon=True).start()
+
+        return True
+
+    def start_sensors(self, callback: SensorCallback, sensors: tuple[bool, bool, bool, bool]) -> None:
+        from sensor import Sensor
+
+        Sensor.run(callback, sensors[0], sensors[1], sensors[2], sensors[3])
+
+    def get_last_input_ns(self) -> int:
+        # MIT-SCREEN-SAVER extension, loaded by Xlib when the server has it
+        idle_ms = self.display.screensaver_query_info(self.root).idle
+        last_input_ns = self.monotonic_ns() - idle_ms * 1_000_000
+
+        if last_input_ns - self.last_input_ns > X11_INPUT_JITTER_NS:
+            self.last_input_ns = last_input_ns
+
+        return self.last_input_ns
+
+class HeadlessPlatform(Platform):
+    def __init__(self) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating HeadlessPlatform')
+        logger.warning(f'{LOG_PREFIX} No display: no foreground window and no input, only the session is tracked')
+
+    def get_username(self) -> str:
+        return psutil.Process().username()
+
+    def get_active_window(self) -> int:
+        return 0
+
+    def get_window_description(self, window: Hashable) -> str:
+        # As a window without a process on X11
+        return ''
+
+    def start_sensors(self, callback: SensorCallback, sensors: tuple[bool, bool, bool, bool]) -> None:
+        return None
+
+    def get_last_input_ns(self) -> int:
+        # Before any Watcher tick: never active
+        return 0
+
+def get_platform() -> Platform:
+    if sys.platform == 'win32':
+        return WindowsPlatform()
+
+    # Headless session: the Watcher runs without a foreground window, the process descriptions are still available
+    if not os.environ.get('DISPLAY'):
+        return HeadlessPlatform()
+
+    return X11Platform()
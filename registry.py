@@ -0,0 +1,119 @@
+import json
+import os
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from threading import Lock
+from typing import Any, Dict, Iterable
+
+from logger import logger, LOG_PID, LOG_PATH
+
+LOG_PREFIX = f"{LOG_PID} {'registry.py':<20}"
+
+APPS_FILE = os.path.join(LOG_PATH, 'apps.json')
+
+class AppRegistry():
+    def __init__(self, collection: Collection[Dict[str, Any]], path: str = APPS_FILE) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating AppRegistry')
+
+        self.collection = collection
+        self.path = path
+        self.lock = Lock()
+
+        self.apps: dict[str, ObjectId] = dict()
+        self.last_id: ObjectId | None = None
+
+        self.__load()
+
+    def __load(self) -> None:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+
+            self.apps = {app_name: ObjectId(app_id) for app_name, app_id in data['apps'].items()}
+            self.last_id = ObjectId(data['last_id']) if data.get('last_id') else None
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f'{LOG_PREFIX} Cannot read the apps file, rebuilding it from the database')
+            logger.debug(f'{LOG_PREFIX} path: {self.path}')
+            self.apps = dict()
+            self.last_id = None
+            return None
+
+        logger.debug(f'{LOG_PREFIX} {len(self.apps)} apps loaded from {self.path}')
+
+    def __save(self) -> None:
+        data = {
+            'last_id': str(self.last_id) if self.last_id else None,
+            'apps': {app_name: str(app_id) for app_name, app_id in self.apps.items()},
+        }
+
+        temporary_path = f'{self.path}.tmp'
+
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file)
+
+        os.replace(temporary_path, self.path)
+
+    def __add(self, app_name: str, app_id: ObjectId) -> None:
+        self.apps[app_name] = app_id
+
+        if not self.last_id or app_id > self.last_id:
+            self.last_id = app_id
+
+    def __refresh(self) -> int:
+        query: dict[str, Any] = {'_id': {'$gt': self.last_id}} if self.last_id else {}
+        refreshed = 0
+
+        for app in self.collection.find(query, {'app': 1}):
+            app_id: ObjectId | None = app.get('_id')
+            app_name: str | None = app.get('app')
+
+            if not app_name or not app_id:
+                logger.warning(f'{LOG_PREFIX} Cannot get app from apps_db')
+                logger.debug(f'{LOG_PREFIX} app: {app}')
+                continue
+
+            self.__add(app_name, app_id)
+            refreshed += 1
+
+        return refreshed
+
+    def resolve(self, app_names: Iterable[str]) -> dict[str, ObjectId]:
+        with self.lock:
+            unknown = {app_name for app_name in app_names if app_name not in self.apps}
+
+            if unknown:
+                self.__resolve(unknown)
+                self.__save()
+
+            return {app_name: self.apps[app_name] for app_name in app_names if app_name in self.apps}
+
+    def __resolve(self, unknown: set[str]) -> None:
+        # Apps registered by other agents since the last refresh
+        self.__refresh()
+        unknown = {app_name for app_name in unknown if app_name not in self.apps}
+
+        if not unknown:
+            return None
+
+        app_names = list(unknown)
+        requests = [UpdateOne({'app': app_name}, {'$setOnInsert': {'app': app_name}}, upsert=True) for app_name in app_names]
+
+        result = self.collection.bulk_write(requests, ordered=False)
+
+        for index, app_id in result.upserted_ids.items():
+            self.__add(app_names[index], app_id)
+
+        # Apps inserted concurrently by another agent between the refresh and the bulk write
+        remaining = [app_name for app_name in app_names if app_name not in self.apps]
+
+        if remaining:
+            for app in self.collection.find({'app': {'$in': remaining}}, {'app': 1}):
+                self.__add(app['app'], app['_id'])
+
+        logger.debug(f'{LOG_PREFIX} {len(app_names)} apps registered')
+
+    def get(self, app_name: str) -> ObjectId | None:
+        return self.resolve([app_name]).get(app_name)
@@ -0,0 +1,316 @@
+import argparse
+import json
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from time import sleep
+from typing import Callable, Hashable, TextIO
+
+from logger import logger, LOG_PID
+from objects import SensorCounters, SensorEvent
+from platforms import Platform, SensorCallback
+
+LOG_PREFIX = f"{LOG_PID} {'replay.py':<20}"
+
+# Trace format, one JSON object per line:
+#   {"version": 1, "username": "DOMAIN\\user", "start": "2024-10-16T09:00:00"}   header
+#   {"t": 0.0, "app": "Google Chrome"}                                          foreground app change
+#   {"t": 1.25, "sensor": "MOUSE_MOVE"}                                         accepted sensor event
+# t is in seconds since the start of the trace and never decreases.
+TRACE_VERSION = 1
+
+@dataclass
+class TraceEvent():
+    time_ns : int
+    app     : str | None            = None
+    sensor  : SensorEvent | None    = None
+
+@dataclass
+class TraceTimer():
+    callback    : Callable[[], None]
+    interval_ns : int
+    deadline_ns : int
+
+@dataclass
+class Trace():
+    username: str
+    start   : datetime
+    events  : list[TraceEvent]      = field(default_factory=list)
+
+def load_trace(path: str) -> Trace:
+    with open(path, 'r', encoding='utf-8') as file:
+        header = json.loads(file.readline())
+
+        if header.get('version') != TRACE_VERSION:
+            raise ValueError(f'Unsupported trace version: {header.get("version")}')
+
+        trace = Trace(header['username'], datetime.fromisoformat(header['start']))
+
+        for line in file:
+            if not line.strip():
+                continue
+
+            event = json.loads(line)
+            time_ns = int(event['t'] * 1_000_000_000)
+
+            if 'app' in event:
+                trace.events.append(TraceEvent(time_ns, app=event['app']))
+            else:
+                trace.events.append(TraceEvent(time_ns, sensor=SensorEvent[event['sensor']]))
+
+    return trace
+
+def write_trace_header(file: TextIO, username: str, start: datetime) -> None:
+    file.write(json.dumps({'version': TRACE_VERSION, 'username': username, 'start': start.isoformat()}) + '\n')
+
+def write_trace_event(file: TextIO, seconds: float, app: str | None = None, sensor: SensorEvent | None = None) -> None:
+    if app is not None:
+        file.write(json.dumps({'t': round(seconds, 6), 'app': app}) + '\n')
+    elif sensor is not None:
+        file.write(json.dumps({'t': round(seconds, 6), 'sensor': sensor.name}) + '\n')
+
+def generate_trace(path: str, minutes: float, seed: int = 0, username: str = 'WATCHER\\replay') -> None:
+    apps = ['Google Chrome', 'Microsoft Excel', 'Microsoft Outlook', 'Microsoft Teams', 'Visual Studio Code', 'Windows Explorer', 'Notepad', 'Adobe Acrobat']
+    sensors = [SensorEvent.MOUSE_MOVE, SensorEvent.MOUSE_MOVE, SensorEvent.MOUSE_CLICK, SensorEvent.MOUSE_SCROLL, SensorEvent.KEYBOARD_PRESS, SensorEvent.KEYBOARD_PRESS]
+
+    generator = random.Random(seed)
+    duration = minutes * 60
+
+    with open(path, 'w', encoding='utf-8') as file:
+        write_trace_header(file, username, datetime(2024, 1, 1, 9))
+        write_trace_event(file, 0, app=generator.choice(apps))
+
+        seconds = 0.0
+        next_app = generator.expovariate(1 / 30)
+        active_until = generator.expovariate(1 / 120)
+
+        while seconds < duration:
+            if seconds >= active_until:
+                # Idle period, then a new active period
+                seconds += generator.expovariate(1 / 60)
+                active_until = seconds + generator.expovariate(1 / 120)
+
+            seconds += generator.uniform(0.05, 0.6)
+
+            while next_app <= seconds:
+                write_trace_event(file, next_app, app=generator.choice(apps))
+                next_app += generator.expovariate(1 / 30)
+
+            write_trace_event(file, seconds, sensor=generator.choice(sensors))
+
+class TracePlatform(Platform):
+    def __init__(self, trace: Trace, stop_event: Event, speed: float = 0, window_events: bool = False) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating TracePlatform')
+
+        # speed: 0 replays as fast as possible, otherwise as a multiple of real time
+        # window_events: the app changes are pushed to the Watcher instead of seen by its ticks
+        self.trace = trace
+        self.stop_event = stop_event
+        self.speed = speed
+        self.window_events = window_events
+        self.window_callback: Callable[[], None] | None = None
+
+        self.time_ns = 0
+        self.index = 0
+        self.waits = 0
+        self.replayed = 0
+
+        first_app = next((event.app for event in trace.events if event.app is not None), '')
+        self.app: str = first_app
+
+        self.sensors = (True, True, True, True)
+        self.sensor_counters = SensorCounters()
+        self.callback: SensorCallback | None = None
+        self.last_input_ns = 0
+
+        self.timers: list[TraceTimer] = []
+
+    def add_timer(self, interval: float, callback: Callable[[], None]) -> None:
+        interval_ns = int(interval * 1_000_000_000)
+        self.timers.append(TraceTimer(callback, interval_ns, self.time_ns + interval_ns))
+
+    def monotonic_ns(self) -> int:
+        return self.time_ns
+
+    def now(self) -> datetime:
+        return self.trace.start + timedelta(microseconds=self.time_ns // 1000)
+
+    def get_username(self) -> str:
+        return self.trace.username
+
+    def get_active_window(self) -> str:
+        return self.app
+
+    def get_window_description(self, window: Hashable) -> str:
+        return str(window)
+
+    def watch_active_window(self, callback: Callable[[], None]) -> bool:
+        if self.window_events:
+            self.window_callback = callback
+
+        return self.window_events
+
+    def start_sensors(self, callback: SensorCallback, sensors: tuple[bool, bool, bool, bool]) -> None:
+        self.callback = callback
+        self.sensors = sensors
+
+    def get_last_input_ns(self) -> int:
+        return self.last_input_ns
+
+    def __advance(self, time_ns: int) -> None:
+        if self.speed and time_ns > self.time_ns:
+            sleep((time_ns - self.time_ns) / 1_000_000_000 / self.speed)
+
+        for timer in self.timers:
+            while timer.deadline_ns <= time_ns:
+                self.time_ns = timer.deadline_ns
+                timer.callback()
+                timer.deadline_ns += timer.interval_ns
+
+        self.time_ns = time_ns
+
+    def __apply(self, event: TraceEvent) -> None:
+        self.replayed += 1
+
+        if event.app is not None:
+            changed = event.app != self.app
+            self.app = event.app
+
+            if changed and self.window_callback:
+                self.window_callback()
+
+            return None
+
+        # Seen by a polling activity provider whether or not the hooks are on
+        self.last_input_ns = self.time_ns
+
+        if event.sensor is None or not self.sensors[event.sensor.value] or not self.callback:
+            return None
+
+        self.sensor_counters.all += 1
+
+        if event.sensor == SensorEvent.KEYBOARD_PRESS:
+            self.sensor_counters.keyboard += 1
+        else:
+            self.sensor_counters.mouse += 1
+
+        self.callback(self.sensor_counters, event.sensor)
+
+    def wait(self, event: Event, timeout: float) -> bool:
+        self.waits += 1
+        target_ns = self.time_ns + int(timeout * 1_000_000_000)
+
+        while self.index < len(self.trace.events) and self.trace.events[self.index].time_ns <= target_ns:
+            trace_event = self.trace.events[self.index]
+            self.index += 1
+
+            self.__advance(max(trace_event.time_ns, self.time_ns))
+            self.__apply(trace_event)
+
+            if event.is_set():
+                return True
+
+        self.__advance(target_ns)
+
+        if self.index >= len(self.trace.events):
+            self.stop_event.set()
+
+        return False
+
+class RecordingPlatform(Platform):
+    def __init__(self, platform: Platform, path: str) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating RecordingPlatform')
+
+        self.platform = platform
+        self.file = open(path, 'w', encoding='utf-8', buffering=1)
+        self.start_ns = platform.monotonic_ns()
+        self.last_app: str | None = None
+
+        write_trace_header(self.file, platform.get_username(), platform.now())
+
+    def __seconds(self) -> float:
+        return (self.platform.monotonic_ns() - self.start_ns) / 1_000_000_000
+
+    def monotonic_ns(self) -> int:
+        return self.platform.monotonic_ns()
+
+    def now(self) -> datetime:
+        return self.platform.now()
+
+    def wait(self, event: Event, timeout: float) -> bool:
+        return self.platform.wait(event, timeout)
+
+    def get_username(self) -> str:
+        return self.platform.get_username()
+
+    def get_active_window(self) -> Hashable:
+        return self.platform.get_active_window()
+
+    def get_window_description(self, window: Hashable) -> str:
+        description = self.platform.get_window_description(window)
+
+        if description != self.last_app:
+            write_trace_event(self.file, self.__seconds(), app=description)
+            self.last_app = description
+
+        return description
+
+    def watch_active_window(self, callback: Callable[[], None]) -> bool:
+        return self.platform.watch_active_window(callback)
+
+    def start_sensors(self, callback: SensorCallback, sensors: tuple[bool, bool, bool, bool]) -> None:
+        def __recording_callback(sensor_counters: SensorCounters, sensor_event: SensorEvent) -> None:
+            write_trace_event(self.file, self.__seconds(), sensor=sensor_event)
+            callback(sensor_counters, sensor_event)
+
+        self.platform.start_sensors(__recording_callback, sensors)
+
+    def get_last_input_ns(self) -> int:
+        return self.platform.get_last_input_ns()
+
+    def close(self) -> None:
+        self.file.close()
+
+def record(path: str) -> None:
+    from activity import HookActivityProvider
+    from platforms import WindowsPlatform
+    from watcher import Watcher
+
+    stop_event = Event()
+    platform = RecordingPlatform(WindowsPlatform(), path)
+    # A trace holds the sensor events, whatever the configured provider
+    watcher = Watcher(stop_event, platform, HookActivityProvider(platform))
+
+    watcher_thread = Thread(target=watcher.run)
+    watcher_thread.start()
+
+    logger.info(f'{LOG_PREFIX} Recording trace to {path}, press Ctrl+C to stop')
+
+    try:
+        while watcher_thread.is_alive():
+            watcher_thread.join(1)
+    except KeyboardInterrupt:
+        stop_event.set()
+        watcher_thread.join()
+
+    platform.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record or generate Watcher traces')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='record the foreground apps and sensor events of this desktop')
+    record_parser.add_argument('path')
+
+    generate_parser = subparsers.add_parser('generate', help='generate a deterministic synthetic trace')
+    generate_parser.add_argument('path')
+    generate_parser.add_argument('--minutes', type=float, default=60)
+    generate_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.path)
+    else:
+        generate_trace(args.path, args.minutes, args.seed)
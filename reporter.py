@@ -1,365 +1,381 @@
 from bson.objectid import ObjectId
-from datetime import datetime, date, time
-from pymongo import MongoClient
+from datetime import datetime, time
 from pymongo.database import Database
-from pymongo.errors import ServerSelectionTimeoutError
-from threading import Event
-from time import sleep
+from pymongo.errors import ConnectionFailure
+from threading import Event, Lock
+from time import perf_counter
 from typing import Any, Dict
 
-from config import MONGODB_URL, REPORTER_INTERVAL
-from logger import logger, LOG_PID
-from objects import DatabaseCollections, EventsQueue, EventType, ReporterApp, ReporterData, ReporterUserData
+from config import AGGREGATOR_ENABLED, METRICS_INTERVAL, REPORTER_BACKPRESSURE_RECORDS, REPORTER_BACKPRESSURE_SECONDS, REPORTER_INTERVAL, SENSOR_BUCKET_SECONDS, SPOOL_BATCH_SIZE, SPOOL_ENABLED
+from aggregator import AggregatorClient
+from database import database, get_collections
+from logger import logger, log_queue, log_sampler, LOG_PID
+from metrics import metrics
+from objects import EventRingView, EventsQueue, RecordKind, ReporterApp, ReporterData, SensorEvent, WatcherSnapshot
+from registry import APPS_FILE
+from schema import ensure_indexes
+from spool import Spool
 from watcher import Watcher
+from writer import RecordWriter
 
 LOG_PREFIX = f"{LOG_PID} {'reporter.py':<20}"
 
+FLUSH_SECONDS = metrics.histogram('flush_seconds', 'Duration of a Reporter flush, spooling or writing its records')
+FLUSH_RECORDS = metrics.counter('flush_records_total', 'Records produced by the Reporter flushes')
+DROPPED_LOGS = metrics.counter('dropped_logs_total', 'Log messages dropped by sampling')
+QUEUE_DROPPED_LOGS = metrics.counter('queue_dropped_logs_total', 'Log messages dropped because the log queue was full')
+BACKPRESSURE = metrics.gauge('backpressure', 'Whether the Reporter is coalescing sensor events because the database falls behind')
+
 class Reporter:
-    def __init__(self, watcher: Watcher, stop_event: Event) -> None:
+    def __init__(self, watcher: Watcher, stop_event: Event, mongodb: Database[Dict[str, Any]] | None = None, spool_enabled: bool = SPOOL_ENABLED, registry_path: str = APPS_FILE) -> None:
         logger.debug(f'{LOG_PREFIX} Instantiating Reporter')
-        
+
         self.watcher = watcher
         self.stop_event = stop_event
-        
-        self.mongodb: Database[Dict[str, Any]] = MongoClient(MONGODB_URL).get_database("watcher")
-        
-        self.events_queue = EventsQueue()
+
+        self.mongodb: Database[Dict[str, Any]] = mongodb if mongodb is not None else database.get_database("watcher")
+
         self.last_save: datetime | None = None
-        
-        self.db = DatabaseCollections(
-            self.mongodb.apps,
-            self.mongodb.events,
-            self.mongodb.reports,
-            self.mongodb.users
-        )
-        
-    def __get_or_create_user_id(self, username: str) -> ObjectId | None:
-        user = self.db.users.find_one({"username": username})
-        
-        if user:
-            return user.get('_id')
-        else:
-            new_user = {"username": username}
-            result = self.db.users.insert_one(new_user)
-            return result.inserted_id
-        
-    def __get_or_create_app_id(self, app_name: str) -> ObjectId | None:
-        app: dict[str, ObjectId] | None = self.db.apps.find_one({"app": app_name})
-        app_id: ObjectId | None
-        
-        if app:
-            app_id = app.get('_id')
+
+        self.db = get_collections(self.mongodb)
+
+        self.writer = RecordWriter(self.db, registry_path)
+        self.indexes_ensured = False
+        self.spool = Spool() if spool_enabled else None
+        self.aggregator = AggregatorClient() if AGGREGATOR_ENABLED else None
+
+        # Without a spool, the batches not yet written, oldest first, each with its batch id
+        self.pending: list[tuple[str, list[dict[str, Any]]]] = []
+        self.pending_lock = Lock()
+
+        if self.spool:
+            metrics.gauge('spool_pending', 'Records waiting in the spool', function=self.spool.pending)
         else:
-            new_app = {"app": app_name}
-            result = self.db.apps.insert_one(new_app)
-            app_id = result.inserted_id
-                        
-        if not app_id:
-            return None
-        
-        self.data.apps[app_name] = ReporterApp(app_id, app_name)
-        
-        return app_id
-        
-    def __get_apps_db(self) -> dict[str, ReporterApp] | None:
-        db_apps = self.db.apps.find()
-        if not db_apps:
-            return None
-        
-        apps: dict[str, ReporterApp] = dict()
-        for app in db_apps:
-            app_id: ObjectId | None = app.get('_id')
-            app_name: str | None = app.get('app')
-            
-            if not app_name or not app_id:
-                continue
-            
-            apps[app_name] = ReporterApp(app_id, app_name)
-            
-        return apps
- 
-    def __get_apps(self) -> dict[str, ReporterApp]:
-        apps_db = self.__get_apps_db()
-        apps: dict[str, ReporterApp] = dict()
-        
-        if not apps_db:
-            logger.warning(f'{LOG_PREFIX} Cannot get apps_db')
-            logger.debug(f'{LOG_PREFIX} apps_db: {apps_db}')
-            return self.data.apps
-            
-        for app in apps_db.values():
-            app_id = app.id
-            app_name = app.name
-            
-            if not app_name:
-                logger.warning(f'{LOG_PREFIX} Cannot get app_name from apps_db')
-                logger.debug(f'{LOG_PREFIX} app_name: {app_name}')
-                logger.debug(f'{LOG_PREFIX} app: {app}')
-                continue
-            
-            if not app_id:
-                logger.warning(f'{LOG_PREFIX} Cannot get app_id from apps_db')
-                logger.debug(f'{LOG_PREFIX} app_id: {app_id}')
-                logger.debug(f'{LOG_PREFIX} app: {app}')
-                continue
-            
-            apps[app_name] = ReporterApp(app_id, app_name)
-        
-        return apps
-           
-    def __get_report_db(self, user_id: ObjectId) -> Dict[str, Any] | None:
-        return self.db.reports.find_one({"date": datetime.combine(date.today(), time.min), "user": user_id})
-        
-    def __create_empty_report(self, user_id: ObjectId) -> ObjectId | None:    
-        new_report: dict[str, Any] = {
-            "date": datetime.combine(date.today(), time.min), 
-            "user": user_id,
-            "active_time": 0,
-            "screen_time": 0,
-            "sensor_counter": 0,
-            "apps": {},
-            "sessions": {},
-        }
-        result = self.db.reports.insert_one(new_report)
-        return result.inserted_id
+            metrics.gauge('write_pending', 'Records waiting for a direct write', function=self.pending_records)
+
+        self.last_metrics = perf_counter()
+        self.last_flush_seconds = 0.0
+        self.backpressure = False
+
+        self.data = ReporterData(self.watcher.snapshot.USERNAME)
+        self.events_overflows = 0
 
     def __log_active_time(self) -> None:
         hours = self.data.active_time // 3600
         minutes = (self.data.active_time % 3600) // 60
         seconds = self.data.active_time % 60
-            
+
         logger.info(f'{LOG_PREFIX} Active time: {hours:02d}:{minutes:02d}:{seconds:02d}')
-        
+
     def __log_screen_time(self) -> None:
         hours = self.data.screen_time // 3600
         minutes = (self.data.screen_time % 3600) // 60
         seconds = self.data.screen_time % 60
-            
+
         logger.info(f'{LOG_PREFIX} Screen time: {hours:02d}:{minutes:02d}:{seconds:02d}')
 
-    def __update_report_apps(self, report: dict[str, Any]) -> dict[str, Any]:
-        for watcher_app in self.watcher.data.apps.values():
-            app_id = self.data.apps.get(watcher_app.name)
-            
-            if not app_id:
-                app_id = self.__get_or_create_app_id(watcher_app.name)
-                
-                if not app_id:
-                    logger.warning(f'{LOG_PREFIX} Cannot get app_id')
-                    logger.debug(f'{LOG_PREFIX} app_id: {app_id}')
-                    continue
-            
-            if watcher_app.name not in report['apps']:
-                report['apps'][watcher_app.name] = {'active_time': 0, 'screen_time': 0}
-            
-            report['apps'][watcher_app.name]['active_time'] += watcher_app.active_time.seconds - self.data.apps[watcher_app.name].active_time
-            report['apps'][watcher_app.name]['screen_time'] += watcher_app.screen_time.seconds - self.data.apps[watcher_app.name].screen_time
-            
+    def __get_report_apps_deltas(self, snapshot: WatcherSnapshot) -> dict[str, dict[str, int]]:
+        apps_deltas: dict[str, dict[str, int]] = dict()
+
+        for watcher_app in snapshot.apps:
+            if watcher_app.name not in self.data.apps:
+                self.data.apps[watcher_app.name] = ReporterApp(watcher_app.name)
+
+            active_time_delta = watcher_app.active_time.seconds - self.data.apps[watcher_app.name].active_time
+            screen_time_delta = watcher_app.screen_time.seconds - self.data.apps[watcher_app.name].screen_time
+
             self.data.apps[watcher_app.name].active_time = watcher_app.active_time.seconds
             self.data.apps[watcher_app.name].screen_time = watcher_app.screen_time.seconds
-            
-        return report
-
-    def __update_report_sessions(self, report: dict[str, Any], active_time_delta: int, screen_time_delta: int, sensor_counter_delta: int) -> dict[str, Any]:
-        last_watch = self.watcher.data.last_time
-        session_key = self.watcher.data.INIT_TIME.isoformat()
-        
-        for session in report['sessions']:
-            session: datetime
-            if session == session_key:
-                report['sessions'][session_key]['last_watch'] = last_watch
-                report['sessions'][session_key]['active_time'] += active_time_delta
-                report['sessions'][session_key]['screen_time'] += screen_time_delta
-                report['sessions'][session_key]['sensor_counter'] += sensor_counter_delta
-                break
-        else:
-            report['sessions'][session_key] = {
-                "init_watch": self.watcher.data.INIT_TIME,
-                "last_watch": last_watch,
-                "active_time": active_time_delta,
-                "screen_time": screen_time_delta,
-                "sensor_counter": sensor_counter_delta
-            }
-        
-        return report
 
-    def __update_report_total_deltas(self, report: dict[str, Any], active_time_delta: int, screen_time_delta: int, sensor_counter_delta: int) -> dict[str, Any]:
-        report['active_time'] += active_time_delta
-        report['screen_time'] += screen_time_delta
-        report['sensor_counter'] += sensor_counter_delta
-        
-        return report
+            apps_deltas[watcher_app.name] = {'active_time': active_time_delta, 'screen_time': screen_time_delta}
+
+        return apps_deltas
 
-    def __get_report_total_deltas(self) -> tuple[int, int, int]:
+    def __get_report_total_deltas(self, snapshot: WatcherSnapshot) -> tuple[int, int, int]:
         # active_time
-        active_time_delta = self.watcher.data.active_time.seconds - self.data.active_time
-        self.data.active_time = self.watcher.data.active_time.seconds
-        
+        active_time_delta = snapshot.active_time.seconds - self.data.active_time
+        self.data.active_time = snapshot.active_time.seconds
+
         # screen_time
-        screen_time_delta = self.watcher.data.screen_time.seconds - self.data.screen_time
-        self.data.screen_time = self.watcher.data.screen_time.seconds
-        
+        screen_time_delta = snapshot.screen_time.seconds - self.data.screen_time
+        self.data.screen_time = snapshot.screen_time.seconds
+
         # sensor_counter
-        sensor_counter_delta = self.watcher.data.sensor_counters.all - self.data.sensor_counters.all
-        self.data.sensor_counters.all = self.watcher.data.sensor_counters.all
-        
+        sensor_counter_delta = snapshot.sensor_counter - self.data.sensor_counters.all
+        self.data.sensor_counters.all = snapshot.sensor_counter
+
         return active_time_delta, screen_time_delta, sensor_counter_delta
-    
-    def __proccess_report(self, report: dict[str, Any]) -> dict[str, Any]:
-        active_time_delta, screen_time_delta, sensor_counter_delta = self.__get_report_total_deltas()
-        
-        report = self.__update_report_apps(report)
-        report = self.__update_report_sessions(report, active_time_delta, screen_time_delta, sensor_counter_delta)
-        report = self.__update_report_total_deltas(report, active_time_delta, screen_time_delta, sensor_counter_delta)
-            
-        return report
-
-    def __write_activity_events(self) -> None:
-        while self.watcher.events_queue.activity:
-            activity = self.watcher.events_queue.activity.popleft()
-            self.events_queue.activity.append(activity)
-            logger.debug(f'{LOG_PREFIX} activity: {activity}')
-            
-        if not self.events_queue.activity:
-            return
-            
-        documents: list[dict[str, Any]] = []
-        activity_dict: dict[str, Any] = dict()
-        for activity in self.events_queue.activity:
-            activity_dict['active'] = activity[0]
-            activity_dict['timestamp'] = activity[1]
-            activity_dict['type'] = EventType.ACTIVITY.value
-            activity_dict['user'] = self.data.user.id
-            activity_dict['session'] = self.watcher.data.INIT_TIME.isoformat()
-            
-            documents.append(activity_dict)
-            
-        self.db.events.insert_many(documents)
-        logger.success(f'{LOG_PREFIX} The activity events have been saved in the database')
-        
-        self.events_queue.activity.clear()
-        
-    def __write_app_events(self) -> None:
-        while self.watcher.events_queue.app:
-            app = self.watcher.events_queue.app.popleft()
-            self.events_queue.app.append(app)
-            logger.debug(f'{LOG_PREFIX} app: {app}')
-            
-        if not self.events_queue.app:
-            return
-            
-        documents: list[dict[str, Any]] = []
-        app_dict: dict[str, Any] = dict()
-        for app in self.events_queue.app:
-            app_dict['app'] = self.__get_or_create_app_id(app[0])
-            app_dict['timestamp'] = app[1]
-            app_dict['type'] = EventType.APP.value
-            app_dict['user'] = self.data.user.id
-            app_dict['session'] = self.watcher.data.INIT_TIME.isoformat()
-            
-            documents.append(app_dict)
-            
-        self.db.events.insert_many(documents)
-        logger.success(f'{LOG_PREFIX} The app events have been saved in the database')
-        
-        self.events_queue.app.clear()
-
-    def __write_sensor_events(self) -> None:
-        while self.watcher.events_queue.sensor:
-            sensor = self.watcher.events_queue.sensor.popleft()
-            self.events_queue.sensor.append(sensor)
-            logger.debug(f'{LOG_PREFIX} sensor: {sensor}')
-            
-        if not self.events_queue.sensor:
-            return
-
-        documents: list[dict[str, Any]] = []
-        sensor_dict: dict[str, Any] = dict()
-        for sensor in self.events_queue.sensor:
-            sensor_dict['sensor'] = sensor[0].value
-            sensor_dict['timestamp'] = sensor[1]
-            sensor_dict['type'] = EventType.SENSOR.value
-            sensor_dict['user'] = self.data.user.id
-            sensor_dict['session'] = self.watcher.data.INIT_TIME.isoformat()
-
-            documents.append(sensor_dict)
-
-        self.db.events.insert_many(documents)
-        logger.success(f'{LOG_PREFIX} The sensor events have been saved in the database')
-        
-        self.events_queue.sensor.clear()
-
-    def __write_report(self, report: dict[str, Any], report_id: ObjectId) -> None:
-        update_one = self.db.reports.update_one(filter={'_id': report_id}, update={'$set': report}, upsert=True)
-
-        if update_one.modified_count == 0:
-            logger.warning(f'{LOG_PREFIX} The report data were not saved in the database: no document modified')
-            logger.debug(f'{LOG_PREFIX} update_one.matched_count: {update_one.matched_count}')
-            logger.debug(f'{LOG_PREFIX} update_one.modified_count: {update_one.modified_count}')
+
+    def __get_report_record(self, snapshot: WatcherSnapshot) -> dict[str, Any]:
+        active_time_delta, screen_time_delta, sensor_counter_delta = self.__get_report_total_deltas(snapshot)
+
+        return {
+            'kind': RecordKind.REPORT.value,
+            'user': self.data.username,
+            'date': datetime.combine(snapshot.last_time.date(), time.min),
+            'session': snapshot.INIT_TIME.isoformat(),
+            'init_watch': snapshot.INIT_TIME,
+            'last_watch': snapshot.last_time,
+            'active_time': active_time_delta,
+            'screen_time': screen_time_delta,
+            'sensor_counter': sensor_counter_delta,
+            'apps': self.__get_report_apps_deltas(snapshot),
+        }
+
+    def __get_sensor_bucket_records(self, events_queue: EventsQueue, sensor_view: EventRingView, session: str, bucket_seconds: int) -> list[dict[str, Any]]:
+        bucket_ns = bucket_seconds * 1_000_000_000
+        origin_ns = events_queue.origin_ns - int(events_queue.origin_datetime.timestamp() * 1_000_000_000)
+        buckets: dict[int, dict[str, int]] = dict()
+
+        # Fold the events into counts per SensorEvent for each bucket, aligned on the wall clock
+        for time_ns, sensor in sensor_view:
+            bucket = (time_ns - origin_ns) // bucket_ns
+
+            if bucket not in buckets:
+                buckets[bucket] = {sensor_event.name.lower(): 0 for sensor_event in SensorEvent}
+
+            buckets[bucket][SensorEvent(sensor).name.lower()] += 1
+
+        return [
+            {
+                'kind': RecordKind.SENSOR_BUCKET.value,
+                'user': self.data.username,
+                'session': session,
+                'timestamp': datetime.fromtimestamp(bucket * bucket_seconds),
+                'counts': counts,
+            }
+            for bucket, counts in buckets.items()
+        ]
+
+    def __get_event_records(self, snapshot: WatcherSnapshot) -> list[dict[str, Any]]:
+        records: list[dict[str, Any]] = []
+        session = snapshot.INIT_TIME.isoformat()
+        events_queue = self.watcher.events_queue
+        events_queue.anchor(self.watcher.platform.monotonic_ns(), self.watcher.platform.now())
+
+        activity_view = events_queue.activity.drain()
+        for time_ns, active in activity_view:
+            records.append({'kind': RecordKind.ACTIVITY.value, 'user': self.data.username, 'session': session, 'active': bool(active), 'timestamp': events_queue.get_datetime(time_ns)})
+        events_queue.activity.commit(activity_view)
+
+        app_view = events_queue.app.drain()
+        for time_ns, app_code in app_view:
+            records.append({'kind': RecordKind.APP.value, 'user': self.data.username, 'session': session, 'app': events_queue.app_names[app_code], 'timestamp': events_queue.get_datetime(time_ns)})
+        events_queue.app.commit(app_view)
+
+        sensor_view = events_queue.sensor.drain()
+        if SENSOR_BUCKET_SECONDS:
+            records.extend(self.__get_sensor_bucket_records(events_queue, sensor_view, session, SENSOR_BUCKET_SECONDS))
+        elif self.backpressure:
+            # Coalesce the raw sensor events into minute buckets until the database catches up
+            records.extend(self.__get_sensor_bucket_records(events_queue, sensor_view, session, 60))
+        else:
+            for time_ns, sensor in sensor_view:
+                records.append({'kind': RecordKind.SENSOR.value, 'user': self.data.username, 'session': session, 'sensor': sensor, 'timestamp': events_queue.get_datetime(time_ns)})
+        events_queue.sensor.commit(sensor_view)
+
+        logger.debug(f'{LOG_PREFIX} events: {len(activity_view)} activity, {len(app_view)} app, {len(sensor_view)} sensor')
+
+        overflows = events_queue.overflows()
+        if overflows != self.events_overflows:
+            logger.warning(f'{LOG_PREFIX} The events queue dropped {overflows - self.events_overflows} events: queue full')
+            self.events_overflows = overflows
+
+        return records
+
+    def __get_metrics_record(self, snapshot: WatcherSnapshot) -> dict[str, Any]:
+        return {
+            'kind': RecordKind.METRICS.value,
+            'user': self.data.username,
+            'session': snapshot.INIT_TIME.isoformat(),
+            'timestamp': datetime.now(),
+            'metrics': metrics.summary(),
+        }
+
+    def flush(self) -> None:
+        with FLUSH_SECONDS.time():
+            # One snapshot for the whole flush, the Watcher keeps ticking meanwhile
+            snapshot = self.watcher.snapshot
+
+            self.__update_backpressure()
+
+            report_record = self.__get_report_record(snapshot)
+
+            # Nothing happened since the last flush: no report round trip
+            records = [report_record] if self.__has_changes(report_record) else []
+            records.extend(self.__get_event_records(snapshot))
+
+            if METRICS_INTERVAL and perf_counter() - self.last_metrics >= METRICS_INTERVAL:
+                records.append(self.__get_metrics_record(snapshot))
+                self.last_metrics = perf_counter()
+
+            FLUSH_RECORDS.inc(len(records))
+
+            self.__log_active_time()
+            self.__log_screen_time()
+
+            dropped_logs = log_sampler.pop_dropped()
+            if dropped_logs:
+                DROPPED_LOGS.inc(dropped_logs)
+                logger.debug(f'{LOG_PREFIX} {dropped_logs} log messages dropped by sampling')
+
+            queue_dropped_logs = log_queue.pop_dropped()
+            if queue_dropped_logs:
+                QUEUE_DROPPED_LOGS.inc(queue_dropped_logs)
+                logger.warning(f'{LOG_PREFIX} {queue_dropped_logs} log messages dropped: log queue full')
+
+            if not records:
+                return None
+
+            # The id of each record, whatever path it takes: the writer inserts its event once
+            for record in records:
+                record['rid'] = ObjectId()
+
+            # Through the host aggregator when it runs, the agent keeps its own spool or writes as the fallback
+            if self.aggregator and self.aggregator.send(records):
+                self.last_save = datetime.now()
+                return None
+
+            if self.spool:
+                self.spool.append(records)
+                return None
+
+            self.__write(records)
+
+    def __ensure_indexes(self) -> None:
+        # Once the database is reachable, before the first write: a ConnectionFailure leaves it to the caller's retry
+        if self.indexes_ensured:
             return None
 
+        ensure_indexes(self.db)
+        self.indexes_ensured = True
+
+    def __write(self, records: list[dict[str, Any]]) -> None:
+        # The rings are already drained: a batch is kept until written, and written again with the same batch id after a
+        # failure, before any newer one
+        with self.pending_lock:
+            self.pending.append((str(ObjectId()), records))
+            self.__ensure_indexes()
+
+            while self.pending:
+                batch_id, batch = self.pending[0]
+
+                start = perf_counter()
+                self.writer.write(batch, batch_id)
+                self.last_flush_seconds = perf_counter() - start
+
+                self.pending.pop(0)
+
+        database.set_healthy(True)
         self.last_save = datetime.now()
-        logger.success(f'{LOG_PREFIX} The report data have been saved in the database')
 
-    def __run(self) -> None:
-        sleep(REPORTER_INTERVAL)
-        report = self.__get_report_db(self.data.user.id)
+    def pending_records(self) -> int:
+        return sum(len(batch) for _, batch in self.pending)
 
-        if not report:
-            self.__create_empty_report(self.data.user.id)
-            report = self.__get_report_db(self.data.user.id)
+    def __has_changes(self, report_record: dict[str, Any]) -> bool:
+        if report_record['active_time'] or report_record['screen_time'] or report_record['sensor_counter']:
+            return True
 
-            if not report:
-                logger.warning(f'{LOG_PREFIX} Cannot get report')
-                logger.debug(f'{LOG_PREFIX} report: {report}')
-                return None
+        return any(app['active_time'] or app['screen_time'] for app in report_record['apps'].values())
+
+    def __update_backpressure(self) -> None:
+        # The database falls behind: too many spooled records waiting, or the last direct write was too slow
+        if self.spool:
+            backpressure = self.spool.pending() >= REPORTER_BACKPRESSURE_RECORDS
+        else:
+            backpressure = self.last_flush_seconds >= REPORTER_BACKPRESSURE_SECONDS or self.pending_records() >= REPORTER_BACKPRESSURE_RECORDS
+
+        if backpressure != self.backpressure:
+            if backpressure:
+                logger.warning(f'{LOG_PREFIX} The database falls behind, coalescing sensor events')
+            else:
+                logger.info(f'{LOG_PREFIX} The database caught up')
+
+            self.backpressure = backpressure
+            BACKPRESSURE.set(int(backpressure))
+
+    def wake(self) -> None:
+        self.watcher.events_queue.ready.set()
+
+    def __run(self) -> None:
+        # Flush on the age deadline, or earlier once the Watcher signals enough pending events
+        ready = self.watcher.events_queue.ready
 
-        report_id: ObjectId | None = report.get('_id')
+        if ready.wait(REPORTER_INTERVAL) and not self.stop_event.is_set():
+            logger.debug(f'{LOG_PREFIX} Flushing early: {len(self.watcher.events_queue)} events pending')
 
-        if not report_id:
-            logger.warning(f'{LOG_PREFIX} Cannot get report_id')
-            logger.debug(f'{LOG_PREFIX} report_id: {report_id}')
+        ready.clear()
+        self.flush()
+
+    def drain(self) -> None:
+        if not self.spool:
             return None
 
-        report = self.__proccess_report(report)
+        spool = self.spool
+        logger.debug(f'{LOG_PREFIX} Draining spool')
+
+        while not self.stop_event.is_set():
+            try:
+                self.__ensure_indexes()
+
+                offset, records = spool.read(SPOOL_BATCH_SIZE)
+
+                if not records:
+                    self.stop_event.wait(REPORTER_INTERVAL)
+                    continue
+
+                self.writer.write(records, spool.get_batch_id(offset))
+                spool.commit(offset)
 
-        self.__log_active_time()
-        self.__log_screen_time()
+                database.set_healthy(True)
+                self.last_save = datetime.now()
+                logger.debug(f'{LOG_PREFIX} Spool drained up to offset {offset}')
+            except ConnectionFailure:
+                database.set_healthy(False)
+                reconnect_delay = database.get_reconnect_delay()
 
-        self.__write_report(report, report_id)
-        self.__write_activity_events()
-        self.__write_app_events()
-        self.__write_sensor_events()
+                logger.warning(f'{LOG_PREFIX} The spooled data were not saved in the database: database unreachable, retrying in {reconnect_delay:.1f}s')
+                self.stop_event.wait(reconnect_delay)
+            except Exception:
+                logger.exception(f'{LOG_PREFIX} Exception on draining spool ↴')
+                return None
 
     def write_exception_event(self, restart_counter: int) -> None:
-        document: dict[str, Any] = {
+        record: dict[str, Any] = {
+            'kind': RecordKind.EXCEPTION.value,
+            'user': self.data.username,
             'restarts': restart_counter,
             'timestamp': datetime.now(),
-            'type': EventType.EXCEPTION.value,
-            'user': self.data.user.id
+            'rid': ObjectId(),
         }
-        self.db.events.insert_one(document)
+
+        if self.aggregator and self.aggregator.send([record]):
+            return None
+
+        if self.spool:
+            self.spool.append([record])
+        else:
+            self.__write([record])
 
     def run(self) -> None:
         logger.debug(f'{LOG_PREFIX} Running Reporter')
-        
+
+        # Writing directly: the indexes are ensured on startup, not with the first flush (the drainer or the aggregator
+        # ensure them otherwise)
+        if not self.spool and not self.aggregator:
+            try:
+                self.__ensure_indexes()
+            except ConnectionFailure:
+                logger.warning(f'{LOG_PREFIX} Cannot ensure the indexes: database unreachable, retrying before the next write')
+
+        # The spool drainer runs as its own thread, see drain()
         while not self.stop_event.is_set():
             try:
-                username = self.watcher.data.USERNAME
-                user_id = self.__get_or_create_user_id(username)
-                
-                if not user_id:
-                    logger.warning(f'{LOG_PREFIX} Cannot get user_id')
-                    logger.debug(f'{LOG_PREFIX} user_id: {user_id}')
-                    raise Exception('Cannot get user_id')
-                
-                user = ReporterUserData(user_id, username)                
-                self.data = ReporterData(user, self.__get_apps())
-                
-                while True:
+                while not self.stop_event.is_set():
                     self.__run()
-            except ServerSelectionTimeoutError:
-                logger.warning(f'{LOG_PREFIX} The data were not saved in the database: database timeout')
+            except ConnectionFailure:
+                database.set_healthy(False)
+                logger.warning(f'{LOG_PREFIX} The data were not saved in the database: database unreachable')
             except Exception:
                 logger.exception(f'{LOG_PREFIX} Exception on running ↴')
-                self.stop_event.set()
\ No newline at end of file
+                return None
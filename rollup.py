@@ -0,0 +1,334 @@
+import argparse
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DESCENDING
+from pymongo.database import Database
+from typing import Any, Dict
+
+from config import EVENTS_TIMESERIES, MONGODB_URL, ROLLUP_DELAY_MINUTES
+from database import DatabaseManager
+from logger import logger, LOG_PID
+from objects import EventType
+
+LOG_PREFIX = f"{LOG_PID} {'rollup.py':<20}"
+
+# rollup_hourly and rollup_daily hold one document per user and hour (day):
+#   {_id: {user, hour}, user, hour, active_time, screen_time, sensor_counter, apps: [{app, active_time, screen_time}]}
+# Times are in seconds. The activity and app events of a session form one timeline: each event starts a segment that
+# lasts until the next one, with the foreground app and the activity carried forward, and the segments are split at the
+# hour boundaries. The session ends at its last_watch: only an inactive event or the end of the session (the agent
+# stopped) ends an interval, however long.
+# A spool drained late adds events (found by their _id), increments sensor buckets and extends sessions (found by their
+# updated time on the server clock) in hours already rolled up: each run recomputes from the earliest of them. Every
+# session remembers in rollup_watch how far it was rolled up, the start of its late extension.
+HOURLY_COLLECTION = 'rollup_hourly'
+DAILY_COLLECTION = 'rollup_daily'
+STATE_COLLECTION = 'rollup_state'
+
+# Sorts the bounds of a session around its events at the same timestamp
+START_ORDER = 0
+EVENT_ORDER = 1
+END_ORDER = 2
+
+def floor_hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def floor_day(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def get_event_field(name: str) -> str:
+    # events keeps the fields at the top level, events_timeseries under meta
+    if EVENTS_TIMESERIES and name in ('user', 'session', 'type'):
+        return f'meta.{name}'
+
+    return name
+
+def get_event_fields() -> dict[str, Any]:
+    return {
+        'user': f'${get_event_field("user")}',
+        'session': f'${get_event_field("session")}',
+        'type': f'${get_event_field("type")}',
+        'timestamp': 1,
+        'app': 1,
+        'active': 1,
+        'order': {'$literal': EVENT_ORDER},
+    }
+
+def get_last_event_lookup(events: str, event_type: EventType, start: datetime, output: str) -> dict[str, Any]:
+    return {'$lookup': {
+        'from': events,
+        'localField': 'user',
+        'foreignField': get_event_field('user'),
+        'let': {'session': '$session', 'init_watch': '$init_watch'},
+        'pipeline': [
+            {'$match': {
+                'timestamp': {'$lt': start},
+                get_event_field('type'): event_type.value,
+                '$expr': {'$and': [{'$eq': [f'${get_event_field("session")}', '$$session']}, {'$gte': ['$timestamp', '$$init_watch']}]},
+            }},
+            {'$sort': {'timestamp': -1}},
+            {'$limit': 1},
+        ],
+        'as': output,
+    }}
+
+def get_session_bounds_pipeline(events: str, start: datetime, end: datetime) -> list[dict[str, Any]]:
+    # The sessions running during the range, as two documents: one at the start of the range with the app and the
+    # activity of the session at that time, one at its end (last_watch, or the end of the range)
+    return [
+        {'$match': {'init_watch': {'$lt': end}, 'last_watch': {'$gte': start}}},
+        get_last_event_lookup(events, EventType.APP, start, 'last_app'),
+        get_last_event_lookup(events, EventType.ACTIVITY, start, 'last_activity'),
+        {'$project': {'_id': 0, 'bounds': [
+            {
+                'user': '$user',
+                'session': '$session',
+                'type': None,
+                'timestamp': {'$max': ['$init_watch', start]},
+                'app': {'$first': '$last_app.app'},
+                'active': {'$first': '$last_activity.active'},
+                'order': {'$literal': START_ORDER},
+            },
+            {
+                'user': '$user',
+                'session': '$session',
+                'type': None,
+                'timestamp': {'$min': ['$last_watch', end]},
+                'order': {'$literal': END_ORDER},
+            },
+        ]}},
+        {'$unwind': '$bounds'},
+        {'$replaceWith': '$bounds'},
+    ]
+
+def get_hourly_pipeline(events: str, start: datetime, end: datetime) -> list[dict[str, Any]]:
+    hour_end = {'$dateAdd': {'startDate': '$hour', 'unit': 'hour', 'amount': 1}}
+    seconds = {'$divide': [{'$subtract': [{'$min': ['$segment_end', hour_end]}, {'$max': ['$timestamp', '$hour']}]}, 1000]}
+
+    pipeline: list[dict[str, Any]] = [
+        {'$match': {'timestamp': {'$gte': start, '$lt': end}}},
+        {'$project': get_event_fields()},
+        {'$match': {'type': {'$in': [EventType.ACTIVITY.value, EventType.APP.value, EventType.SENSOR.value]}}},
+        {'$unionWith': {'coll': 'sessions', 'pipeline': get_session_bounds_pipeline(events, start, end)}},
+        # The app and the activity in effect at every event of the session
+        {'$setWindowFields': {
+            'partitionBy': {'user': '$user', 'session': '$session'},
+            'sortBy': {'timestamp': 1, 'order': 1},
+            'output': {
+                'next': {'$shift': {'output': '$timestamp', 'by': 1}},
+                'app': {'$locf': '$app'},
+                'active': {'$locf': '$active'},
+            },
+        }},
+        {'$match': {'order': {'$ne': END_ORDER}}},
+        # A segment of a session without a sessions document (older agents) ends at its last event
+        {'$set': {'segment_end': {'$min': [{'$ifNull': ['$next', '$timestamp']}, end]}}},
+        {'$set': {'hour': {'$range': [0, {'$add': [{'$dateDiff': {'startDate': '$timestamp', 'endDate': '$segment_end', 'unit': 'hour'}}, 1]}]}}},
+        {'$unwind': {'path': '$hour', 'includeArrayIndex': 'piece'}},
+        {'$set': {'hour': {'$dateAdd': {'startDate': {'$dateTrunc': {'date': '$timestamp', 'unit': 'hour'}}, 'unit': 'hour', 'amount': '$hour'}}}},
+        {'$project': {
+            'user': 1,
+            'hour': 1,
+            'app': {'$ifNull': ['$app', None]},
+            'active_time': {'$cond': [{'$eq': ['$active', True]}, seconds, 0]},
+            'screen_time': {'$cond': [{'$ne': [{'$ifNull': ['$app', None]}, None]}, seconds, 0]},
+            'sensor_counter': {'$cond': [{'$and': [{'$eq': ['$type', EventType.SENSOR.value]}, {'$eq': ['$piece', 0]}]}, 1, 0]},
+        }},
+    ]
+
+    pipeline += [
+        # The sensor events folded into buckets never reach the events collection: with SENSOR_BUCKET_SECONDS, and the
+        # ones coalesced under backpressure without it
+        {'$unionWith': {'coll': 'sensor_buckets', 'pipeline': [
+            {'$match': {'timestamp': {'$gte': start, '$lt': end}}},
+            {'$project': {'user': 1, 'hour': {'$dateTrunc': {'date': '$timestamp', 'unit': 'hour'}}, 'app': {'$literal': None}, 'active_time': {'$literal': 0}, 'screen_time': {'$literal': 0}, 'sensor_counter': '$total'}},
+        ]}},
+        {'$group': {
+            '_id': {'user': '$user', 'hour': '$hour', 'app': '$app'},
+            'active_time': {'$sum': '$active_time'},
+            'screen_time': {'$sum': '$screen_time'},
+            'sensor_counter': {'$sum': '$sensor_counter'},
+        }},
+        {'$group': {
+            '_id': {'user': '$_id.user', 'hour': '$_id.hour'},
+            'active_time': {'$sum': '$active_time'},
+            'screen_time': {'$sum': '$screen_time'},
+            'sensor_counter': {'$sum': '$sensor_counter'},
+            'apps': {'$push': {'app': '$_id.app', 'active_time': {'$round': ['$active_time', 0]}, 'screen_time': {'$round': ['$screen_time', 0]}}},
+        }},
+        {'$project': {
+            'user': '$_id.user',
+            'hour': '$_id.hour',
+            'active_time': {'$round': ['$active_time', 0]},
+            'screen_time': {'$round': ['$screen_time', 0]},
+            'sensor_counter': 1,
+            'apps': {'$filter': {'input': '$apps', 'cond': {'$ne': ['$$this.app', None]}}},
+        }},
+        # Whole hours are recomputed, so replacing them makes a re-run over the same range idempotent
+        {'$merge': {'into': HOURLY_COLLECTION, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+    ]
+
+    return pipeline
+
+def get_daily_pipeline(start: datetime, end: datetime) -> list[dict[str, Any]]:
+    def get_app_sum(field: str) -> dict[str, Any]:
+        return {'$sum': {'$map': {'input': {'$filter': {'input': '$apps', 'cond': {'$eq': ['$$this.app', '$$app']}}}, 'in': f'$$this.{field}'}}}
+
+    return [
+        {'$match': {'hour': {'$gte': start, '$lt': end}}},
+        {'$group': {
+            '_id': {'user': '$user', 'day': {'$dateTrunc': {'date': '$hour', 'unit': 'day'}}},
+            'active_time': {'$sum': '$active_time'},
+            'screen_time': {'$sum': '$screen_time'},
+            'sensor_counter': {'$sum': '$sensor_counter'},
+            'apps': {'$push': '$apps'},
+        }},
+        {'$set': {'apps': {'$reduce': {'input': '$apps', 'initialValue': [], 'in': {'$concatArrays': ['$$value', '$$this']}}}}},
+        {'$project': {
+            'user': '$_id.user',
+            'day': '$_id.day',
+            'active_time': 1,
+            'screen_time': 1,
+            'sensor_counter': 1,
+            'apps': {'$map': {
+                'input': {'$setUnion': ['$apps.app']},
+                'as': 'app',
+                'in': {'app': '$$app', 'active_time': get_app_sum('active_time'), 'screen_time': get_app_sum('screen_time')},
+            }},
+        }},
+        {'$merge': {'into': DAILY_COLLECTION, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+    ]
+
+class Rollup():
+    def __init__(self, mongodb: Database[Dict[str, Any]]) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating Rollup')
+
+        self.mongodb = mongodb
+        self.events = mongodb.events_timeseries if EVENTS_TIMESERIES else mongodb.events
+        self.state = mongodb[STATE_COLLECTION]
+
+        self.mongodb[HOURLY_COLLECTION].create_index([('hour', ASCENDING)])
+        self.mongodb[DAILY_COLLECTION].create_index([('user', ASCENDING), ('day', ASCENDING)])
+
+    def get_state(self) -> dict[str, Any]:
+        return self.state.find_one({'_id': self.events.name}) or {}
+
+    def __set_state(self, state: dict[str, Any]) -> None:
+        self.state.update_one({'_id': self.events.name}, {'$set': {**state, 'updated': datetime.now()}}, upsert=True)
+
+    def __get_first_event(self, query: dict[str, Any] | None = None) -> datetime | None:
+        event = self.events.find_one(query or {}, {'timestamp': 1}, sort=[('timestamp', ASCENDING)])
+
+        return event['timestamp'] if event else None
+
+    def __get_last_id(self) -> ObjectId | None:
+        event = self.events.find_one({}, {'_id': 1}, sort=[('_id', DESCENDING)])
+
+        return event['_id'] if event else None
+
+    def __get_server_time(self) -> datetime:
+        return self.mongodb.command('hello')['localTime']
+
+    def __get_ingested_query(self, last_id: ObjectId) -> dict[str, Any]:
+        # The _id is the insertion time on the clock of the agent (or aggregator) that wrote the event: the events written
+        # by a host late by up to ROLLUP_DELAY_MINUTES are not missed
+        return {'_id': {'$gt': ObjectId.from_datetime(last_id.generation_time - timedelta(minutes=ROLLUP_DELAY_MINUTES))}}
+
+    def __get_late_start(self, state: dict[str, Any]) -> datetime | None:
+        # The earliest time of the rolled up hours changed since the last run, by events, sensor buckets or sessions
+        high_water: datetime = state['high_water']
+        starts: list[datetime] = []
+
+        if state.get('last_id'):
+            late_event = self.__get_first_event(self.__get_ingested_query(state['last_id']))
+
+            if late_event:
+                starts.append(late_event)
+
+        if state.get('checked'):
+            # The writes not yet visible when the last run started are looked at again
+            updated = {'$gt': state['checked'] - timedelta(minutes=ROLLUP_DELAY_MINUTES)}
+
+            late_bucket = self.mongodb.sensor_buckets.find_one({'updated': updated, 'timestamp': {'$lt': high_water}}, {'timestamp': 1}, sort=[('timestamp', ASCENDING)])
+
+            if late_bucket:
+                starts.append(late_bucket['timestamp'])
+
+            for session in self.mongodb.sessions.find({'updated': updated, 'init_watch': {'$lt': high_water}}, {'init_watch': 1, 'last_watch': 1, 'rollup_watch': 1}):
+                rollup_watch = session.get('rollup_watch')
+
+                if rollup_watch is None:
+                    starts.append(session['init_watch'])
+                elif rollup_watch < min(session['last_watch'], high_water):
+                    starts.append(rollup_watch)
+
+        late = min(starts) if starts else None
+
+        return late if late and late < high_water else None
+
+    def __mark_sessions(self, start: datetime, end: datetime) -> None:
+        # Before the aggregation: a session extended meanwhile is found late by the next run, never skipped
+        self.mongodb.sessions.update_many(
+            {'init_watch': {'$lt': end}, 'last_watch': {'$gte': start}},
+            [{'$set': {'rollup_watch': {'$max': ['$rollup_watch', {'$min': ['$last_watch', end]}]}}}],
+        )
+
+    def __run_range(self, start: datetime, end: datetime) -> None:
+        self.__mark_sessions(start, end)
+        self.events.aggregate(get_hourly_pipeline(self.events.name, start, end), allowDiskUse=True)
+
+        # Every day touched by the range is rebuilt from all its hours
+        self.mongodb[HOURLY_COLLECTION].aggregate(get_daily_pipeline(floor_day(start), floor_day(end - timedelta(microseconds=1)) + timedelta(days=1)))
+
+        self.__set_state({'high_water': end})
+        logger.info(f'{LOG_PREFIX} Rolled up {start.isoformat()} to {end.isoformat()}')
+
+    def run(self, backfill: bool = False, since: datetime | None = None, chunk: timedelta = timedelta(days=1)) -> None:
+        # Hours stay open for ROLLUP_DELAY_MINUTES: the agents flush and drain their spools late
+        end = floor_hour(datetime.now() - timedelta(minutes=ROLLUP_DELAY_MINUTES))
+        state = self.get_state()
+
+        # Taken before the rollup: the documents written meanwhile are looked at again by the next run
+        last_id = self.__get_last_id()
+        checked = self.__get_server_time()
+
+        if backfill or not state.get('high_water'):
+            start = since or self.__get_first_event()
+        else:
+            # From the high-water mark, or from the oldest data written since the last run when a spool was drained late
+            start = state['high_water']
+            late = self.__get_late_start(state)
+
+            if late:
+                logger.info(f'{LOG_PREFIX} Late data since {late.isoformat()}')
+                start = late
+
+        if not start:
+            logger.info(f'{LOG_PREFIX} No events to roll up')
+            return None
+
+        start = floor_hour(start)
+
+        # The high-water mark advances chunk by chunk, an interrupted run resumes after the last completed chunk
+        while start < end:
+            chunk_end = min(start + chunk, end)
+            self.__run_range(start, chunk_end)
+            start = chunk_end
+
+        self.__set_state({'last_id': last_id, 'checked': checked} if last_id else {'checked': checked})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Roll the raw events up into hourly and daily per-user, per-app summaries')
+    parser.add_argument('--mongodb-url', default=MONGODB_URL)
+    parser.add_argument('--backfill', action='store_true', help='rebuild from --since (or the first event) instead of the high-water mark')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='backfill start, ISO format')
+    parser.add_argument('--chunk-hours', type=int, default=24, help='hours rolled up per aggregation before the high-water mark advances')
+
+    args = parser.parse_args()
+
+    database = DatabaseManager(args.mongodb_url)
+
+    try:
+        Rollup(database.get_database('watcher')).run(args.backfill, args.since, timedelta(hours=args.chunk_hours))
+    finally:
+        database.close()
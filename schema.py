@@ -0,0 +1,71 @@
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+from pymongo.errors import CollectionInvalid, OperationFailure
+from time import perf_counter
+from typing import Any, Dict
+
+from config import EVENTS_TIMESERIES, EVENTS_TIMESERIES_GRANULARITY, EVENTS_TTL_DAYS
+from logger import logger, LOG_PID
+from objects import DatabaseCollections
+
+LOG_PREFIX = f"{LOG_PID} {'schema.py':<20}"
+
+def get_indexes(db: DatabaseCollections) -> list[tuple[Collection[Dict[str, Any]], list[tuple[str, int]], dict[str, Any]]]:
+    indexes: list[tuple[Collection[Dict[str, Any]], list[tuple[str, int]], dict[str, Any]]] = [
+        (db.users,          [('username', ASCENDING)],                                          {'unique': True}),
+        (db.apps,           [('app', ASCENDING)],                                               {'unique': True}),
+        (db.reports,        [('user', ASCENDING), ('date', ASCENDING)],                         {'unique': True}),
+        (db.events,         [('user', ASCENDING), ('timestamp', ASCENDING)],                    {}),
+        (db.sensor_buckets, [('user', ASCENDING), ('session', ASCENDING), ('timestamp', ASCENDING)], {'unique': True}),
+        (db.metrics,        [('user', ASCENDING), ('timestamp', ASCENDING)],                    {}),
+        (db.sessions,       [('user', ASCENDING), ('init_watch', ASCENDING)],                   {'unique': True}),
+        # The id the Reporter gives each record: a batch written again does not insert its events twice
+        (db.events,         [('rid', ASCENDING)],                                               {'unique': True, 'sparse': True}),
+        (db.metrics,        [('rid', ASCENDING)],                                               {'unique': True, 'sparse': True}),
+        # The last write on the server clock: rollup.py recomputes the hours of the documents updated late
+        (db.sessions,       [('updated', ASCENDING)],                                           {}),
+        (db.sensor_buckets, [('updated', ASCENDING)],                                           {}),
+    ]
+
+    if EVENTS_TTL_DAYS:
+        indexes.append((db.events, [('timestamp', ASCENDING)], {'expireAfterSeconds': EVENTS_TTL_DAYS * 86400}))
+
+    if EVENTS_TIMESERIES:
+        indexes.append((db.events_timeseries, [('meta.user', ASCENDING), ('timestamp', ASCENDING)], {}))
+
+    return indexes
+
+def ensure_timeseries(collection: Collection[Dict[str, Any]]) -> None:
+    options: dict[str, Any] = {'timeseries': {'timeField': 'timestamp', 'metaField': 'meta', 'granularity': EVENTS_TIMESERIES_GRANULARITY}}
+
+    if EVENTS_TTL_DAYS:
+        options['expireAfterSeconds'] = EVENTS_TTL_DAYS * 86400
+
+    try:
+        collection.database.create_collection(collection.name, **options)
+        logger.info(f'{LOG_PREFIX} Time series collection {collection.name} created')
+    except CollectionInvalid:
+        # Already created, by this agent or another one
+        return None
+    except OperationFailure as error:
+        logger.warning(f'{LOG_PREFIX} Cannot create time series collection {collection.name}: {error.details.get("errmsg") if error.details else error}')
+        logger.debug(f'{LOG_PREFIX} options: {options}')
+
+def ensure_indexes(db: DatabaseCollections) -> None:
+    start = perf_counter()
+
+    # Created before its indexes, an index on a missing collection would create a regular one
+    if EVENTS_TIMESERIES:
+        ensure_timeseries(db.events_timeseries)
+
+    # create_index is a no-op on the server when the same index already exists
+    for collection, keys, options in get_indexes(db):
+        try:
+            index_name = collection.create_index(keys, **options)
+            logger.debug(f'{LOG_PREFIX} {collection.name}.{index_name}')
+        except OperationFailure as error:
+            logger.warning(f'{LOG_PREFIX} Cannot create index on {collection.name}: {error.details.get("errmsg") if error.details else error}')
+            logger.debug(f'{LOG_PREFIX} keys: {keys}')
+            logger.debug(f'{LOG_PREFIX} options: {options}')
+
+    logger.info(f'{LOG_PREFIX} Indexes ensured in {perf_counter() - start:.3f}s')
@@ -1,119 +1,92 @@
-from datetime import datetime, timedelta
 from typing import Callable
 from pynput import mouse, keyboard
 
 from config import LOG_SENSOR_EVENTS, MOVE_INTERVAL, CLICK_INTERVAL, SCROLL_INTERVAL, PRESS_INTERVAL
-from logger import logger, LOG_PID
-from objects import SensorEvent, SensorCounters, SensorLast
+from logger import logger, log_sampler, LOG_PID
+from metrics import metrics
+from objects import SensorEvent, SensorCounters, SensorThrottle
 
 LOG_PREFIX = f"{LOG_PID} {'sensor.py':<20}"
     
 class Sensor():
-    sensor_counter  = SensorCounters()
-    sensor_last     = SensorLast()
+    # One throttle per listener thread: the hot path never shares a counter, they are merged on read
+    mouse_throttle      = SensorThrottle({SensorEvent.MOUSE_MOVE: MOVE_INTERVAL, SensorEvent.MOUSE_CLICK: CLICK_INTERVAL, SensorEvent.MOUSE_SCROLL: SCROLL_INTERVAL})
+    keyboard_throttle   = SensorThrottle({SensorEvent.KEYBOARD_PRESS: PRESS_INTERVAL})
 
     @classmethod
-    def __log_counter_event(cls) -> None:
-        if cls.sensor_counter.all % LOG_SENSOR_EVENTS == 0:
-            logger.info(f'{LOG_PREFIX} The Sensor counted {cls.sensor_counter.all} events')
-
-    @classmethod
-    def __is_valid_mouse_event(cls, event: SensorEvent) -> bool:
-        if cls.sensor_last.event == event:
-            return False
-        
-        now = datetime.now()
+    def get_counters(cls) -> SensorCounters:
+        mouse_count = cls.mouse_throttle.count
+        keyboard_count = cls.keyboard_throttle.count
         
-        match event:
-            case SensorEvent.MOUSE_MOVE:
-                if (now - cls.sensor_last.move_time) < timedelta(seconds=MOVE_INTERVAL):
-                    return False
-                cls.sensor_last.move_time = now
-            case SensorEvent.MOUSE_CLICK:
-                if (now - cls.sensor_last.click_time) < timedelta(seconds=CLICK_INTERVAL):
-                    return False
-                cls.sensor_last.click_time = now
-            case SensorEvent.MOUSE_SCROLL:
-                if (now - cls.sensor_last.scroll_time) < timedelta(seconds=SCROLL_INTERVAL):
-                    return False
-                cls.sensor_last.scroll_time = now
-            case _:
-                return False
+        return SensorCounters(mouse_count + keyboard_count, mouse_count, keyboard_count)
 
-        cls.sensor_counter.mouse += 1
-        cls.sensor_counter.all += 1
-        cls.sensor_last.event = event
-        
-        return True
-        
     @classmethod
-    def __is_valid_keyboard_event(cls, key: keyboard.Key | keyboard.KeyCode | None) -> bool:
-        if cls.sensor_last.pressed_key == key:
-            return False
-        
-        now = datetime.now()
-        
-        if (now - cls.sensor_last.pressed_time) < timedelta(seconds=PRESS_INTERVAL):
-            return False
-        
-        cls.sensor_counter.keyboard += 1
-        cls.sensor_counter.all += 1
-        cls.sensor_last.pressed_key = key
-        cls.sensor_last.pressed_time = now
-        
-        return True
+    def __log_counter_event(cls, sensor_counters: SensorCounters) -> None:
+        if sensor_counters.all % LOG_SENSOR_EVENTS == 0:
+            logger.info('{} The Sensor counted {} events', LOG_PREFIX, sensor_counters.all)
     
     @classmethod
-    def __log_mouse_event(cls, event: SensorEvent) -> None:
-        logger.debug(f'{LOG_PREFIX} {event.name} event')
+    def __log_mouse_event(cls, event: SensorEvent, sensor_counters: SensorCounters) -> None:
+        if log_sampler.allow(event.name):
+            logger.debug('{} {} event', LOG_PREFIX, event.name)
         
-        cls.__log_counter_event()
+        cls.__log_counter_event(sensor_counters)
         
-        if cls.sensor_counter.mouse % LOG_SENSOR_EVENTS == 0:
-            logger.info(f'{LOG_PREFIX} The Sensor counted {cls.sensor_counter.mouse} mouse events')
+        if sensor_counters.mouse % LOG_SENSOR_EVENTS == 0:
+            logger.info('{} The Sensor counted {} mouse events', LOG_PREFIX, sensor_counters.mouse)
                 
     @classmethod
-    def __log_keyboard_event(cls) -> None:        
-        logger.debug(f'{LOG_PREFIX} KEYBOARD_PRESS event')
+    def __log_keyboard_event(cls, sensor_counters: SensorCounters) -> None:        
+        if log_sampler.allow(SensorEvent.KEYBOARD_PRESS.name):
+            logger.debug('{} KEYBOARD_PRESS event', LOG_PREFIX)
     
-        cls.__log_counter_event()
+        cls.__log_counter_event(sensor_counters)
     
-        if cls.sensor_counter.keyboard % LOG_SENSOR_EVENTS == 0:
-            logger.info(f'{LOG_PREFIX} The Sensor counted {cls.sensor_counter.keyboard} keyboard events')        
+        if sensor_counters.keyboard % LOG_SENSOR_EVENTS == 0:
+            logger.info('{} The Sensor counted {} keyboard events', LOG_PREFIX, sensor_counters.keyboard)        
                     
     @classmethod
     def run(cls, callback: Callable[[SensorCounters, SensorEvent],  None], move_sensor: bool = True, click_sensor: bool = True, scroll_sensor: bool = True, press_sensor: bool = True) -> None:
         logger.debug(f'{LOG_PREFIX} Running Sensor')
         
+        # Bound once: a rejected event costs a comparison and, past the same-event check, one clock read
+        mouse_throttle = cls.mouse_throttle
+        keyboard_throttle = cls.keyboard_throttle
+        MOUSE_MOVE, MOUSE_CLICK, MOUSE_SCROLL, KEYBOARD_PRESS = (sensor_event.value for sensor_event in SensorEvent)
+        
         # Mouse events
         def __on_move(x: int, y: int) -> bool | None:
-            if not cls.__is_valid_mouse_event(SensorEvent.MOUSE_MOVE):
+            if not mouse_throttle.allow(MOUSE_MOVE, MOUSE_MOVE):
                 return None
             
-            cls.__log_mouse_event(SensorEvent.MOUSE_MOVE)
-            callback(cls.sensor_counter, SensorEvent.MOUSE_MOVE)
+            sensor_counters = cls.get_counters()
+            cls.__log_mouse_event(SensorEvent.MOUSE_MOVE, sensor_counters)
+            callback(sensor_counters, SensorEvent.MOUSE_MOVE)
 
         def __on_click(x: int, y: int, button: mouse.Button, pressed: bool) -> bool | None:
-            if not cls.__is_valid_mouse_event(SensorEvent.MOUSE_CLICK):
+            if not mouse_throttle.allow(MOUSE_CLICK, MOUSE_CLICK):
                 return None
             
-            cls.__log_mouse_event(SensorEvent.MOUSE_CLICK)
-            callback(cls.sensor_counter, SensorEvent.MOUSE_CLICK)
+            sensor_counters = cls.get_counters()
+            cls.__log_mouse_event(SensorEvent.MOUSE_CLICK, sensor_counters)
+            callback(sensor_counters, SensorEvent.MOUSE_CLICK)
 
         def __on_scroll(x: int, y: int, dx: int, dy: int) -> bool | None:
-            if not cls.__is_valid_mouse_event(SensorEvent.MOUSE_SCROLL):
+            if not mouse_throttle.allow(MOUSE_SCROLL, MOUSE_SCROLL):
                 return None
             
-            cls.__log_mouse_event(SensorEvent.MOUSE_SCROLL)
-            callback(cls.sensor_counter, SensorEvent.MOUSE_SCROLL)
+            sensor_counters = cls.get_counters()
+            cls.__log_mouse_event(SensorEvent.MOUSE_SCROLL, sensor_counters)
+            callback(sensor_counters, SensorEvent.MOUSE_SCROLL)
 
         # Keyboard event
         def __on_press(key: keyboard.Key | keyboard.KeyCode | None) -> None:
-            if not cls.__is_valid_keyboard_event(key):
+            if not keyboard_throttle.allow(KEYBOARD_PRESS, key):
                 return None
             
-            cls.__log_keyboard_event()
-            callback(cls.sensor_counter, SensorEvent.KEYBOARD_PRESS)
+            sensor_counters = cls.get_counters()
+            cls.__log_keyboard_event(sensor_counters)
+            callback(sensor_counters, SensorEvent.KEYBOARD_PRESS)
             
         on_move = __on_move if move_sensor else None
         on_click = __on_click if click_sensor else None
@@ -124,4 +97,10 @@ class Sensor():
         keyboard_listener = keyboard.Listener(on_press=on_press)
         
         mouse_listener.start()
-        keyboard_listener.start()
\ No newline at end of file
+        keyboard_listener.start()
+
+for sensor_event in SensorEvent:
+    throttle = Sensor.keyboard_throttle if sensor_event == SensorEvent.KEYBOARD_PRESS else Sensor.mouse_throttle
+    metrics.counter('sensor_events_total', 'Input events accepted by the Sensor', {'sensor': sensor_event.name.lower()}, function=lambda throttle=throttle, value=sensor_event.value: throttle.accepted[value])
+
+metrics.counter('sensor_rejected_total', 'Input events rejected by the Sensor throttle', function=lambda: Sensor.mouse_throttle.rejected + Sensor.keyboard_throttle.rejected)
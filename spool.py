@@ -0,0 +1,97 @@
+import bson
+from bson.objectid import ObjectId
+import os
+import sqlite3
+from threading import Lock
+from typing import Any
+
+from logger import logger, LOG_PID, LOG_PATH
+
+LOG_PREFIX = f"{LOG_PID} {'spool.py':<20}"
+
+SPOOL_FILE = os.path.join(LOG_PATH, 'spool.db')
+
+class Spool():
+    def __init__(self, path: str = SPOOL_FILE) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating Spool')
+        logger.debug(f'{LOG_PREFIX} path: {path}')
+
+        self.lock = Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY AUTOINCREMENT, payload BLOB NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS offsets (name TEXT PRIMARY KEY, offset INTEGER NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS properties (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+        # Names the batches of this spool file: its offsets restart from 1 with a new file, never within one
+        self.connection.execute("INSERT OR IGNORE INTO properties (name, value) VALUES ('id', ?)", (str(ObjectId()),))
+        self.id: str = self.connection.execute("SELECT value FROM properties WHERE name = 'id'").fetchone()[0]
+
+        pending = self.pending()
+        if pending:
+            logger.info(f'{LOG_PREFIX} {pending} records pending from a previous run')
+
+    def __get_offset(self, name: str) -> int:
+        row = self.connection.execute('SELECT offset FROM offsets WHERE name = ?', (name,)).fetchone()
+
+        return row[0] if row else 0
+
+    def get_offset(self) -> int:
+        with self.lock:
+            return self.__get_offset('drained')
+
+    def get_batch_id(self, offset: int) -> str:
+        return f'{self.id}:{offset}'
+
+    def pending(self) -> int:
+        with self.lock:
+            row = self.connection.execute("SELECT COUNT(*) FROM records WHERE id > COALESCE((SELECT offset FROM offsets WHERE name = 'drained'), 0)").fetchone()
+
+        return row[0]
+
+    def append(self, records: list[dict[str, Any]]) -> None:
+        if not records:
+            return None
+
+        payloads = [(bson.encode(record),) for record in records]
+
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT INTO records (payload) VALUES (?)', payloads)
+            self.connection.execute('COMMIT')
+
+        logger.debug(f'{LOG_PREFIX} {len(records)} records spooled')
+
+    def read(self, limit: int) -> tuple[int, list[dict[str, Any]]]:
+        # A batch read but not committed is read again with the same bounds, whatever was appended since: the writer
+        # recognizes its batch id and does not apply it twice
+        with self.lock:
+            offset = self.__get_offset('drained')
+            inflight = self.__get_offset('inflight')
+
+            if inflight > offset:
+                rows = self.connection.execute('SELECT id, payload FROM records WHERE id > ? AND id <= ? ORDER BY id', (offset, inflight)).fetchall()
+            else:
+                rows = self.connection.execute('SELECT id, payload FROM records WHERE id > ? ORDER BY id LIMIT ?', (offset, limit)).fetchall()
+
+                if rows:
+                    self.connection.execute("INSERT INTO offsets (name, offset) VALUES ('inflight', ?) ON CONFLICT(name) DO UPDATE SET offset = excluded.offset", (rows[-1][0],))
+
+        if not rows:
+            return offset, []
+
+        return rows[-1][0], [bson.decode(row[1]) for row in rows]
+
+    def commit(self, offset: int) -> None:
+        # The offset and the removal of the drained records are one transaction: a restart resumes right after it
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.execute("INSERT INTO offsets (name, offset) VALUES ('drained', ?) ON CONFLICT(name) DO UPDATE SET offset = excluded.offset", (offset,))
+            self.connection.execute('DELETE FROM records WHERE id <= ?', (offset,))
+            self.connection.execute('COMMIT')
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
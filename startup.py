@@ -0,0 +1,77 @@
+from time import perf_counter, time
+
+# Imported first by main.py and taken before any other import: everything before is the interpreter start,
+# and the PyInstaller onefile unpacking
+STARTUP_PERF = perf_counter()
+STARTUP_TIME = time()
+
+import json
+import sys
+from typing import Any
+
+from logger import logger, LOG_PID
+from metrics import metrics
+
+LOG_PREFIX = f"{LOG_PID} {'startup.py':<20}"
+
+# Modules a startup should not need before the first sample, reported when they are already loaded
+HEAVY_MODULES = ('pymongo', 'pynput', 'pystray', 'PIL', 'win32api', 'Xlib', 'http.server')
+
+class StartupProfile():
+    def __init__(self) -> None:
+        self.last = STARTUP_PERF
+        self.phases: dict[str, float] = dict()
+        self.output: str | None = None
+        self.reported = False
+
+    def mark(self, phase: str) -> None:
+        # Each phase lasts from the previous mark; a phase reached again (a restarted component) keeps its first time
+        if self.reported or phase in self.phases:
+            return None
+
+        now = perf_counter()
+
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def get_report(self) -> dict[str, Any]:
+        try:
+            import psutil
+
+            process_seconds = STARTUP_TIME - psutil.Process().create_time()
+        except Exception:
+            process_seconds = None
+
+        return {
+            'process_seconds': process_seconds,
+            'phases': self.phases,
+            'total_seconds': self.last - STARTUP_PERF,
+            'modules': len(sys.modules),
+            'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules],
+        }
+
+    def report(self) -> None:
+        # Once, when the first sample is taken
+        if self.reported:
+            return None
+
+        self.reported = True
+        report = self.get_report()
+
+        for phase, seconds in self.phases.items():
+            metrics.gauge('startup_seconds', 'Duration of the startup phases, up to the first sample', {'phase': phase}).set(seconds)
+
+        phases = ', '.join(f'{phase} {seconds * 1000:.1f}ms' for phase, seconds in self.phases.items())
+        logger.info(f'{LOG_PREFIX} First sample {report["total_seconds"] * 1000:.1f}ms after the first import ({phases}), heavy modules loaded: {report["heavy_modules"]}')
+
+        if report['process_seconds'] is not None:
+            logger.info(f'{LOG_PREFIX} {report["process_seconds"] * 1000:.1f}ms from the process creation to the first import')
+
+        if self.output:
+            try:
+                with open(self.output, 'w', encoding='utf-8') as file:
+                    json.dump(report, file, indent=4)
+            except OSError:
+                logger.exception(f'{LOG_PREFIX} Exception on writing the startup report ↴')
+
+startup = StartupProfile()
@@ -1,25 +1,34 @@
 import os
 import sys
 from datetime import datetime
-from pystray import Icon, Menu, MenuItem # type: ignore
-from PIL import Image
 from threading import Event
+from typing import TYPE_CHECKING
 
 from logger import logger, LOG_FILE, LOG_PID
-from reporter import Reporter
-from watcher import Watcher
+
+if TYPE_CHECKING:
+    from pystray import Icon, MenuItem # type: ignore
+    from reporter import Reporter
+    from watcher import Watcher
 
 LOG_PREFIX = f"{LOG_PID} {'stray.py':<20}"
 
 
 class SystemTray():
-    def __init__(self, watcher: Watcher, reporter: Reporter, stop_event: Event) -> None:
+    def __init__(self, watcher: 'Watcher', reporter: 'Reporter', stop_event: Event) -> None:
         logger.debug(f'{LOG_PREFIX} Instantiating SystemTray')
         
         self.watcher = watcher
         self.reporter = reporter
         self.stop_event = stop_event
         
+        # Built on the tray thread: the tray stack is imported and the icon decoded once the tracking already runs
+        self.icon: 'Icon | None' = None
+        
+    def __get_icon(self) -> 'Icon':
+        from pystray import Icon, Menu, MenuItem # type: ignore
+        from PIL import Image
+        
         if getattr(sys, 'frozen', False):
             base_path = str(sys._MEIPASS) # type: ignore
         else:
@@ -27,9 +36,9 @@ class SystemTray():
             
         icon_image = Image.open(os.path.join(base_path, "images", "icon.png"))
         
-        self.icon = Icon("Watcher", icon_image, "Watcher")
+        icon = Icon("Watcher", icon_image, "Watcher")
         
-        self.menu = Menu(
+        icon.menu = Menu(
             MenuItem(f"Tempo total ativo:", None, enabled=False),
             MenuItem(self.__get_total_active_time, None, enabled=False),
             MenuItem('', None, enabled=False),
@@ -43,7 +52,7 @@ class SystemTray():
             MenuItem("Atualizar", self.__update_menu),
         )
         
-        self.icon.menu = self.menu
+        return icon
         
     def __open_log_file(self) -> None:
         logger.info(f'{LOG_PREFIX} Opening log file')
@@ -51,10 +60,12 @@ class SystemTray():
         
     def __update_menu(self) -> None:
         logger.info(f'{LOG_PREFIX} Updating SystemTray')
-        self.icon.update_menu()
+        
+        if self.icon:
+            self.icon.update_menu()
     
-    def __get_total_active_time(self, _: MenuItem) -> str:
-        active_time = self.watcher.data.active_time.seconds
+    def __get_total_active_time(self, _: 'MenuItem') -> str:
+        active_time = self.watcher.snapshot.active_time.seconds
         
         active_hours = active_time // 3600
         active_minutes = (active_time % 3600) // 60
@@ -62,8 +73,8 @@ class SystemTray():
         
         return f"{active_hours:02d}h{active_minutes:02d}m{active_seconds:02d}s"
     
-    def __get_total_screen_time(self, _: MenuItem) -> str:
-        screen_time = self.watcher.data.screen_time.seconds
+    def __get_total_screen_time(self, _: 'MenuItem') -> str:
+        screen_time = self.watcher.snapshot.screen_time.seconds
         
         screen_hours = screen_time // 3600
         screen_minutes = (screen_time % 3600) // 60
@@ -71,7 +82,7 @@ class SystemTray():
         
         return f"{screen_hours:02d}h{screen_minutes:02d}m{screen_seconds:02d}s"
     
-    def __get_last_save(self, _: MenuItem) -> str:
+    def __get_last_save(self, _: 'MenuItem') -> str:
         last_save = self.reporter.last_save
         
         if not last_save:
@@ -85,12 +96,15 @@ class SystemTray():
         
         return f"{time_hours:02d}h{time_minutes:02d}m{time_seconds:02d}s"
                     
+    def stop(self) -> None:
+        if self.icon:
+            self.icon.stop()
+                    
     def run(self) -> None:
         try:
             logger.debug(f'{LOG_PREFIX} Running SystemTray')
+            self.icon = self.__get_icon()
             self.icon.run() # type: ignore
-        except Exception as e:
-            print('System Tray Exception')
-            print(e)
-            self.stop_event.set()
-            self.icon.stop()
\ No newline at end of file
+        except Exception:
+            logger.exception(f'{LOG_PREFIX} Exception on running ↴')
+            self.stop()
\ No newline at end of file
@@ -0,0 +1,154 @@
+from dataclasses import dataclass
+from queue import Empty, Queue
+from threading import Event, Thread
+from time import monotonic_ns
+from typing import Any, Callable
+
+from config import SUPERVISOR_BACKOFF_MAX, SUPERVISOR_BACKOFF_MIN
+from logger import logger, LOG_PID
+from metrics import metrics
+
+LOG_PREFIX = f"{LOG_PID} {'supervisor.py':<20}"
+
+@dataclass
+class SupervisedComponent():
+    name        : str
+    factory     : Callable[[], Any]
+    stop        : Callable[[Any], None] | None  = None
+    target      : str                           = 'run'
+    instance    : Any                           = None
+    thread      : Thread | None                 = None
+    failures    : int                           = 0
+    started_ns  : int                           = 0
+    restart_ns  : int | None                    = None
+
+class Supervisor():
+    def __init__(self, stop_event: Event, on_restart: Callable[[int], None] | None = None) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating Supervisor')
+
+        self.stop_event = stop_event
+        self.on_restart = on_restart
+
+        self.components: dict[str, SupervisedComponent] = dict()
+        self.exits: Queue[SupervisedComponent | None] = Queue()
+        self.restarts = 0
+
+    def add(self, name: str, factory: Callable[[], Any], stop: Callable[[Any], None] | None = None, target: str = 'run') -> None:
+        # factory() returns the object whose target method is supervised: returning the same instance keeps its state across restarts
+        self.components[name] = SupervisedComponent(name, factory, stop, target)
+
+    def __target(self, component: SupervisedComponent) -> None:
+        try:
+            getattr(component.instance, component.target)()
+        except Exception:
+            logger.exception(f'{LOG_PREFIX} Exception on running {component.name} ↴')
+        finally:
+            self.exits.put(component)
+
+    def __start(self, component: SupervisedComponent) -> None:
+        component.started_ns = monotonic_ns()
+
+        # A component that cannot be built is retried with the same backoff as one whose thread stopped
+        try:
+            component.instance = component.factory()
+        except Exception:
+            logger.exception(f'{LOG_PREFIX} Exception on building {component.name} ↴')
+            component.instance = None
+            self.__schedule(component)
+            return None
+
+        component.thread = Thread(target=self.__target, args=(component,), name=component.name)
+        component.thread.start()
+
+        logger.info(f'{LOG_PREFIX} {component.name} thread started')
+
+    def __get_backoff(self, component: SupervisedComponent) -> float:
+        # A component that ran longer than the longest delay before failing starts over from the shortest one
+        if monotonic_ns() - component.started_ns > SUPERVISOR_BACKOFF_MAX * 1_000_000_000:
+            component.failures = 0
+
+        backoff = min(SUPERVISOR_BACKOFF_MIN * 2 ** component.failures, SUPERVISOR_BACKOFF_MAX)
+        component.failures += 1
+
+        return backoff
+
+    def __schedule(self, component: SupervisedComponent) -> None:
+        if component.thread:
+            component.thread.join()
+
+        backoff = self.__get_backoff(component)
+        component.restart_ns = monotonic_ns() + int(backoff * 1_000_000_000)
+
+        logger.warning(f'{LOG_PREFIX} {component.name} thread stopped, restarting it in {backoff}s')
+
+    def __get_timeout(self) -> float | None:
+        # Until the earliest restart deadline, or until a thread exits when none is scheduled
+        restarts_ns = [component.restart_ns for component in self.components.values() if component.restart_ns is not None]
+
+        if not restarts_ns:
+            return None
+
+        return max(min(restarts_ns) - monotonic_ns(), 0) / 1_000_000_000
+
+    def __restart_due(self) -> None:
+        now_ns = monotonic_ns()
+
+        for component in self.components.values():
+            if component.restart_ns is not None and component.restart_ns <= now_ns:
+                component.restart_ns = None
+                self.__restart(component)
+
+    def __restart(self, component: SupervisedComponent) -> None:
+        self.restarts += 1
+        metrics.counter('restarts_total', 'Component restarts by the Supervisor', {'component': component.name}).inc()
+        logger.warning(f'{LOG_PREFIX} restarts: {self.restarts}')
+
+        self.__start(component)
+
+        if self.on_restart:
+            try:
+                self.on_restart(self.restarts)
+            except Exception:
+                logger.exception(f'{LOG_PREFIX} Exception on restart callback ↴')
+
+    def __shutdown(self) -> None:
+        self.stop_event.set()
+
+        for component in self.components.values():
+            if component.stop and component.instance:
+                try:
+                    component.stop(component.instance)
+                except Exception:
+                    logger.exception(f'{LOG_PREFIX} Exception on stopping {component.name} ↴')
+
+        for component in self.components.values():
+            if component.thread:
+                component.thread.join()
+                logger.info(f'{LOG_PREFIX} {component.name} thread stopped')
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.exits.put(None)
+
+    def run(self) -> None:
+        logger.info(f'{LOG_PREFIX} Starting Threads')
+
+        for component in self.components.values():
+            self.__start(component)
+
+        # Blocks until a thread exits or the earliest restart deadline: each stopped component waits out its own backoff,
+        # the others keep being restarted meanwhile
+        while not self.stop_event.is_set():
+            try:
+                component = self.exits.get(timeout=self.__get_timeout())
+            except Empty:
+                self.__restart_due()
+                continue
+
+            if component is None or self.stop_event.is_set():
+                break
+
+            self.__schedule(component)
+            self.__restart_due()
+
+        self.__shutdown()
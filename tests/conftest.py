@@ -0,0 +1,28 @@
+import os
+import sys
+from types import ModuleType
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+def get_test_config() -> ModuleType:
+    # The settings of config_example.py, plus those the build derives from them: the tests never depend on a local config.py
+    config = ModuleType('config')
+
+    with open(os.path.join(ROOT, 'config_example.py'), 'r', encoding='utf-8') as file:
+        exec(file.read(), config.__dict__)
+
+    config.ACTIVE_TIMEOUT = config.ACTIVE_SECONDS
+    config.REPORTER_INTERVAL = config.REPORT_SECONDS
+    config.WATCHER_INTERVAL = config.WATCHER_SECONDS
+    config.LOG_LEVEL = 'WARNING'
+    config.LOG_SENSOR_EVENTS = 100
+    config.MOVE_INTERVAL = 1
+    config.CLICK_INTERVAL = 0.5
+    config.SCROLL_INTERVAL = 0.5
+    config.PRESS_INTERVAL = 0.2
+
+    return config
+
+sys.modules['config'] = get_test_config()
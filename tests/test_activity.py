@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from threading import Event
+
+import pytest
+
+from activity import FakeActivityProvider, LastInputActivityProvider, get_activity_provider
+from replay import Trace, TraceEvent, TracePlatform
+from watcher import Watcher
+
+SECOND_NS = 1_000_000_000
+
+def get_platform(seconds: float) -> tuple[TracePlatform, Event]:
+    # A single app in the foreground for the whole trace, no sensor event: the activity only comes from the provider
+    stop_event = Event()
+    trace = Trace('WATCHER\\test', datetime(2024, 1, 1, 9), [TraceEvent(0, app='Editor'), TraceEvent(int(seconds * SECOND_NS), app='Editor')])
+
+    return TracePlatform(trace, stop_event), stop_event
+
+def run_watcher(inputs_seconds: list[float], seconds: float) -> Watcher:
+    platform, stop_event = get_platform(seconds)
+    watcher = Watcher(stop_event, platform, FakeActivityProvider(platform, [int(input_seconds * SECOND_NS) for input_seconds in inputs_seconds]))
+    watcher.run()
+
+    return watcher
+
+def test_get_activity_provider():
+    platform, _ = get_platform(1)
+
+    assert isinstance(get_activity_provider('last_input', platform), LastInputActivityProvider)
+
+    with pytest.raises(ValueError):
+        get_activity_provider('fake', platform)
+
+def test_fake_provider_only_sees_passed_inputs():
+    platform, _ = get_platform(1)
+    provider = FakeActivityProvider(platform, [2 * SECOND_NS, SECOND_NS])
+
+    assert provider.get_last_input_ns() is None
+
+    platform.time_ns = int(1.5 * SECOND_NS)
+    assert provider.get_last_input_ns() == SECOND_NS
+
+    provider.input()
+    assert provider.get_last_input_ns() == int(1.5 * SECOND_NS)
+
+    platform.time_ns = 3 * SECOND_NS
+    assert provider.get_last_input_ns() == 2 * SECOND_NS
+
+def test_no_input_is_never_active():
+    watcher = run_watcher([], 120)
+
+    # The replay stops at the first tick past the end of the trace, backed off by then
+    assert watcher.data.screen_time >= timedelta(seconds=120)
+    assert watcher.data.active_time == timedelta()
+    assert not watcher.data.is_active
+
+def test_active_from_the_polled_input():
+    # Seen by the tick at 10.2s, active from the input itself until the last tick before ACTIVE_TIMEOUT (15s) elapsed
+    watcher = run_watcher([10.05], 120)
+
+    assert watcher.data.active_time == timedelta(seconds=14.95)
+    assert watcher.data.apps['Editor'].active_time == timedelta(seconds=14.95)
+    assert watcher.data.last_active_time == datetime(2024, 1, 1, 9, 0, 10, 50000)
+
+def test_inputs_extend_the_active_period():
+    watcher = run_watcher([10.05, 20.05], 120)
+
+    assert watcher.data.active_time == timedelta(seconds=24.95)
+
+def test_backed_off_input_counts_from_the_input():
+    # Idle for more than WATCHER_IDLE_AFTER: the sampler backed off to WATCHER_ACCURACY_BUDGET (5s) ticks when the input comes,
+    # the period it was not sampled still counts as active
+    watcher = run_watcher([200.5], 300)
+
+    assert timedelta(seconds=14.8) <= watcher.data.active_time <= timedelta(seconds=15)
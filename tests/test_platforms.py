@@ -0,0 +1,171 @@
+import os
+import sys
+from queue import Queue
+from threading import Event
+from types import ModuleType, SimpleNamespace
+
+import psutil
+import pytest
+
+import platforms
+from platforms import HeadlessPlatform, X11Platform, X11_INPUT_JITTER_NS, get_platform
+from watcher import Watcher
+
+NET_ACTIVE_WINDOW = 1
+NET_WM_PID = 2
+
+class FakeXError(Exception):
+    pass
+
+class FakeWindow():
+    def __init__(self, server: 'FakeServer', window_id: int) -> None:
+        self.server = server
+        self.window_id = window_id
+
+    def get_full_property(self, atom: int, property_type: int) -> SimpleNamespace | None:
+        if atom == NET_ACTIVE_WINDOW:
+            return SimpleNamespace(value=[self.server.active_window]) if self.server.active_window is not None else None
+
+        if self.window_id not in self.server.pids:
+            raise FakeXError
+
+        pid = self.server.pids[self.window_id]
+
+        return SimpleNamespace(value=[pid] if pid else [])
+
+    def change_attributes(self, event_mask: int) -> None:
+        return None
+
+class FakeDisplay():
+    def __init__(self, server: 'FakeServer') -> None:
+        self.server = server
+        self.root = FakeWindow(server, 0)
+
+    def screen(self) -> SimpleNamespace:
+        return SimpleNamespace(root=self.root)
+
+    def intern_atom(self, name: str) -> int:
+        return {'_NET_ACTIVE_WINDOW': NET_ACTIVE_WINDOW, '_NET_WM_PID': NET_WM_PID}[name]
+
+    def create_resource_object(self, resource_type: str, window_id: int) -> FakeWindow:
+        return FakeWindow(self.server, window_id)
+
+    def next_event(self) -> SimpleNamespace:
+        return self.server.events.get()
+
+    def screensaver_query_info(self, window: FakeWindow) -> SimpleNamespace:
+        return SimpleNamespace(idle=self.server.idle_ms)
+
+class FakeServer():
+    # The state of the X server shared by every connection: the active window, the pid of each window, the idle time
+    def __init__(self) -> None:
+        self.active_window: int | None = None
+        self.pids: dict[int, int] = dict()
+        self.idle_ms = 0
+        self.events: Queue[SimpleNamespace] = Queue()
+
+    def focus(self, window_id: int) -> None:
+        self.active_window = window_id
+        self.events.put(SimpleNamespace(type=X.PropertyNotify, atom=NET_ACTIVE_WINDOW))
+
+X = SimpleNamespace(AnyPropertyType=0, PropertyChangeMask=1 << 22, PropertyNotify=28)
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch) -> FakeServer:
+    # Xlib is imported by X11Platform itself: fake modules stand in for it, whether python-xlib is installed or not
+    server = FakeServer()
+
+    xlib = ModuleType('Xlib')
+    xlib.X = X
+    xlib.display = ModuleType('Xlib.display')
+    xlib.display.Display = lambda: FakeDisplay(server)
+    xlib.error = ModuleType('Xlib.error')
+    xlib.error.XError = FakeXError
+
+    monkeypatch.setitem(sys.modules, 'Xlib', xlib)
+    monkeypatch.setitem(sys.modules, 'Xlib.X', X)
+    monkeypatch.setitem(sys.modules, 'Xlib.display', xlib.display)
+    monkeypatch.setitem(sys.modules, 'Xlib.error', xlib.error)
+
+    return server
+
+def test_active_window(server: FakeServer):
+    platform = X11Platform()
+
+    assert platform.get_active_window() == (0, 0)
+
+    server.active_window = 42
+    server.pids[42] = os.getpid()
+    assert platform.get_active_window() == (42, os.getpid())
+
+    # A client that does not set its pid, a window already gone
+    server.pids[42] = 0
+    assert platform.get_active_window() == (42, 0)
+
+    server.active_window = 43
+    assert platform.get_active_window() == (43, 0)
+
+def test_window_description(server: FakeServer):
+    platform = X11Platform()
+
+    assert platform.get_window_description((42, 0)) == ''
+    assert platform.get_window_description((42, os.getpid())) == psutil.Process().name()
+
+def test_last_input(server: FakeServer, monkeypatch: pytest.MonkeyPatch):
+    platform = X11Platform()
+    monkeypatch.setattr(platform, 'monotonic_ns', lambda: 100_000_000_000)
+
+    server.idle_ms = 2_000
+    assert platform.get_last_input_ns() == 98_000_000_000
+
+    # Read against another clock: a shift within the jitter is not a new input
+    monkeypatch.setattr(platform, 'monotonic_ns', lambda: 100_000_000_000 + X11_INPUT_JITTER_NS)
+    assert platform.get_last_input_ns() == 98_000_000_000
+
+    server.idle_ms = 0
+    assert platform.get_last_input_ns() == 100_000_000_000 + X11_INPUT_JITTER_NS
+
+def test_watch_active_window(server: FakeServer):
+    platform = X11Platform()
+    changes: Queue[tuple[int, int]] = Queue()
+
+    server.active_window = 42
+    server.pids[42] = 1000
+    server.pids[43] = 2000
+
+    assert platform.watch_active_window(lambda: changes.put(platform.get_active_window()))
+
+    server.focus(43)
+    assert changes.get(timeout=5) == (43, 2000)
+
+def test_get_platform_without_display(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(platforms.sys, 'platform', 'linux')
+    monkeypatch.delenv('DISPLAY', raising=False)
+
+    platform = get_platform()
+
+    assert isinstance(platform, HeadlessPlatform)
+    assert platform.get_process_description(psutil.Process()) == psutil.Process().name()
+
+def test_watcher_without_display(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(platforms.sys, 'platform', 'linux')
+    monkeypatch.delenv('DISPLAY', raising=False)
+
+    # Stopped before its loop: the Watcher only takes its first sample
+    stop_event = Event()
+    stop_event.set()
+
+    watcher = Watcher(stop_event)
+    watcher.run()
+
+    assert isinstance(watcher.platform, HeadlessPlatform)
+    assert watcher.data.USERNAME == psutil.Process().username()
+    assert watcher.data.last_app == ''
+    assert '' in watcher.data.apps
+    assert not watcher.data.is_active
+
+def test_get_platform_with_display(server: FakeServer, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(platforms.sys, 'platform', 'linux')
+    monkeypatch.setenv('DISPLAY', ':0')
+
+    assert isinstance(get_platform(), X11Platform)
@@ -0,0 +1,121 @@
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+from pymongo.database import Database
+
+from objects import EventType
+from rollup import DAILY_COLLECTION, HOURLY_COLLECTION, Rollup
+
+# $setWindowFields, $locf, $dateDiff and $merge need a real server: mongomock runs none of them
+MONGODB_URL = os.environ.get('WATCHER_TEST_MONGODB_URL')
+
+pytestmark = pytest.mark.skipif(not MONGODB_URL, reason='set WATCHER_TEST_MONGODB_URL to a MongoDB 5.2+ server')
+
+USER = ObjectId()
+APP_A = ObjectId()
+APP_B = ObjectId()
+
+DAY = (datetime.now() - timedelta(days=2)).replace(hour=0, minute=0, second=0, microsecond=0)
+SESSION = (DAY + timedelta(hours=10)).isoformat()
+
+def at(hours: float) -> datetime:
+    return DAY + timedelta(hours=hours)
+
+def get_id(timestamp: datetime) -> ObjectId:
+    # Written on time: the writer takes the _id just before the insert
+    return ObjectId(str(ObjectId.from_datetime(timestamp.astimezone(timezone.utc)))[:8] + str(ObjectId())[8:])
+
+def get_event(hours: float, event_type: EventType, **fields: Any) -> dict[str, Any]:
+    return {'_id': get_id(at(hours)), 'timestamp': at(hours), 'user': USER, 'session': SESSION, 'type': event_type.value, **fields}
+
+@pytest.fixture
+def mongodb() -> Iterator[Database[Dict[str, Any]]]:
+    client: MongoClient[Dict[str, Any]] = MongoClient(MONGODB_URL)
+
+    if client.server_info()['versionArray'] < [5, 2]:
+        client.close()
+        pytest.skip('the rollup needs MongoDB 5.2+')
+
+    mongodb = client[f'watcher_test_{ObjectId()}']
+
+    # 10:00 A active, 10:30 inactive, 11:15 B, 11:20 active, 12:01 one sensor event, 12:10 inactive, session ends at 12:30;
+    # the exception event of another session at 20:00 is the last one inserted, all of them written on time
+    updated = datetime.now(timezone.utc) - timedelta(days=1)
+
+    mongodb.sessions.insert_one({'user': USER, 'init_watch': at(10), 'last_watch': at(12.5), 'session': SESSION, 'updated': updated})
+    mongodb.events.insert_many([
+        get_event(10, EventType.APP, app=APP_A),
+        get_event(10, EventType.ACTIVITY, active=True),
+        get_event(10.5, EventType.ACTIVITY, active=False),
+        get_event(11.25, EventType.APP, app=APP_B),
+        get_event(11 + 1 / 3, EventType.ACTIVITY, active=True),
+        get_event(12 + 1 / 60, EventType.SENSOR, sensor=0),
+        get_event(12 + 1 / 6, EventType.ACTIVITY, active=False),
+        {'_id': get_id(at(20)), 'timestamp': at(20), 'user': USER, 'type': EventType.EXCEPTION.value, 'restarts': 1},
+    ])
+    # Folded sensor events, never in events
+    mongodb.sensor_buckets.insert_many([
+        {'user': USER, 'session': SESSION, 'timestamp': at(10 + 1 / 12), 'counts': {'mouse_move': 7}, 'total': 7, 'updated': updated},
+        {'user': USER, 'session': SESSION, 'timestamp': at(11.5), 'counts': {'keyboard_press': 3}, 'total': 3, 'updated': updated},
+    ])
+
+    yield mongodb
+
+    client.drop_database(mongodb.name)
+    client.close()
+
+def get_hours(mongodb: Database[Dict[str, Any]]) -> dict[int, dict[str, Any]]:
+    return {hour['hour'].hour: hour for hour in mongodb[HOURLY_COLLECTION].find({'user': USER})}
+
+def get_apps(document: dict[str, Any]) -> dict[ObjectId, tuple[int, int]]:
+    return {app['app']: (app['active_time'], app['screen_time']) for app in document['apps']}
+
+def test_rollup(mongodb: Database[Dict[str, Any]]):
+    Rollup(mongodb).run()
+
+    hours = get_hours(mongodb)
+
+    assert sorted(hours) == [10, 11, 12]
+    assert (hours[10]['active_time'], hours[10]['screen_time'], hours[10]['sensor_counter']) == (1800, 3600, 7)
+    assert (hours[11]['active_time'], hours[11]['screen_time'], hours[11]['sensor_counter']) == (2400, 3600, 3)
+    assert (hours[12]['active_time'], hours[12]['screen_time'], hours[12]['sensor_counter']) == (600, 1800, 1)
+    assert get_apps(hours[11]) == {APP_A: (0, 900), APP_B: (2400, 2700)}
+
+    day = mongodb[DAILY_COLLECTION].find_one({'user': USER})
+
+    assert day is not None
+    assert (day['active_time'], day['screen_time'], day['sensor_counter']) == (4800, 9000, 11)
+    assert get_apps(day) == {APP_A: (1800, 4500), APP_B: (3000, 4500)}
+
+def test_rollup_is_idempotent(mongodb: Database[Dict[str, Any]]):
+    Rollup(mongodb).run()
+    first = get_hours(mongodb)
+
+    Rollup(mongodb).run(backfill=True)
+
+    assert get_hours(mongodb) == first
+
+def test_late_sensor_bucket(mongodb: Database[Dict[str, Any]]):
+    Rollup(mongodb).run()
+
+    # A spool drained late increments a bucket of an hour already rolled up, as the writer does
+    mongodb.sensor_buckets.update_one({'user': USER, 'session': SESSION, 'timestamp': at(10 + 1 / 12)}, {'$inc': {'counts.mouse_move': 5, 'total': 5}, '$currentDate': {'updated': True}})
+    Rollup(mongodb).run()
+
+    assert get_hours(mongodb)[10]['sensor_counter'] == 12
+
+def test_late_session_extension(mongodb: Database[Dict[str, Any]]):
+    Rollup(mongodb).run()
+
+    # The session records of a spool drained late extend the session, without any new event
+    mongodb.sessions.update_one({'user': USER, 'init_watch': at(10)}, {'$max': {'last_watch': at(13)}, '$currentDate': {'updated': True}})
+    Rollup(mongodb).run()
+
+    hours = get_hours(mongodb)
+
+    assert (hours[12]['active_time'], hours[12]['screen_time']) == (600, 3600)
+    assert get_apps(hours[12]) == {APP_B: (600, 3600)}
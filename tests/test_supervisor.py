@@ -0,0 +1,74 @@
+from threading import Event, Thread
+
+import pytest
+
+import supervisor
+from supervisor import Supervisor
+
+class Component():
+    def __init__(self, stop_event: Event) -> None:
+        self.stop_event = stop_event
+        self.runs = 0
+
+    def run(self) -> None:
+        self.runs += 1
+        self.stop_event.wait()
+
+@pytest.fixture(autouse=True)
+def backoff(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(supervisor, 'SUPERVISOR_BACKOFF_MIN', 0.01)
+    monkeypatch.setattr(supervisor, 'SUPERVISOR_BACKOFF_MAX', 0.1)
+
+def run_supervisor(component_supervisor: Supervisor) -> Thread:
+    thread = Thread(target=component_supervisor.run)
+    thread.start()
+
+    return thread
+
+def test_failing_factory_is_retried():
+    stop_event = Event()
+    component = Component(stop_event)
+    built = Event()
+    attempts = []
+
+    def factory() -> Component:
+        attempts.append(None)
+
+        if len(attempts) < 3:
+            raise OSError('spool unavailable')
+
+        built.set()
+        return component
+
+    component_supervisor = Supervisor(stop_event)
+    component_supervisor.add('Component', factory)
+    thread = run_supervisor(component_supervisor)
+
+    assert built.wait(5)
+
+    component_supervisor.stop()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert len(attempts) == 3
+    assert component.runs == 1
+
+def test_other_components_keep_running():
+    stop_event = Event()
+    component = Component(stop_event)
+
+    def factory() -> Component:
+        raise OSError('spool unavailable')
+
+    component_supervisor = Supervisor(stop_event)
+    component_supervisor.add('Component', lambda: component)
+    component_supervisor.add('Failing', factory)
+    thread = run_supervisor(component_supervisor)
+
+    stop_event.wait(0.3)
+    component_supervisor.stop()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert component.runs == 1
+    assert component_supervisor.restarts >= 2
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+from threading import Event
+
+from activity import FakeActivityProvider
+from replay import Trace, TraceEvent, TracePlatform
+from watcher import Watcher
+
+SECOND_NS = 1_000_000_000
+
+def run_watcher(apps: list[tuple[float, str]], inputs_seconds: list[float], window_events: bool) -> tuple[Watcher, TracePlatform]:
+    stop_event = Event()
+    trace = Trace('WATCHER\\test', datetime(2024, 1, 1, 9), [TraceEvent(int(seconds * SECOND_NS), app=app) for seconds, app in apps])
+    platform = TracePlatform(trace, stop_event, window_events=window_events)
+
+    watcher = Watcher(stop_event, platform, FakeActivityProvider(platform, [int(input_seconds * SECOND_NS) for input_seconds in inputs_seconds]))
+    watcher.run()
+
+    return watcher, platform
+
+def test_pushed_focus_changes_are_accounted_to_the_app_that_had_the_focus():
+    watcher, _ = run_watcher([(0, 'Editor'), (100.3, 'Browser'), (400.7, 'Editor'), (600, 'Editor')], [], window_events=True)
+
+    assert watcher.data.apps['Browser'].screen_time == timedelta(seconds=300.4)
+    assert watcher.data.apps['Editor'].screen_time == watcher.data.screen_time - timedelta(seconds=300.4)
+
+def test_pushed_idle_backs_off():
+    # Idle for ten minutes: after WATCHER_IDLE_AFTER (60s), one tick per WATCHER_ACCURACY_BUDGET (5s) instead of one per
+    # WATCHER_SNAPSHOT_INTERVAL (1s)
+    watcher, platform = run_watcher([(0, 'Editor'), (600, 'Editor')], [], window_events=True)
+
+    assert watcher.data.screen_time >= timedelta(seconds=600)
+    assert platform.waits < 60 + (600 - 60) / 5 + 10
+
+def test_pushed_active_period_ends_on_time():
+    watcher, platform = run_watcher([(0, 'Editor'), (600, 'Editor')], [300.05], window_events=True)
+
+    # The input is only seen by the next backed off tick and counts from the input itself; as when polling, the period
+    # ends on the first tick past ACTIVE_TIMEOUT (15s), one WATCHER_SNAPSHOT_INTERVAL at most after the last counted one
+    assert timedelta(seconds=14) <= watcher.data.active_time <= timedelta(seconds=15)
+    assert watcher.data.last_active_time == datetime(2024, 1, 1, 9, 5, 0, 50000)
+    # One tick per second during the first minute, the active period and the minute after it, backed off otherwise
+    assert platform.waits < 60 + 15 + 60 + (600 - 135) / 5 + 10
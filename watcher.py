@@ -1,111 +1,231 @@
-import ctypes
-import psutil
-import win32api
 from datetime import datetime, timedelta
 from threading import Event
-from time import sleep
+from time import perf_counter
+from typing import Hashable
 
-from config import ACTIVE_TIMEOUT, SENSORS, WATCHER_INTERVAL
-from logger import logger, LOG_PID
-from objects import SensorEvent, SensorCounters, WatcherApp, WatcherData, EventsQueue
-from sensor import Sensor
+from activity import ActivityProvider, get_activity_provider
+from config import ACTIVE_TIMEOUT, ACTIVITY_PROVIDER, EVENTS_QUEUE_CAPACITY, REPORTER_FLUSH_BYTES, REPORTER_FLUSH_EVENTS, WATCHER_ACCURACY_BUDGET, WATCHER_IDLE_AFTER, WATCHER_INTERVAL, WATCHER_SNAPSHOT_INTERVAL, WATCHER_WINDOW_EVENTS
+from logger import logger, log_sampler, LOG_PID
+from metrics import metrics
+from objects import SensorEvent, SensorCounters, WatcherApp, WatcherData, WatcherSnapshot, EventsQueue
+from platforms import Platform, get_platform
+from startup import startup
 
 LOG_PREFIX = f"{LOG_PID} {'watcher.py':<20}"
 
+TICK_SECONDS = metrics.histogram('tick_seconds', 'Duration of a Watcher tick')
+SAMPLING_INTERVAL = metrics.gauge('sampling_interval_seconds', 'Current Watcher sampling period')
+APP_SWITCHES = metrics.counter('app_switches_total', 'Foreground app changes seen by the Watcher')
+
 class Watcher():
-    def __init__(self, stop_event: Event) -> None:
+    def __init__(self, stop_event: Event, platform: Platform | None = None, activity_provider: ActivityProvider | None = None) -> None:
         logger.debug(f'{LOG_PREFIX} Instantiating Watcher')
         
         self.stop_event = stop_event
         
-        self.user32_dll = ctypes.windll.user32
+        self.platform = platform if platform else get_platform()
+        self.activity_provider = activity_provider if activity_provider else get_activity_provider(ACTIVITY_PROVIDER, self.platform)
         
-        self.data = WatcherData(self.get_active_window_process().username())
+        self.last_window: Hashable | None = None
+        self.last_window_description = ''
         
-        self.events_queue = EventsQueue()
+        now = self.platform.now()
         
-    def __sensor_callback(self, sensor_counters: SensorCounters, sensor_event: SensorEvent) -> None:
-        now = datetime.now()
+        self.data = WatcherData(self.platform.get_username(), today=now.date(), INIT_TIME=now, last_time=now, last_active_time=now)
         
-        self.data.sensor_counters = sensor_counters
+        self.events_queue = EventsQueue(EVENTS_QUEUE_CAPACITY, self.platform.monotonic_ns(), now)
+        
+        for queue_name, ring in (('activity', self.events_queue.activity), ('app', self.events_queue.app), ('sensor', self.events_queue.sensor)):
+            metrics.gauge('events_queue_depth', 'Events waiting in the Watcher queue', {'queue': queue_name}, ring.__len__)
+        metrics.gauge('events_queue_overflows', 'Events dropped because the Watcher queue was full', function=self.events_queue.overflows)
+        
+        self.wake_event = Event()
+        self.activity_started = False
+        self.window_events: bool | None = None
+        self.last_tick_ns = self.platform.monotonic_ns()
+        self.last_active_ns = self.last_tick_ns
+        self.active_since_ns = self.last_tick_ns
+        self.last_app_change_ns = self.last_tick_ns
+        
+        # Other threads only read the published snapshot: it is replaced as a whole, never mutated
+        self.snapshot = WatcherSnapshot.from_data(self.data)
+        self.last_snapshot_ns = self.last_tick_ns
+        
+    def __set_active(self, now: datetime, input_ns: int) -> bool:
         self.data.last_active_time = now
+        self.last_active_ns = input_ns
         
-        if not self.data.is_active:
-            self.data.is_active = True
-            self.events_queue.activity.append((self.data.is_active, now))
-            
-            logger.info(f'{LOG_PREFIX} Activity detected')
+        if self.data.is_active:
+            return False
+        
+        self.data.is_active = True
+        self.active_since_ns = input_ns
+        self.events_queue.activity.append(self.data.is_active, input_ns)
+        
+        logger.info(f'{LOG_PREFIX} Activity detected')
+        
+        return True
+        
+    def __sensor_callback(self, sensor_counters: SensorCounters, sensor_event: SensorEvent) -> None:
+        self.data.sensor_counters = sensor_counters
+        
+        if self.__set_active(self.platform.now(), self.platform.monotonic_ns()):
+            # Back to full rate right away if the sampler was backed off
+            self.wake_event.set()
             
-        self.events_queue.sensor.append((sensor_event, datetime.now()))
+        self.events_queue.sensor.append(sensor_event.value, self.last_active_ns)
         
-    def get_active_window_process(self) -> psutil.Process:
-        hwnd = self.user32_dll.GetForegroundWindow()
-        pid = ctypes.c_ulong()
-
-        self.user32_dll.GetWindowThreadProcessId(hwnd, ctypes.byref(pid))
-
-        return psutil.Process(pid.value)
+        if not self.events_queue.ready.is_set() and (len(self.events_queue) >= REPORTER_FLUSH_EVENTS or self.events_queue.nbytes() >= REPORTER_FLUSH_BYTES):
+            self.events_queue.ready.set()
+        
+    def get_active_window_description(self) -> str:
+        active_window = self.platform.get_active_window()
+        
+        # Same window as the last tick (handle and pid on Windows): the process behind it did not change
+        if active_window == self.last_window:
+            return self.last_window_description
+        
+        description = self.platform.get_window_description(active_window)
+        
+        self.last_window = active_window
+        self.last_window_description = description
+        
+        return description
          
-    @classmethod
-    def get_process_description(cls, process: psutil.Process) -> str:
-        if process.pid == 0:
-            return ""
+    def __tick(self) -> None:
+        active_window_description = self.get_active_window_description()
+            
+        if active_window_description == 'System Idle Process':
+            return None
+            
+        if active_window_description not in self.data.apps:
+            self.data.apps[active_window_description] = WatcherApp(active_window_description)
+            
+        now = self.platform.now()
+        now_ns = self.platform.monotonic_ns()
         
-        try:
-            file_path = process.exe()
-            lang, codepage = win32api.GetFileVersionInfo(file_path, '\\VarFileInfo\\Translation')[0] # type: ignore
-            description_key = f'\\StringFileInfo\\{lang:04x}{codepage:04x}\\FileDescription'
-
-            description = win32api.GetFileVersionInfo(file_path, description_key)
-            return str(description) if description else process.name()
-
-        except:
-            return process.name()
+        # Polling providers: a backed off step still counts as active from the input itself, not from the tick that saw it
+        last_input_ns = self.activity_provider.get_last_input_ns()
+        
+        if last_input_ns is not None and last_input_ns > self.last_active_ns:
+            self.__set_active(now - timedelta(microseconds=(now_ns - last_input_ns) // 1000), last_input_ns)
+        
+        delta_time = timedelta(microseconds=(now_ns - self.last_tick_ns) // 1000)
+        delta_active_ns = now_ns - self.last_active_ns
+        
+        # A pushed focus change ticks right after it: the time since the last tick belongs to the app that had the focus
+        accounted_app = self.data.last_app if self.window_events and self.data.last_app in self.data.apps else active_window_description
+        
+        self.data.screen_time += delta_time
+        self.data.apps[accounted_app].screen_time += delta_time
+        
+        if active_window_description != self.data.last_app:
+            if log_sampler.allow('app'):
+                logger.debug('{} {}', LOG_PREFIX, active_window_description)
+            self.events_queue.app.append(self.events_queue.get_app_code(active_window_description), now_ns)
+            self.last_app_change_ns = now_ns
+            APP_SWITCHES.inc()
+        
+        if self.data.is_active and delta_active_ns > ACTIVE_TIMEOUT * 1_000_000_000:
+            self.data.is_active = False
+            self.events_queue.activity.append(self.data.is_active, now_ns)
+            
+            logger.info(f'{LOG_PREFIX} Inactivity detected')
+            
+        if self.data.is_active:
+            # A backed off step only counts as active from the input that woke the sampler
+            delta_active_time = timedelta(microseconds=(now_ns - max(self.last_tick_ns, self.active_since_ns)) // 1000)
+            
+            self.data.active_time += delta_active_time
+            self.data.apps[accounted_app].active_time += delta_active_time
+            
+        self.last_tick_ns = now_ns
+        self.data.last_time = now
+        self.data.last_app = active_window_description
+        
+    def publish_snapshot(self) -> None:
+        self.snapshot = WatcherSnapshot.from_data(self.data)
+        self.last_snapshot_ns = self.platform.monotonic_ns()
+        
+    def __get_interval(self, interval: float) -> float:
+        idle_ns = self.platform.monotonic_ns() - max(self.last_active_ns, self.last_app_change_ns)
+        
+        if self.data.is_active or idle_ns < WATCHER_IDLE_AFTER * 1_000_000_000:
+            return WATCHER_INTERVAL
+        
+        # Idle: double the period up to the accuracy budget, the most screen_time a focus change can be misattributed
+        return min(interval * 2, WATCHER_ACCURACY_BUDGET)
+    
+    def __get_deadline_ns(self, interval: float) -> int:
+        # With pushed focus changes, the only other reasons to tick: publishing the snapshot and ending the active period
+        # while active; once idle, only screen_time moves and the snapshot follows the sampling back-off
+        if not self.data.is_active:
+            return self.last_tick_ns + int(max(interval, WATCHER_SNAPSHOT_INTERVAL) * 1_000_000_000)
+        
+        deadline_ns = self.last_snapshot_ns + int(WATCHER_SNAPSHOT_INTERVAL * 1_000_000_000)
+            
+        return min(deadline_ns, self.last_active_ns + int(ACTIVE_TIMEOUT * 1_000_000_000) + 1)
     
     def __run(self):
         logger.debug(f'{LOG_PREFIX} Running Watcher')
-        Sensor.run(self.__sensor_callback, SENSORS[0], SENSORS[1], SENSORS[2], SENSORS[3])
+        
+        # The time the loop was down is not attributed to the app of the next tick
+        self.last_tick_ns = self.platform.monotonic_ns()
+        
+        # First sample right away, before the input hooks and the window events are set up
+        self.__tick()
+        
+        startup.mark('first_sample')
+        startup.report()
+        
+        # The listeners outlive a restart of the sampling loop: started once, they keep feeding the same data
+        if not self.activity_started:
+            self.activity_provider.start(self.__sensor_callback)
+            self.activity_started = True
+        
+        if self.window_events is None:
+            self.window_events = WATCHER_WINDOW_EVENTS and self.platform.watch_active_window(self.wake_event.set)
+            logger.info(f'{LOG_PREFIX} Foreground window {"pushed" if self.window_events else "polled"}')
+        
+        interval = WATCHER_INTERVAL
+        deadline_ns = self.platform.monotonic_ns()
+        SAMPLING_INTERVAL.set(0 if self.window_events else interval)
         
         while not self.stop_event.is_set():
-            sleep(WATCHER_INTERVAL)
-            
-            active_window_process = self.get_active_window_process()
-            active_window_description = self.get_process_description(active_window_process)
-                
-            if active_window_description == 'System Idle Process':
-                continue
+            if self.window_events:
+                # Focus changes wake the loop: no work in between but the time-accounting deadlines
+                deadline_ns = self.__get_deadline_ns(interval)
+            else:
+                # Deadlines advance by the period itself, so the time spent on the tick does not make it drift
+                deadline_ns += int(interval * 1_000_000_000)
                 
-            if active_window_description not in self.data.apps:
-                self.data.apps[active_window_description] = WatcherApp(active_window_description)
-                
-            now = datetime.now()
+            now_ns = self.platform.monotonic_ns()
             
-            delta_time = now - self.data.last_time
-            delta_active_time = now - self.data.last_active_time
+            if deadline_ns < now_ns:
+                deadline_ns = now_ns
             
-            self.data.screen_time += delta_time
-            self.data.apps[active_window_description].screen_time += delta_time
+            if self.platform.wait(self.wake_event, (deadline_ns - now_ns) / 1_000_000_000):
+                self.wake_event.clear()
+                deadline_ns = self.platform.monotonic_ns()
+                
+            tick_start = perf_counter()
+            self.__tick()
+            TICK_SECONDS.observe(perf_counter() - tick_start)
             
-            if active_window_description != self.data.last_app:
-                logger.debug(f'{LOG_PREFIX} {active_window_description}')
-                self.events_queue.app.append((self.data.apps[active_window_description].name, now))
+            if self.last_tick_ns - self.last_snapshot_ns >= WATCHER_SNAPSHOT_INTERVAL * 1_000_000_000:
+                self.publish_snapshot()
             
-            if self.data.is_active and delta_active_time > timedelta(seconds=ACTIVE_TIMEOUT):
-                self.data.is_active = False
-                self.events_queue.activity.append((self.data.is_active, now))
-                
-                logger.info(f'{LOG_PREFIX} Inactivity detected')
-                
-            if self.data.is_active:
-                self.data.active_time += delta_time
-                self.data.apps[active_window_description].active_time += delta_time
+            next_interval = self.__get_interval(interval)
+            
+            if next_interval != interval:
+                logger.debug(f'{LOG_PREFIX} Sampling interval: {next_interval}s')
+                interval = next_interval
+                SAMPLING_INTERVAL.set(0 if self.window_events else interval)
                 
-            self.data.last_time = now
-            self.data.last_app = active_window_description
+        self.publish_snapshot()
             
     def run(self):
         try:
             self.__run()
         except Exception:
-            logger.exception(f'{LOG_PREFIX} Exception on running ↴')
-            self.stop_event.set()
\ No newline at end of file
+            logger.exception(f'{LOG_PREFIX} Exception on running ↴')
\ No newline at end of file
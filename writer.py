@@ -0,0 +1,494 @@
+from bson.objectid import ObjectId
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+from typing import Any, Dict
+
+from config import EVENTS_TIMESERIES, REPORTER_DELTA_WRITES
+from logger import logger, LOG_PID
+from metrics import metrics
+from objects import DatabaseCollections, EventType, RecordKind
+from registry import AppRegistry, APPS_FILE
+
+LOG_PREFIX = f"{LOG_PID} {'writer.py':<20}"
+
+TIMESERIES_EVENT_TYPES = (EventType.ACTIVITY.value, EventType.APP.value, EventType.SENSOR.value)
+
+# Markers kept per document: a batch is replayed right after its failed write, long before as many other batches reach it
+APPLIED_BATCHES = 64
+DUPLICATE_KEY_ERROR = 11000
+
+WRITE_SECONDS = {collection: metrics.histogram('write_seconds', 'Duration of the database writes', {'collection': collection}) for collection in ('apps', 'events', 'events_timeseries', 'metrics', 'reports', 'sensor_buckets', 'sessions')}
+
+def get_report_app_key(app_id: ObjectId) -> str:
+    # Report apps are keyed by the registry id, the name is kept in the entry: an app name may hold '.' or start with '$'
+    return str(app_id)
+
+def get_applied_request(filter: dict[str, Any], update: dict[str, Any], marker: str) -> UpdateOne:
+    # Applied once: the marker joins the document with the update, a replay no longer matches the filter and its upsert
+    # collides with the document on the unique index
+    return UpdateOne(
+        {**filter, 'applied': {'$ne': marker}},
+        {**update, '$push': {'applied': {'$each': [marker], '$slice': -APPLIED_BATCHES}}},
+        upsert=True
+    )
+
+def is_duplicate_key_error(error: BulkWriteError) -> bool:
+    return not error.details.get('writeConcernErrors') and all(write_error['code'] == DUPLICATE_KEY_ERROR for write_error in error.details['writeErrors'])
+
+def merge_report_records(records: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    merged: dict[tuple[str, datetime, str], dict[str, Any]] = dict()
+
+    for record in records:
+        key = (record['user'], record['date'], record['session'])
+        report = merged.get(key)
+
+        if not report:
+            merged[key] = {**record, 'apps': {name: dict(app) for name, app in record['apps'].items()}}
+            continue
+
+        report['active_time'] += record['active_time']
+        report['screen_time'] += record['screen_time']
+        report['sensor_counter'] += record['sensor_counter']
+        report['init_watch'] = min(report['init_watch'], record['init_watch'])
+        report['last_watch'] = max(report['last_watch'], record['last_watch'])
+
+        for app_name, app in record['apps'].items():
+            if app_name not in report['apps']:
+                report['apps'][app_name] = {'active_time': 0, 'screen_time': 0}
+
+            report['apps'][app_name]['active_time'] += app['active_time']
+            report['apps'][app_name]['screen_time'] += app['screen_time']
+
+    return list(merged.values())
+
+def merge_sensor_bucket_records(records: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    merged: dict[tuple[str, str, datetime], dict[str, Any]] = dict()
+
+    for record in records:
+        key = (record['user'], record['session'], record['timestamp'])
+        bucket = merged.get(key)
+
+        if not bucket:
+            merged[key] = {**record, 'counts': dict(record['counts'])}
+            continue
+
+        for sensor_name, count in record['counts'].items():
+            bucket['counts'][sensor_name] = bucket['counts'].get(sensor_name, 0) + count
+
+    return list(merged.values())
+
+class RecordWriter():
+    def __init__(self, db: DatabaseCollections, registry_path: str = APPS_FILE) -> None:
+        logger.debug(f'{LOG_PREFIX} Instantiating RecordWriter')
+
+        self.db = db
+
+        self.users: dict[str, ObjectId] = dict()
+        self.registry = AppRegistry(self.db.apps, registry_path)
+
+    def get_user_id(self, username: str) -> ObjectId | None:
+        user_id = self.users.get(username)
+
+        if user_id:
+            return user_id
+
+        user = self.db.users.find_one({"username": username})
+
+        if user:
+            user_id = user.get('_id')
+        else:
+            new_user = {"username": username}
+            result = self.db.users.insert_one(new_user)
+            user_id = result.inserted_id
+
+        if not user_id:
+            return None
+
+        self.users[username] = user_id
+
+        return user_id
+
+    def get_app_id(self, app_name: str) -> ObjectId | None:
+        return self.registry.get(app_name)
+
+    def __get_report_db(self, user_id: ObjectId, report_date: datetime) -> Dict[str, Any] | None:
+        return self.db.reports.find_one({"date": report_date, "user": user_id})
+
+    def __create_empty_report(self, user_id: ObjectId, report_date: datetime) -> ObjectId | None:
+        new_report: dict[str, Any] = {
+            "date": report_date,
+            "user": user_id,
+            "active_time": 0,
+            "screen_time": 0,
+            "sensor_counter": 0,
+            "apps": {},
+        }
+        result = self.db.reports.insert_one(new_report)
+        return result.inserted_id
+
+    def __update_report_apps(self, report: dict[str, Any], record: dict[str, Any], app_ids: dict[str, ObjectId]) -> dict[str, Any]:
+        for app_name, app in record['apps'].items():
+            app_key = get_report_app_key(app_ids[app_name])
+
+            if app_key not in report['apps']:
+                report['apps'][app_key] = {'app': app_name, 'active_time': 0, 'screen_time': 0}
+
+            report['apps'][app_key]['active_time'] += app['active_time']
+            report['apps'][app_key]['screen_time'] += app['screen_time']
+
+        return report
+
+    def __update_report_total_deltas(self, report: dict[str, Any], record: dict[str, Any]) -> dict[str, Any]:
+        report['active_time'] += record['active_time']
+        report['screen_time'] += record['screen_time']
+        report['sensor_counter'] += record['sensor_counter']
+
+        return report
+
+    def __write_report(self, user_id: ObjectId, record: dict[str, Any], app_ids: dict[str, ObjectId], marker: str) -> bool:
+        report = self.__get_report_db(user_id, record['date'])
+
+        if not report:
+            self.__create_empty_report(user_id, record['date'])
+            report = self.__get_report_db(user_id, record['date'])
+
+            if not report:
+                logger.warning(f'{LOG_PREFIX} Cannot get report')
+                logger.debug(f'{LOG_PREFIX} report: {report}')
+                return False
+
+        report_id: ObjectId | None = report.get('_id')
+
+        if not report_id:
+            logger.warning(f'{LOG_PREFIX} Cannot get report_id')
+            logger.debug(f'{LOG_PREFIX} report_id: {report_id}')
+            return False
+
+        if marker in report.get('applied', []):
+            logger.debug(f'{LOG_PREFIX} The report data were already saved in the database: {marker}')
+            return True
+
+        report = self.__update_report_apps(report, record, app_ids)
+        report = self.__update_report_total_deltas(report, record)
+        report['applied'] = [*report.get('applied', []), marker][-APPLIED_BATCHES:]
+
+        with WRITE_SECONDS['reports'].time():
+            update_one = self.db.reports.update_one(filter={'_id': report_id}, update={'$set': report}, upsert=True)
+
+        if update_one.modified_count == 0:
+            logger.warning(f'{LOG_PREFIX} The report data were not saved in the database: no document modified')
+            logger.debug(f'{LOG_PREFIX} update_one.matched_count: {update_one.matched_count}')
+            logger.debug(f'{LOG_PREFIX} update_one.modified_count: {update_one.modified_count}')
+            return False
+
+        return True
+
+    def __get_report_deltas_request(self, user_id: ObjectId, record: dict[str, Any], app_ids: dict[str, ObjectId], marker: str) -> UpdateOne:
+        increments: dict[str, int] = {
+            'active_time': record['active_time'],
+            'screen_time': record['screen_time'],
+            'sensor_counter': record['sensor_counter'],
+        }
+        names: dict[str, str] = dict()
+
+        for app_name, app in record['apps'].items():
+            if not app['active_time'] and not app['screen_time']:
+                continue
+
+            app_key = f'apps.{get_report_app_key(app_ids[app_name])}'
+
+            if app['active_time']:
+                increments[f'{app_key}.active_time'] = app['active_time']
+            if app['screen_time']:
+                increments[f'{app_key}.screen_time'] = app['screen_time']
+
+            names[f'{app_key}.app'] = app_name
+
+        update: dict[str, Any] = {'$inc': increments}
+
+        if names:
+            update['$set'] = names
+
+        return get_applied_request({"date": record['date'], "user": user_id}, update, marker)
+
+    def __get_session_request(self, user_id: ObjectId, record: dict[str, Any], marker: str) -> UpdateOne:
+        update: dict[str, Any] = {
+            '$inc': {
+                'active_time': record['active_time'],
+                'screen_time': record['screen_time'],
+                'sensor_counter': record['sensor_counter'],
+            },
+            '$max': {'last_watch': record['last_watch']},
+            '$setOnInsert': {'session': record['session']},
+            # On the server clock: rollup.py finds the sessions extended late by a drained spool
+            '$currentDate': {'updated': True},
+        }
+
+        return get_applied_request({'user': user_id, 'init_watch': record['init_watch']}, update, marker)
+
+    def __bulk_write(self, collection: Collection[Dict[str, Any]], requests: list[UpdateOne]) -> tuple[int, int]:
+        # Returns the requests saved, and those skipped as already applied by a previous attempt of the batch. A new
+        # document upserted meanwhile by another agent collides too: such a request applies on the second round
+        saved = 0
+
+        for _ in range(2):
+            try:
+                result = collection.bulk_write(requests, ordered=False)
+                return saved + result.matched_count + len(result.upserted_ids), 0
+            except BulkWriteError as error:
+                if not is_duplicate_key_error(error):
+                    raise
+
+                saved += error.details['nMatched'] + len(error.details['upserted'])
+                requests = [requests[write_error['index']] for write_error in error.details['writeErrors']]
+
+        logger.debug(f'{LOG_PREFIX} {len(requests)} {collection.name} requests already applied')
+        return saved, len(requests)
+
+    def __write_sessions(self, requests: list[UpdateOne]) -> None:
+        # One document per session: the cost of a flush does not depend on how many sessions the day had
+        with WRITE_SECONDS['sessions'].time():
+            self.__bulk_write(self.db.sessions, requests)
+
+    def __write_reports(self, records: list[dict[str, Any]], batch_id: str) -> None:
+        requests: list[UpdateOne] = []
+        session_requests: list[UpdateOne] = []
+
+        # The merge is the same for the same batch: a request keeps its marker from one attempt to the next
+        for index, record in enumerate(merge_report_records(records)):
+            marker = f'{batch_id}:{index}'
+
+            user_id = self.get_user_id(record['user'])
+
+            if not user_id:
+                logger.warning(f'{LOG_PREFIX} Cannot get user_id')
+                logger.debug(f'{LOG_PREFIX} user_id: {user_id}')
+                continue
+
+            app_ids = self.registry.resolve(record['apps'])
+
+            for app_name in list(record['apps']):
+                if app_name not in app_ids:
+                    logger.warning(f'{LOG_PREFIX} Cannot get app_id')
+                    logger.debug(f'{LOG_PREFIX} app_name: {app_name}')
+                    del record['apps'][app_name]
+
+            session_requests.append(self.__get_session_request(user_id, record, marker))
+
+            if REPORTER_DELTA_WRITES:
+                requests.append(self.__get_report_deltas_request(user_id, record, app_ids, marker))
+            elif self.__write_report(user_id, record, app_ids, marker):
+                logger.success(f'{LOG_PREFIX} The report data have been saved in the database')
+
+        if session_requests:
+            self.__write_sessions(session_requests)
+
+        if not requests:
+            return None
+
+        # Every report of the batch (users, days) in one unordered round trip
+        with WRITE_SECONDS['reports'].time():
+            saved, skipped = self.__bulk_write(self.db.reports, requests)
+
+        if saved + skipped < len(requests):
+            logger.warning(f'{LOG_PREFIX} The report data were not saved in the database: {len(requests) - saved - skipped} reports not matched or upserted')
+            logger.debug(f'{LOG_PREFIX} saved: {saved}')
+            logger.debug(f'{LOG_PREFIX} skipped: {skipped}')
+            return None
+
+        logger.success(f'{LOG_PREFIX} The report data have been saved in the database')
+
+    def __get_event_document(self, record: dict[str, Any]) -> dict[str, Any] | None:
+        user_id = self.get_user_id(record['user'])
+
+        if not user_id:
+            logger.warning(f'{LOG_PREFIX} Cannot get user_id')
+            logger.debug(f'{LOG_PREFIX} record: {record}')
+            return None
+
+        document: dict[str, Any] = {'timestamp': record['timestamp'], 'user': user_id}
+
+        # Records spooled before the record ids have none: written as they are
+        if 'rid' in record:
+            document['rid'] = record['rid']
+
+        match RecordKind(record['kind']):
+            case RecordKind.ACTIVITY:
+                document['active'] = record['active']
+                document['type'] = EventType.ACTIVITY.value
+            case RecordKind.APP:
+                document['app'] = self.get_app_id(record['app'])
+                document['type'] = EventType.APP.value
+            case RecordKind.SENSOR:
+                document['sensor'] = record['sensor']
+                document['type'] = EventType.SENSOR.value
+            case RecordKind.EXCEPTION:
+                document['restarts'] = record['restarts']
+                document['type'] = EventType.EXCEPTION.value
+                return document
+            case _:
+                return None
+
+        document['session'] = record['session']
+
+        return document
+
+    def __write_events(self, records: list[dict[str, Any]]) -> None:
+        documents: list[dict[str, Any]] = []
+
+        for record in records:
+            document = self.__get_event_document(record)
+
+            if document:
+                documents.append(document)
+
+        if EVENTS_TIMESERIES:
+            documents = self.__write_timeseries_events(documents)
+
+        if not documents:
+            return None
+
+        with WRITE_SECONDS['events'].time():
+            inserted = self.__insert_many(self.db.events, documents)
+        logger.success(f'{LOG_PREFIX} {inserted} events have been saved in the database')
+
+    def __insert_many(self, collection: Collection[Dict[str, Any]], documents: list[dict[str, Any]]) -> int:
+        # The unique rid index turns away the documents a previous attempt of the batch already inserted
+        try:
+            return len(collection.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as error:
+            if not is_duplicate_key_error(error):
+                raise
+
+            logger.debug(f'{LOG_PREFIX} {len(error.details["writeErrors"])} {collection.name} documents already inserted')
+            return error.details['nInserted']
+
+    def __write_timeseries_events(self, documents: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        # Activity, app and sensor events go to the time series collection, bucketed by their meta field; returns the others
+        timeseries_documents: list[dict[str, Any]] = []
+        other_documents: list[dict[str, Any]] = []
+
+        for document in documents:
+            if document['type'] not in TIMESERIES_EVENT_TYPES:
+                other_documents.append(document)
+                continue
+
+            document['meta'] = {'user': document.pop('user'), 'session': document.pop('session'), 'type': document.pop('type')}
+            timeseries_documents.append(document)
+
+        # No unique index on a time series collection: the documents a previous attempt of the batch inserted are looked up,
+        # within the time range of the batch so that only its buckets are read
+        rids = [document['rid'] for document in timeseries_documents if 'rid' in document]
+
+        if rids:
+            inserted = {document['rid'] for document in self.db.events_timeseries.find({
+                'timestamp': {'$gte': min(document['timestamp'] for document in timeseries_documents), '$lte': max(document['timestamp'] for document in timeseries_documents)},
+                'rid': {'$in': rids},
+            }, {'rid': 1})}
+
+            if inserted:
+                logger.debug(f'{LOG_PREFIX} {len(inserted)} events_timeseries documents already inserted')
+                timeseries_documents = [document for document in timeseries_documents if document.get('rid') not in inserted]
+
+        if timeseries_documents:
+            with WRITE_SECONDS['events_timeseries'].time():
+                self.db.events_timeseries.insert_many(timeseries_documents, ordered=False)
+            logger.success(f'{LOG_PREFIX} {len(timeseries_documents)} events have been saved in the time series collection')
+
+        return other_documents
+
+    def __write_sensor_buckets(self, records: list[dict[str, Any]], batch_id: str) -> None:
+        requests: list[UpdateOne] = []
+
+        for index, record in enumerate(merge_sensor_bucket_records(records)):
+            user_id = self.get_user_id(record['user'])
+
+            if not user_id:
+                logger.warning(f'{LOG_PREFIX} Cannot get user_id')
+                logger.debug(f'{LOG_PREFIX} record: {record}')
+                continue
+
+            increments = {f'counts.{sensor_name}': count for sensor_name, count in record['counts'].items() if count}
+            increments['total'] = sum(record['counts'].values())
+
+            requests.append(get_applied_request(
+                {'user': user_id, 'session': record['session'], 'timestamp': record['timestamp']},
+                {'$inc': increments, '$currentDate': {'updated': True}},
+                f'{batch_id}:{index}'
+            ))
+
+        if not requests:
+            return None
+
+        with WRITE_SECONDS['sensor_buckets'].time():
+            saved, _ = self.__bulk_write(self.db.sensor_buckets, requests)
+        logger.success(f'{LOG_PREFIX} {saved} sensor buckets have been saved in the database')
+
+    def __write_metrics(self, records: list[dict[str, Any]]) -> None:
+        documents: list[dict[str, Any]] = []
+
+        for record in records:
+            user_id = self.get_user_id(record['user'])
+
+            if not user_id:
+                logger.warning(f'{LOG_PREFIX} Cannot get user_id')
+                logger.debug(f'{LOG_PREFIX} record: {record}')
+                continue
+
+            document: dict[str, Any] = {'user': user_id, 'session': record['session'], 'timestamp': record['timestamp'], 'metrics': record['metrics']}
+
+            if 'rid' in record:
+                document['rid'] = record['rid']
+
+            documents.append(document)
+
+        if not documents:
+            return None
+
+        with WRITE_SECONDS['metrics'].time():
+            self.__insert_many(self.db.metrics, documents)
+
+    def write(self, records: list[dict[str, Any]], batch_id: str | None = None) -> None:
+        # A batch written again after a failure, with the same records and the same batch_id, is applied once
+        if batch_id is None:
+            batch_id = str(ObjectId())
+
+        reports: list[dict[str, Any]] = []
+        sensor_buckets: list[dict[str, Any]] = []
+        metrics_documents: list[dict[str, Any]] = []
+        events: list[dict[str, Any]] = []
+
+        app_names: set[str] = set()
+
+        for record in records:
+            if record['kind'] == RecordKind.REPORT.value:
+                reports.append(record)
+                app_names.update(record['apps'])
+            elif record['kind'] == RecordKind.SENSOR_BUCKET.value:
+                sensor_buckets.append(record)
+            elif record['kind'] == RecordKind.METRICS.value:
+                metrics_documents.append(record)
+            else:
+                events.append(record)
+
+                if record['kind'] == RecordKind.APP.value:
+                    app_names.add(record['app'])
+
+        # Every app of the batch is resolved up front, with at most one bulk_write for the unknown ones
+        if app_names:
+            with WRITE_SECONDS['apps'].time():
+                self.registry.resolve(app_names)
+
+        if reports:
+            self.__write_reports(reports, batch_id)
+
+        if sensor_buckets:
+            self.__write_sensor_buckets(sensor_buckets, batch_id)
+
+        if events:
+            self.__write_events(events)
+
+        if metrics_documents:
+            self.__write_metrics(metrics_documents)